@@ -0,0 +1,215 @@
+# Normalize lat/lon AOIs that cross the antimeridian or reach the poles.
+#
+# Bounding boxes are [minx, miny, maxx, maxy] in degrees.  A bbox that crosses
+# the antimeridian is written with minx > maxx, as in GeoJSON (RFC 7946), so
+# Fiji is roughly [177.28, -18.29, -179.79, -16.02] rather than a box around
+# the whole globe.  Anything that looks up tiles or reads pixels works on the
+# parts returned by ``split_bbox``, each of which is an ordinary bbox within
+# [-180, 180].
+#
+# The target projection for an AOI is normally the UTM zone at its center,
+# including the Norway and Svalbard exceptions.  UTM is only defined between
+# 80S and 84N and distorts quickly away from a zone's central meridian, so
+# polar AOIs use a polar stereographic projection and wide AOIs use an
+# azimuthal equal-area projection centered on the AOI.
+import pygeoprocessing
+from osgeo import osr
+
+# UTM zones are 6 degrees wide; beyond about two zones, the scale error at
+# the edges of the AOI gets large.
+MAX_UTM_WIDTH_DEGREES = 12.0
+UTM_MIN_LATITUDE = -80.0
+UTM_MAX_LATITUDE = 84.0
+# NSIDC Sea Ice Polar Stereographic North and Antarctic Polar Stereographic.
+NORTH_POLAR_EPSG = 3413
+SOUTH_POLAR_EPSG = 3031
+# Projected bboxes are computed from this many points along each edge, since
+# the edges of a lat/lon bbox are curves in most projections.
+EDGE_SAMPLES = 101
+
+
+def wrap_longitude(lon):
+    # Into the range [-180, 180).
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def crosses_antimeridian(bbox):
+    return bbox[0] > bbox[2]
+
+
+def bbox_width(bbox):
+    # The longitudinal extent of a bbox in degrees.
+    minx, _, maxx, _ = bbox
+    if minx > maxx:
+        return maxx - minx + 360.0
+    return maxx - minx
+
+
+def normalize_bbox(bbox):
+    """Bring a lat/lon bbox into the form used throughout the pipeline.
+
+    Longitudes outside of [-180, 180] are wrapped, so [170, -20, 190, -10]
+    becomes the antimeridian-crossing [170, -20, -170, -10], and a bbox that
+    covers every longitude becomes [-180, miny, 180, maxy].  Latitudes are
+    clamped to [-90, 90].
+
+    Raises:
+        ValueError: if miny is greater than maxy.
+    """
+    minx, miny, maxx, maxy = [float(coord) for coord in bbox]
+    if miny > maxy:
+        raise ValueError(f'Bounding box {bbox} has miny greater than maxy')
+    miny = max(miny, -90.0)
+    maxy = min(maxy, 90.0)
+    if minx <= maxx and maxx - minx >= 360.0:
+        return [-180.0, miny, 180.0, maxy]
+    if not -180.0 <= minx <= 180.0:
+        minx = wrap_longitude(minx)
+    if not -180.0 <= maxx <= 180.0:
+        maxx = wrap_longitude(maxx)
+    return [minx, miny, maxx, maxy]
+
+
+def split_bbox(bbox):
+    """Split a bbox at the antimeridian.
+
+    Returns:
+        A list of one bbox, or of the eastern and western parts of a bbox
+        that crosses the antimeridian.
+    """
+    minx, miny, maxx, maxy = bbox
+    if minx <= maxx:
+        return [list(bbox)]
+    return [[minx, miny, 180.0, maxy], [-180.0, miny, maxx, maxy]]
+
+
+def buffer_bbox(bbox, buffer_degrees):
+    # Buffer a lat/lon bounding box, wrapping around the antimeridian
+    # rather than stopping at it.
+    minx, miny, maxx, maxy = bbox
+    miny = max(miny - buffer_degrees, -90.0)
+    maxy = min(maxy + buffer_degrees, 90.0)
+    if bbox_width(bbox) + 2 * buffer_degrees >= 360.0:
+        return [-180.0, miny, 180.0, maxy]
+    return normalize_bbox(
+        [minx - buffer_degrees, miny, maxx + buffer_degrees, maxy])
+
+
+def bbox_center(bbox):
+    # The (lon, lat) at the center of a bbox.
+    minx, miny, maxx, maxy = bbox
+    return (wrap_longitude(minx + bbox_width(bbox) / 2),
+            (miny + maxy) / 2)
+
+
+def geometry_bbox(geometry):
+    """The smallest lat/lon bbox around a shapely geometry.
+
+    Geometries that cross the antimeridian are usually split into parts on
+    either side of it, so that their bounds span the whole globe.  Instead,
+    the bbox here leaves out the widest band of longitudes that no part
+    touches, which may mean crossing the antimeridian.
+
+    Raises:
+        ValueError: if the geometry is empty.
+    """
+    parts = getattr(geometry, 'geoms', [geometry])
+    intervals = sorted(
+        (part.bounds[0], part.bounds[2]) for part in parts
+        if not part.is_empty)
+    if not intervals:
+        raise ValueError('An empty geometry has no bounding box')
+    minx, miny, maxx, maxy = geometry.bounds
+    merged = [list(intervals[0])]
+    for start, stop in intervals[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    # The gap that wraps around from the last interval to the first is the
+    # one used by the ordinary (non-crossing) bbox.
+    widest_gap = merged[0][0] + 360.0 - merged[-1][1]
+    for (_, west_stop), (east_start, _) in zip(merged, merged[1:]):
+        if east_start - west_stop > widest_gap:
+            widest_gap = east_start - west_stop
+            minx, maxx = east_start, west_stop
+    return normalize_bbox([minx, miny, maxx, maxy])
+
+
+def get_utm_zone_epsg_from_point(lat, lon):
+    # See https://gis.stackexchange.com/a/387774 and https://gis.stackexchange.com/a/375285/3570
+    # and also https://en.wikipedia.org/wiki/Universal_Transverse_Mercator_coordinate_system#/media/File:Modified_UTM_Zones.png
+    lon = wrap_longitude(lon)
+    utm_zone = int((lon + 180) // 6) + 1
+    # Northern Europe/Arctic has some special cases to handle, which replace
+    # the regular zone rather than the other way around.
+    if lat >= 72.0 and lat < 84.0:
+        if lon >= 0.0 and lon < 9.0:
+            utm_zone = 31
+        elif lon >= 9.0 and lon < 21.0:
+            utm_zone = 33
+        elif lon >= 21.0 and lon < 33.0:
+            utm_zone = 35
+        elif lon >= 33.0 and lon < 42.0:
+            utm_zone = 37
+    elif lat >= 56.0 and lat < 64.0 and lon >= 3.0 and lon < 12.0:
+        utm_zone = 32
+
+    epsg_code = 32600
+    epsg_code += utm_zone
+    if (lat < 0):  # South
+        epsg_code += 100
+    return epsg_code
+
+
+def projection_from_epsg(epsg_code):
+    """The (name, WKT) of an EPSG projection, e.g. ('EPSG32633', ...)."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg_code))
+    return f'EPSG{int(epsg_code)}', srs.ExportToWkt()
+
+
+def target_projection(bbox):
+    """Choose a projection to process a lat/lon AOI in.
+
+    Returns:
+        A (name, WKT) tuple, where the name is suitable for filenames.
+    """
+    minx, miny, maxx, maxy = bbox
+    center_lon, center_lat = bbox_center(bbox)
+    if maxy > UTM_MAX_LATITUDE or miny < UTM_MIN_LATITUDE:
+        if center_lat >= 0:
+            return projection_from_epsg(NORTH_POLAR_EPSG)
+        return projection_from_epsg(SOUTH_POLAR_EPSG)
+
+    if bbox_width(bbox) > MAX_UTM_WIDTH_DEGREES:
+        srs = osr.SpatialReference()
+        srs.ImportFromProj4(
+            f'+proj=laea +lat_0={center_lat:.4f} +lon_0={center_lon:.4f} '
+            '+datum=WGS84 +units=m +no_defs')
+        return (f'LAEA_{center_lat:.2f}_{center_lon:.2f}',
+                srs.ExportToWkt())
+
+    return projection_from_epsg(
+        get_utm_zone_epsg_from_point(center_lat, center_lon))
+
+
+def transform_bbox(bbox, target_projection_wkt):
+    """The bounding box of a lat/lon bbox in another projection.
+
+    A bbox that crosses the antimeridian is transformed one part at a time,
+    which is only meaningful in projections (like those chosen by
+    ``target_projection``) that are continuous across the AOI.
+    """
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    target_bbs = [
+        pygeoprocessing.transform_bounding_box(
+            part, wgs84_srs.ExportToWkt(), target_projection_wkt,
+            edge_samples=EDGE_SAMPLES)
+        for part in split_bbox(bbox)]
+    return [min(target_bb[0] for target_bb in target_bbs),
+            min(target_bb[1] for target_bb in target_bbs),
+            max(target_bb[2] for target_bb in target_bbs),
+            max(target_bb[3] for target_bb in target_bbs)]
@@ -0,0 +1,92 @@
+# Compare the checksum engine in checksums.py against the 1 KiB read loop
+# previously used by verify_checksum in hydrosheds-global-3s-v1-con.py.
+#
+# Synthetic files are written to a temporary directory (or --workdir, which
+# should be on the filesystem you want to measure, e.g. Lustre scratch) and
+# hashed with each implementation.
+#
+# Usage:
+#     python benchmarks/benchmark_checksums.py --n-files 64 --file-size-mb 25
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import checksums  # noqa: E402
+
+
+def legacy_digest(filepath, algorithm):
+    h = hashlib.new(algorithm)
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _time(label, func, n_bytes):
+    start_time = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start_time
+    print(f"{label:<32} {elapsed:8.3f}s {n_bytes / 2**20 / elapsed:10.1f} "
+          "MiB/s")
+    return result, elapsed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-files', type=int, default=32)
+    parser.add_argument('--file-size-mb', type=float, default=25)
+    parser.add_argument('--algorithm', default='md5',
+                        choices=checksums.KNOWN_ALGORITHMS)
+    parser.add_argument('--workers', type=int,
+                        default=checksums.DEFAULT_N_WORKERS)
+    parser.add_argument('--workdir')
+    parsed_args = parser.parse_args(args)
+
+    workdir = tempfile.mkdtemp(dir=parsed_args.workdir)
+    try:
+        file_size = int(parsed_args.file_size_mb * 2**20)
+        filepaths = []
+        for index in range(parsed_args.n_files):
+            filepath = os.path.join(workdir, f'tile{index}.bin')
+            with open(filepath, 'wb') as f:
+                f.write(os.urandom(file_size))
+            filepaths.append(filepath)
+        n_bytes = file_size * len(filepaths)
+        print(f"{len(filepaths)} files, {n_bytes / 2**20:.0f} MiB total, "
+              f"{parsed_args.algorithm}, {parsed_args.workers} workers")
+
+        legacy, legacy_time = _time(
+            'legacy (1 KiB reads, serial)',
+            lambda: {path: legacy_digest(path, parsed_args.algorithm)
+                     for path in filepaths}, n_bytes)
+        serial, _ = _time(
+            'checksums (1 worker)',
+            lambda: checksums.hash_files(
+                filepaths, parsed_args.algorithm, 1), n_bytes)
+        threaded, threaded_time = _time(
+            f'checksums ({parsed_args.workers} threads)',
+            lambda: checksums.hash_files(
+                filepaths, parsed_args.algorithm, parsed_args.workers),
+            n_bytes)
+        processes, _ = _time(
+            f'checksums ({parsed_args.workers} processes)',
+            lambda: checksums.hash_files(
+                filepaths, parsed_args.algorithm, parsed_args.workers,
+                use_processes=True), n_bytes)
+
+        assert legacy == serial == threaded == processes
+        print(f"Speedup (threads vs legacy): {legacy_time / threaded_time:.1f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
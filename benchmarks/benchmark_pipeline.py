@@ -0,0 +1,372 @@
+# Time the stages of the fetcher.py pipeline on synthetic tiles, offline.
+#
+# A grid of SRTM-like 1-degree tiles (zipped HGT, as NASA publishes them, or
+# GeoTIFF) is generated from a smooth synthetic surface, along with a
+# matching bbox JSON and checksum file, and served from a local HTTP server
+# that stands in for DOWNLOAD_BASE_URLS.  For each AOI size, the benchmark
+# then times tile lookup, download, VRT build, warp, pit filling, D8 routing
+# and multi-TFA stream extraction with profiling.Profiler.
+#
+# Results are written to benchmarks/results/<git version>/ (or --results-dir)
+# so that runs can be compared across commits with --compare.
+#
+# Usage:
+#     python benchmarks/benchmark_pipeline.py --grid-size 3 --aoi-sizes 0.5 1 2
+#     python benchmarks/benchmark_pipeline.py --compare benchmarks/results/abc1234/pipeline-*.json
+import argparse
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy
+import pygeoprocessing
+import pygeoprocessing.routing
+from osgeo import gdal
+from osgeo import osr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import aoi  # noqa: E402
+import checksums  # noqa: E402
+import fetcher  # noqa: E402
+import profiling  # noqa: E402
+import tilecache  # noqa: E402
+import zippedtiles  # noqa: E402
+
+LOGGER = logging.getLogger(__name__)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+NODATA = -32768
+# GDAL's SRTMHGT driver only reads the 3 and 1 arc-second tile sizes.
+HGT_TILE_SIZES = (1201, 3601)
+
+
+def tile_name(lat, lon, tile_format):
+    # The name of the tile whose lower left corner is at (lat, lon).
+    name = (f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}"
+            f"{'E' if lon >= 0 else 'W'}{abs(lon):03d}")
+    if tile_format == 'hgt':
+        return f'{name}.SRTMGL1.hgt.zip'
+    return f'{name}.SRTMGL1.tif'
+
+
+def synthetic_elevation(lats, lons, seed=0):
+    """A smooth, continuous surface of ridges and valleys, in meters.
+
+    The surface depends only on the coordinates, so tiles line up at their
+    shared edges, and a little seeded noise gives routing pits to fill.
+    """
+    elevation = (
+        800.0 +
+        300.0 * numpy.sin(lons * 2.1) * numpy.cos(lats * 1.7) +
+        120.0 * numpy.sin(lons * 9.3 + lats * 4.1) +
+        40.0 * lats - 25.0 * lons)
+    rng = numpy.random.default_rng(seed)
+    elevation += rng.normal(0, 2.0, elevation.shape)
+    return numpy.clip(elevation, -100, 8000).astype(numpy.int16)
+
+
+def write_tile(tile_dir, lat, lon, tile_size, tile_format, seed=0):
+    # Tiles overlap their neighbors by one pixel, like SRTM.
+    coords = numpy.linspace(0, 1, tile_size)
+    lons, lats = numpy.meshgrid(lon + coords, lat + 1 - coords)
+    elevation = synthetic_elevation(
+        lats, lons, seed=(seed, lat + 90, lon + 180))
+    name = tile_name(lat, lon, tile_format)
+    path = os.path.join(tile_dir, name)
+    if tile_format == 'hgt':
+        hgt_name = name.split('.')[0] + '.hgt'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as tile_zip:
+            tile_zip.writestr(hgt_name, elevation.astype('>i2').tobytes())
+        return path
+
+    pixel_size = 1.0 / (tile_size - 1)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    raster = gdal.GetDriverByName('GTiff').Create(
+        path, tile_size, tile_size, 1, gdal.GDT_Int16,
+        options=['TILED=YES', 'COMPRESS=LZW'])
+    raster.SetGeoTransform([lon - pixel_size / 2, pixel_size, 0,
+                            lat + 1 + pixel_size / 2, 0, -pixel_size])
+    raster.SetProjection(srs.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(elevation)
+    band = None
+    raster = None
+    return path
+
+
+def generate_tiles(tile_dir, origin, grid_size, tile_size, tile_format,
+                   seed=0):
+    """Write a grid of synthetic tiles and a bbox JSON for them.
+
+    Returns:
+        The path to the bbox JSON, in the format of srtm-data/srtm_bboxes.json.
+    """
+    os.makedirs(tile_dir, exist_ok=True)
+    half_pixel = 0.5 / (tile_size - 1)
+    bboxes = {}
+    for lat in range(origin[0], origin[0] + grid_size):
+        for lon in range(origin[1], origin[1] + grid_size):
+            path = write_tile(tile_dir, lat, lon, tile_size, tile_format,
+                              seed)
+            minx, miny = lon - half_pixel, lat - half_pixel
+            maxx, maxy = lon + 1 + half_pixel, lat + 1 + half_pixel
+            bboxes[os.path.basename(path)] = [
+                [minx, maxy], [minx, miny], [maxx, miny], [maxx, maxy],
+                [minx, maxy]]
+    json_path = os.path.join(tile_dir, 'bboxes.json')
+    with open(json_path, 'w') as json_file:
+        json.dump(bboxes, json_file)
+    return json_path
+
+
+def serve_directory(directory, latency_s=0.0):
+    """Serve a directory over HTTP on localhost from a background thread.
+
+    Returns:
+        The running server and its base URL.
+    """
+    class _TileRequestHandler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            # Simulates the round trip to a remote server.
+            time.sleep(latency_s)
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(
+            _TileRequestHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def benchmark_aoi(profiler, label, bbox, json_path, base_url, expected_digests,
+                  workdir, pixel_size, tfa_list, n_workers):
+    # Runs each stage of the pipeline for one AOI, as fetcher.py does.
+    aoi_dir = os.path.join(workdir, label)
+    tile_cache_dir = os.path.join(aoi_dir, 'tile-cache')
+    os.makedirs(tile_cache_dir)
+    checksums.write_manifest(
+        os.path.join(tile_cache_dir, 'tiles-checksum-sha256.txt'),
+        expected_digests)
+    tile_cache = tilecache.TileCache(tile_cache_dir, 'sha256')
+
+    with profiler.stage(f'{label}/intersecting_tiles') as counts:
+        tilenames = list(fetcher.intersecting_tiles(bbox, json_path))
+        counts['tiles'] = len(tilenames)
+
+    with profiler.stage(f'{label}/download') as counts:
+        with fetcher.new_download_session(n_workers=n_workers) as session:
+            fetcher.download_many(
+                [(f'{base_url}/{tilename}', tilename)
+                 for tilename in tilenames],
+                session=session, n_workers=n_workers, tile_cache=tile_cache)
+        counts['tiles'] = len(tilenames)
+
+    vrt_path = os.path.join(aoi_dir, '0_mosaic.vrt')
+    with profiler.stage(f'{label}/build_vrt', [vrt_path]) as counts:
+        gdal.BuildVRT(
+            vrt_path, zippedtiles.gdal_paths(
+                [tile_cache.tile_path(name) for name in tilenames]),
+            outputBounds=bbox)
+        counts['tiles'] = len(tilenames)
+
+    _, projection_wkt = aoi.target_projection(bbox)
+    warped_path = os.path.join(aoi_dir, '1_warped.tif')
+    with profiler.stage(f'{label}/warp', [warped_path]):
+        fetcher.warp_to_aoi(
+            vrt_path, warped_path, pixel_size, projection_wkt, bbox,
+            n_threads=n_workers)
+
+    filled_path = os.path.join(aoi_dir, '2_pitfilled.tif')
+    with profiler.stage(f'{label}/fill_pits', [filled_path]):
+        pygeoprocessing.routing.fill_pits(
+            (warped_path, 1), filled_path, working_dir=aoi_dir,
+            raster_driver_creation_tuple=(
+                fetcher.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS))
+
+    flow_dir_path = os.path.join(aoi_dir, '3_d8_flow_dir.tif')
+    with profiler.stage(f'{label}/flow_dir_d8', [flow_dir_path]):
+        pygeoprocessing.routing.flow_dir_d8(
+            (filled_path, 1), flow_dir_path, working_dir=aoi_dir,
+            raster_driver_creation_tuple=(
+                fetcher.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS))
+
+    flow_accum_path = os.path.join(aoi_dir, '4_d8_flow_accumulation.tif')
+    with profiler.stage(f'{label}/flow_accumulation_d8', [flow_accum_path]):
+        pygeoprocessing.routing.flow_accumulation_d8(
+            (flow_dir_path, 1), flow_accum_path,
+            raster_driver_creation_tuple=(
+                fetcher.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS))
+
+    streams_paths = [
+        os.path.join(aoi_dir, f'5_tfa{tfa}_streams.tif') for tfa in tfa_list]
+    with profiler.stage(f'{label}/extract_streams', streams_paths):
+        fetcher._extract_streams_d8_multi(
+            flow_accum_path, tfa_list, target_streams_paths=streams_paths)
+
+
+def compare_results(result_paths):
+    # Print the wall time of each stage in each result, relative to the
+    # first result.
+    results = []
+    for path in result_paths:
+        with open(path) as result_file:
+            results.append(json.load(result_file))
+    stage_names = []
+    for result in results:
+        for record in result['stages']:
+            if record['name'] not in stage_names:
+                stage_names.append(record['name'])
+
+    print(f"{'stage':<32}" + ''.join(
+        f"{result['version'] or '?':>16}" for result in results))
+    for name in stage_names:
+        wall_times = [
+            {record['name']: record for record in result['stages']}.get(
+                name, {}).get('wall_time_s') for result in results]
+        baseline = wall_times[0]
+        cells = []
+        for index, wall_time in enumerate(wall_times):
+            if wall_time is None:
+                cells.append(f"{'-':>16}")
+            elif index and baseline:
+                cells.append(f"{wall_time:9.2f}s {wall_time / baseline:4.2f}x")
+            else:
+                cells.append(f"{wall_time:15.2f}s")
+        print(f'{name:<32}' + ''.join(cells))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline on synthetic tiles, offline.')
+    parser.add_argument('--grid-size', type=int, default=3,
+                        help='The number of 1-degree tiles on each side.')
+    parser.add_argument('--origin', type=int, nargs=2, default=[45, 5],
+                        metavar=('LAT', 'LON'),
+                        help='The lower left corner of the tile grid.')
+    parser.add_argument('--tile-size', type=int, default=1201,
+                        help='Pixels on each side of a tile (1201 for 3 '
+                             'arc-seconds, 3601 for 1 arc-second).')
+    parser.add_argument('--format', default='hgt', choices=('hgt', 'gtiff'))
+    parser.add_argument('--aoi-sizes', type=float, nargs='+',
+                        default=[0.5, 1.0, 2.0],
+                        help='AOI widths in degrees, centered on the grid.')
+    parser.add_argument('--tfa-range', default='100::1000::300',
+                        help='The TFAs to extract, as "min::max::step".')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Delay each tile request by this much.')
+    parser.add_argument('--workers', type=int,
+                        default=fetcher.DEFAULT_DOWNLOAD_WORKERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir',
+                        help='Where to write tiles and outputs, e.g. on the '
+                             'filesystem you want to measure.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the tiles and outputs.')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', nargs='+', metavar='RESULT',
+                        help='Compare earlier results instead of running.')
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.compare:
+        compare_results(parsed_args.compare)
+        return 0
+    if (parsed_args.format == 'hgt' and
+            parsed_args.tile_size not in HGT_TILE_SIZES):
+        parser.error(f'HGT tiles must be one of {HGT_TILE_SIZES} pixels '
+                     'on a side; use --format=gtiff for other sizes.')
+    min_tfa, max_tfa, tfa_step = [
+        int(tfa) for tfa in parsed_args.tfa_range.split('::')]
+    tfa_list = list(range(min_tfa, max_tfa + 1, tfa_step))
+    # About 30 m for 1 arc-second tiles, as for SRTM in fetcher.py.
+    pixel_size_m = 30 * 3600 / (parsed_args.tile_size - 1)
+
+    workdir = tempfile.mkdtemp(dir=parsed_args.workdir)
+    server = None
+    try:
+        tile_dir = os.path.join(workdir, 'served')
+        start_time = time.perf_counter()
+        json_path = generate_tiles(
+            tile_dir, parsed_args.origin, parsed_args.grid_size,
+            parsed_args.tile_size, parsed_args.format, parsed_args.seed)
+        tile_paths = [
+            os.path.join(tile_dir, name) for name in os.listdir(tile_dir)
+            if name != 'bboxes.json']
+        expected_digests = checksums.hash_files(tile_paths, 'sha256')
+        LOGGER.info(f"Generated {len(tile_paths)} tiles in "
+                    f"{time.perf_counter() - start_time:.1f}s")
+        server, base_url = serve_directory(
+            tile_dir, parsed_args.latency_ms / 1000)
+
+        profiler = profiling.Profiler()
+        center_lat = parsed_args.origin[0] + parsed_args.grid_size / 2
+        center_lon = parsed_args.origin[1] + parsed_args.grid_size / 2
+        for aoi_size in parsed_args.aoi_sizes:
+            if aoi_size > parsed_args.grid_size:
+                LOGGER.warning(f"Skipping {aoi_size}-degree AOI; the grid is "
+                               f"only {parsed_args.grid_size} degrees wide")
+                continue
+            bbox = [center_lon - aoi_size / 2, center_lat - aoi_size / 2,
+                    center_lon + aoi_size / 2, center_lat + aoi_size / 2]
+            LOGGER.info(f"Benchmarking a {aoi_size}-degree AOI {bbox}")
+            benchmark_aoi(
+                profiler, f'{aoi_size:g}deg', bbox, json_path, base_url,
+                expected_digests, workdir, (pixel_size_m, -pixel_size_m),
+                tfa_list, parsed_args.workers)
+
+        version = profiling.source_version() or 'unversioned'
+        result_dir = os.path.join(parsed_args.results_dir, version)
+        os.makedirs(result_dir, exist_ok=True)
+        result_path = os.path.join(
+            result_dir, f"pipeline-{time.strftime('%Y%m%dT%H%M%S')}.json")
+        with open(result_path, 'w') as result_file:
+            json.dump({
+                'version': version,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'config': vars(parsed_args),
+                'machine': {
+                    'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'gdal': gdal.__version__,
+                    'pygeoprocessing': pygeoprocessing.__version__,
+                    'cpus': os.cpu_count(),
+                },
+                'stages': profiler.records,
+            }, result_file, indent=2)
+
+        print(f"{'stage':<32}{'wall':>10}{'cpu':>10}{'peak MB':>10}"
+              f"{'Mpixels/s':>12}")
+        for record in profiler.records:
+            throughput = ''
+            if record.get('pixels') and record['wall_time_s']:
+                throughput = (
+                    f"{record['pixels'] / record['wall_time_s'] / 1e6:12.1f}")
+            print(f"{record['name']:<32}{record['wall_time_s']:9.2f}s"
+                  f"{record['cpu_time_s']:9.2f}s{record['peak_rss_mb']:10.1f}"
+                  f"{throughput}")
+        print(f"Results written to {result_path}")
+    finally:
+        if server is not None:
+            server.shutdown()
+        if parsed_args.keep:
+            print(f"Tiles and outputs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
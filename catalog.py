@@ -0,0 +1,329 @@
+# A compact, memory-mapped catalog of a product's tiles.
+#
+# The per-product JSON files (e.g. srtm-data/srtm_bboxes.json) store a
+# five-point ring per tile and have to be parsed in full before any tile can
+# be looked up.  A catalog instead stores one fixed-size record per tile in a
+# NumPy structured array:
+#
+#     (name, minx, miny, maxx, maxy, size, checksum, url_index, member)
+#
+# sorted by name and saved as a ``.npy`` file, which is memory-mapped when
+# loaded so that opening a catalog costs next to nothing and only the pages
+# that a query touches are ever read.  The download URL of a tile is one of
+# a handful of templates (stored, with the checksum algorithm, in a small
+# JSON sidecar) with the tile's name substituted for ``{name}``.  For zipped
+# tiles, ``member`` is the name of the raster inside the zip, so that it can
+# be read in place (see zippedtiles.py).
+#
+# Usage to convert a product's JSON bboxes and URL list:
+#     python catalog.py --urls srtm-data/srtm30m_urls.txt srtm-data/srtm_bboxes.json
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy
+
+import checksums
+import tilecache
+
+LOGGER = logging.getLogger(__name__)
+CATALOG_SUFFIX = '-catalog.npy'
+METADATA_SUFFIX = '-catalog.json'
+TILE_DTYPE = numpy.dtype([
+    ('name', 'S48'),
+    ('minx', 'f8'),
+    ('miny', 'f8'),
+    ('maxx', 'f8'),
+    ('maxy', 'f8'),
+    ('size', 'i8'),  # In bytes, or 0 if unknown.
+    ('checksum', 'S64'),  # A hex digest, or empty if unknown.
+    ('url_index', 'i4'),  # Into the URL templates, or -1 if unknown.
+    ('member', 'S48'),  # The raster inside a zipped tile, or empty.
+])
+
+
+def catalog_path_for(product_json_path):
+    return os.path.splitext(product_json_path)[0] + CATALOG_SUFFIX
+
+
+def metadata_path_for(catalog_path):
+    return catalog_path[:-len(CATALOG_SUFFIX)] + METADATA_SUFFIX
+
+
+def is_catalog_path(path):
+    return path.endswith(CATALOG_SUFFIX)
+
+
+def preferred_data_path(product_json_path):
+    """The product's catalog if it is current, otherwise its JSON file."""
+    catalog_path = catalog_path_for(product_json_path)
+    try:
+        catalog_mtime = os.path.getmtime(catalog_path)
+    except OSError:
+        return product_json_path
+    try:
+        if os.path.getmtime(product_json_path) > catalog_mtime:
+            LOGGER.warning(f"{catalog_path} is older than {product_json_path}"
+                           "; using the JSON file")
+            return product_json_path
+    except OSError:
+        pass  # Only the catalog is available.
+    return catalog_path
+
+
+def _bboxes(tiles):
+    return numpy.column_stack(
+        [tiles['minx'], tiles['miny'], tiles['maxx'], tiles['maxy']])
+
+
+class Catalog(object):
+    def __init__(self, tiles, url_templates=(), algorithm=None):
+        self.tiles = tiles  # A TILE_DTYPE array, sorted by name.
+        self.url_templates = list(url_templates)
+        self.algorithm = algorithm
+
+    def __len__(self):
+        return len(self.tiles)
+
+    @property
+    def names(self):
+        return numpy.char.decode(self.tiles['name'], 'ascii')
+
+    @property
+    def bboxes(self):
+        # An (n, 4) array of [minx, miny, maxx, maxy].
+        return _bboxes(self.tiles)
+
+    def query(self, bbox):
+        """Return the indices of the tiles intersecting a lat/lon bbox.
+
+        Touching edges count as intersecting.  A bbox with minx > maxx
+        crosses the antimeridian.
+        """
+        minx, miny, maxx, maxy = bbox
+        tiles = self.tiles
+        in_x = (tiles['minx'] <= maxx) & (tiles['maxx'] >= minx)
+        if minx > maxx:
+            in_x = (tiles['maxx'] >= minx) | (tiles['minx'] <= maxx)
+        return numpy.flatnonzero(
+            in_x & (tiles['miny'] <= maxy) & (tiles['maxy'] >= miny))
+
+    def lookup(self, indices):
+        # The names (as a list) and an (n, 4) array of the bboxes of tiles
+        # by index, as for tileindex.TileIndex.
+        tiles = self.tiles[indices]
+        return (numpy.char.decode(tiles['name'], 'ascii').tolist(),
+                _bboxes(tiles))
+
+    def intersecting(self, bbox):
+        names, _ = self.lookup(self.query(bbox))
+        return iter(names)
+
+    def find(self, names):
+        """Return the indices of tiles by name.
+
+        Raises:
+            KeyError: if any of the names isn't in the catalog.
+        """
+        keys = numpy.asarray(
+            [name.encode('ascii') for name in names], dtype='S48')
+        indices = numpy.searchsorted(self.tiles['name'], keys)
+        indices = numpy.minimum(indices, max(len(self.tiles) - 1, 0))
+        if len(self.tiles) == 0:
+            missing = keys
+        else:
+            missing = keys[self.tiles['name'][indices] != keys]
+        if len(missing):
+            raise KeyError(
+                f"Tiles not in the catalog: "
+                f"{', '.join(numpy.char.decode(missing, 'ascii'))}")
+        return indices
+
+    def url(self, name):
+        """The download URL of a tile, or None if it isn't known."""
+        record = self.tiles[self.find([name])[0]]
+        if record['url_index'] < 0:
+            return None
+        return self.url_templates[record['url_index']].format(name=name)
+
+    def members(self, names):
+        # A {name: member} dict of the named tiles whose zip members are
+        # known.  Catalogs written before members were recorded have none.
+        if 'member' not in self.tiles.dtype.names or not len(names):
+            return {}
+        members = numpy.char.decode(
+            self.tiles['member'][self.find(names)], 'ascii')
+        return {name: str(member) for name, member in zip(names, members)
+                if member}
+
+    def save(self, target_path):
+        temp_path = f'{target_path}.{os.getpid()}.tmp.npy'
+        numpy.save(temp_path, self.tiles, allow_pickle=False)
+        with open(metadata_path_for(target_path), 'w') as metadata_file:
+            json.dump({'url_templates': self.url_templates,
+                       'algorithm': self.algorithm}, metadata_file, indent=2)
+        # The catalog is moved into place last, so it is never newer than
+        # its metadata.
+        os.replace(temp_path, target_path)
+
+    @classmethod
+    def load(cls, catalog_path):
+        tiles = numpy.load(catalog_path, mmap_mode='r', allow_pickle=False)
+        try:
+            with open(metadata_path_for(catalog_path)) as metadata_file:
+                metadata = json.load(metadata_file)
+        except OSError:
+            metadata = {}
+        return cls(tiles, metadata.get('url_templates', ()),
+                   metadata.get('algorithm'))
+
+
+def build_catalog(names, bboxes, urls=None, digests=None, sizes=None,
+                  algorithm=None, members=None):
+    """Build a Catalog.
+
+    Args:
+        names: the tile names.
+        bboxes: an (n, 4) array-like of [minx, miny, maxx, maxy].
+        urls: an optional {name: URL} dict.  URLs are split into a template
+            for their directory and the tile's name.
+        digests: an optional {name: hex digest} dict.
+        sizes: an optional {name: size in bytes} dict.
+        algorithm: the algorithm of ``digests``, e.g. 'sha256'.
+        members: an optional {name: member} dict of the rasters inside
+            zipped tiles.
+    """
+    urls = urls or {}
+    members = members or {}
+    digests = digests or {}
+    sizes = sizes or {}
+    bboxes = numpy.asarray(bboxes, dtype=numpy.float64).reshape(-1, 4)
+    tiles = numpy.zeros(len(names), dtype=TILE_DTYPE)
+    tiles['name'] = [name.encode('ascii') for name in names]
+    tiles['minx'], tiles['miny'], tiles['maxx'], tiles['maxy'] = bboxes.T
+    tiles['size'] = [sizes.get(name, 0) for name in names]
+    tiles['checksum'] = [
+        digests.get(name, '').encode('ascii') for name in names]
+    tiles['member'] = [
+        members.get(name, '').encode('ascii') for name in names]
+
+    template_indices = {}
+    url_indices = []
+    for name in names:
+        url = urls.get(name)
+        if url is None:
+            url_indices.append(-1)
+            continue
+        # Literal braces in the URL are escaped for str.format.
+        escaped_url = url.replace('{', '{{').replace('}', '}}')
+        if url.endswith(name):
+            template = escaped_url[:-len(name)] + '{name}'
+        else:
+            template = escaped_url
+        url_indices.append(
+            template_indices.setdefault(template, len(template_indices)))
+    tiles['url_index'] = url_indices
+    return Catalog(numpy.sort(tiles, order='name'), list(template_indices),
+                   algorithm)
+
+
+def build_catalog_from_json(product_json_path, url_list_path=None,
+                            checksum_path=None, algorithm='sha256',
+                            tiles_dir=None):
+    """Convert a product's JSON bboxes (and URL list) into a Catalog.
+
+    Args:
+        product_json_path: a JSON file mapping tile names to rings of
+            coordinates, e.g. srtm-data/srtm_bboxes.json.
+        url_list_path: an optional file of download URLs, one per line,
+            whose basenames are the tile names.
+        checksum_path: an optional ``sha256sum``-style manifest of the
+            tiles, in ``algorithm``.
+        algorithm: the algorithm of ``checksum_path``.
+        tiles_dir: an optional directory of downloaded tiles to take the
+            tiles' sizes from.
+    """
+    with open(product_json_path) as data_file:
+        json_boundaries = json.load(data_file)
+    names = list(json_boundaries.keys())
+    bboxes = numpy.empty((len(names), 4), dtype=numpy.float64)
+    for tile_index, coords in enumerate(json_boundaries.values()):
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        bboxes[tile_index] = (coords[:, 0].min(), coords[:, 1].min(),
+                              coords[:, 0].max(), coords[:, 1].max())
+
+    urls = {}
+    if url_list_path is not None:
+        with open(url_list_path) as url_file:
+            for line in url_file:
+                url = line.strip()
+                if url:
+                    urls[url.rsplit('/', 1)[-1]] = url
+
+    digests = {}
+    if checksum_path is not None:
+        digests = {
+            os.path.basename(filepath): digest for (filepath, digest) in
+            checksums.read_manifest(checksum_path).items()}
+
+    sizes = {}
+    if tiles_dir is not None:
+        for name in names:
+            try:
+                sizes[name] = os.path.getsize(
+                    tilecache.find_tile(tiles_dir, name))
+            except (OSError, TypeError):
+                pass
+
+    return build_catalog(names, bboxes, urls, digests, sizes,
+                         algorithm if digests else None)
+
+
+_LOADED_CATALOGS = {}
+
+
+def load_catalog(catalog_path):
+    """Memory-map a catalog, reusing it for the life of the process."""
+    catalog_path = os.path.abspath(catalog_path)
+    cache_key = (catalog_path, os.path.getmtime(catalog_path))
+    if cache_key not in _LOADED_CATALOGS:
+        _LOADED_CATALOGS[cache_key] = Catalog.load(catalog_path)
+    return _LOADED_CATALOGS[cache_key]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a product JSON file into a tile catalog.')
+    parser.add_argument('--urls', help='A file of tile URLs, one per line.')
+    parser.add_argument('--checksums',
+                        help='A checksum manifest of the tiles.')
+    parser.add_argument('--algorithm', default='sha256',
+                        choices=checksums.KNOWN_ALGORITHMS)
+    parser.add_argument('--tiles-dir',
+                        help='A directory of the tiles, to record sizes.')
+    parser.add_argument('--output', help=(
+        'The catalog to write.  Defaults to <json name>-catalog.npy next '
+        'to the JSON file.'))
+    parser.add_argument('product_json')
+    parsed_args = parser.parse_args(args)
+    if parsed_args.output and not is_catalog_path(parsed_args.output):
+        parser.error(f'--output must end with {CATALOG_SUFFIX}')
+
+    product_catalog = build_catalog_from_json(
+        parsed_args.product_json, parsed_args.urls, parsed_args.checksums,
+        parsed_args.algorithm, parsed_args.tiles_dir)
+    output_path = (parsed_args.output or
+                   catalog_path_for(parsed_args.product_json))
+    product_catalog.save(output_path)
+    LOGGER.info(
+        f"Wrote {len(product_catalog)} tiles with "
+        f"{len(product_catalog.url_templates)} URL templates to "
+        f"{output_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,340 @@
+# Build a tile catalog (see catalog.py) from a product's tiles in parallel.
+#
+# For each tile, a worker process finds its extent and, if the tile is on
+# local disk, its size, checksum and (for a zip) the name of the raster
+# inside it, all in one task:
+#
+#   * Tiles that follow a known grid (SRTM's 1-degree tiles and GMTED2010's
+#     30x20-degree tiles) have their extent derived from their filename, so
+#     they are never opened by GDAL.
+#   * Other tiles have only their header read.  Zips that GDAL can't open
+#     directly (e.g. the few SRTM tiles whose member isn't named like the
+#     zip; see zippedtiles.py) are opened through /vsizip/ with their actual
+#     member name.
+#
+# Every finished tile is appended to a journal next to the target catalog,
+# so an interrupted build picks up where it left off.  The catalog (and,
+# optionally, the legacy JSON of bbox rings and a checksum manifest) is
+# written once every tile is done.
+#
+# Usage:
+#     python catalogbuilder.py --urls srtm30m_urls.txt --tiles-dir tiles/ \
+#         --write-json srtm_bboxes.json srtm_bboxes-catalog.npy
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from osgeo import gdal
+from osgeo import osr
+
+import catalog
+import checksums
+import tilecache
+import zippedtiles
+
+LOGGER = logging.getLogger(__name__)
+JOURNAL_SUFFIX = '.journal'
+DEFAULT_N_WORKERS = os.cpu_count() or 1
+# Half of a 1 arc-second pixel.  SRTM's pixels are centered on the tile
+# edges, so its tiles extend half a pixel past them; GMTED2010's tiles are
+# shifted by the same amount by the publisher.
+HALF_ARCSECOND = 1 / 7200
+# (filename pattern, (tile width, tile height) in degrees, padding of
+# (minx, miny, maxx, maxy)) for the tilings whose extents are known from the
+# tile's name.  The patterns name the tile's lower left corner.
+GRID_TILINGS = (
+    (re.compile(r'^(?P<lat_hemi>[NS])(?P<lat>\d{2})'
+                r'(?P<lon_hemi>[EW])(?P<lon>\d{3})\.SRTMGL1\.hgt\.zip$'),
+     (1, 1), (-HALF_ARCSECOND, -HALF_ARCSECOND,
+              HALF_ARCSECOND, HALF_ARCSECOND)),
+    (re.compile(r'^(?P<lat>\d{2})(?P<lat_hemi>[NS])'
+                r'(?P<lon>\d{3})(?P<lon_hemi>[EW])_\d{8}_gmted_\w{3}\d{3}'
+                r'\.tif$'),
+     (30, 20), (-HALF_ARCSECOND, -HALF_ARCSECOND,
+                -HALF_ARCSECOND, -HALF_ARCSECOND)),
+)
+
+
+def extent_from_name(tilename):
+    """The [minx, miny, maxx, maxy] of a tile on a known grid, or None."""
+    for pattern, (tile_width, tile_height), padding in GRID_TILINGS:
+        match = pattern.match(tilename)
+        if match is None:
+            continue
+        lat = int(match.group('lat'))
+        if match.group('lat_hemi') == 'S':
+            lat = -lat
+        lon = int(match.group('lon'))
+        if match.group('lon_hemi') == 'W':
+            lon = -lon
+        return [lon + padding[0], lat + padding[1],
+                lon + tile_width + padding[2], lat + tile_height + padding[3]]
+    return None
+
+
+def _open_header(gdal_path):
+    # Opening a dataset only reads its header.
+    raster = gdal.OpenEx(gdal_path, gdal.OF_RASTER)
+    if raster is not None or not gdal_path.endswith('.zip'):
+        return raster
+    member = zippedtiles.choose_member(
+        gdal.ReadDir(f'/vsizip/{gdal_path}') or [])
+    if member is None:
+        return None
+    LOGGER.debug(f"Opening {gdal_path} through /vsizip/ as {member}")
+    return gdal.OpenEx(f'/vsizip/{gdal_path}/{member}', gdal.OF_RASTER)
+
+
+def extent_from_header(gdal_path):
+    """The lat/lon [minx, miny, maxx, maxy] of a raster, from its header."""
+    raster = _open_header(gdal_path)
+    if raster is None:
+        raise ValueError(f"GDAL could not open {gdal_path}")
+    geotransform = raster.GetGeoTransform()
+    corners = [
+        (geotransform[0] + col * geotransform[1] + row * geotransform[2],
+         geotransform[3] + col * geotransform[4] + row * geotransform[5])
+        for col in (0, raster.RasterXSize) for row in (0, raster.RasterYSize)]
+    raster_srs = raster.GetSpatialRef()
+    raster = None
+
+    if raster_srs is not None and not raster_srs.IsGeographic():
+        wgs84_srs = osr.SpatialReference()
+        wgs84_srs.ImportFromEPSG(4326)
+        for srs in (raster_srs, wgs84_srs):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(raster_srs, wgs84_srs)
+        corners = [point[:2] for point in transform.TransformPoints(corners)]
+    lons = [corner[0] for corner in corners]
+    lats = [corner[1] for corner in corners]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def describe_tile(tilename, local_path=None, url=None, algorithm='sha256',
+                  open_tile=False):
+    """Find a tile's catalog record.
+
+    Args:
+        tilename: the tile's name.
+        local_path: the tile's path on disk, if it has been downloaded.
+        url: the tile's URL, used to read its header over /vsicurl/ when
+            there's no local copy and the extent isn't known from its name.
+        algorithm: the checksum algorithm for local tiles.
+        open_tile: if True, read the tile's header even if its extent is
+            known from its name.
+
+    Returns:
+        A dict with the tile's 'name', 'bbox', 'size', 'checksum', 'url' and,
+        for a local zip, the 'member' that is its raster.
+    """
+    bbox = None if open_tile else extent_from_name(tilename)
+    if bbox is None:
+        if local_path is not None:
+            bbox = extent_from_header(local_path)
+        elif url is not None:
+            bbox = extent_from_header(f'/vsicurl/{url}')
+        else:
+            raise ValueError(
+                f"No local copy or URL to read {tilename}'s extent from")
+
+    size = 0
+    digest = ''
+    member = ''
+    if local_path is not None:
+        size = os.path.getsize(local_path)
+        digest = checksums.file_digest(local_path, algorithm)
+        if zippedtiles.is_zipped(local_path):
+            member = zippedtiles.zip_member(local_path)
+    return {'name': tilename, 'bbox': bbox, 'size': size,
+            'checksum': digest, 'url': url, 'member': member}
+
+
+def read_journal(journal_path):
+    # The records of the tiles finished by an earlier, interrupted build.
+    records = {}
+    try:
+        with open(journal_path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut off by the interruption.
+                records[record['name']] = record
+    except OSError:
+        pass
+    return records
+
+
+def build_catalog(tiles, target_catalog_path, algorithm='sha256',
+                  n_workers=DEFAULT_N_WORKERS, open_tiles=False):
+    """Describe every tile in a process pool and write a catalog.
+
+    Args:
+        tiles: a list of (tilename, local path or None, URL or None).
+        target_catalog_path: the catalog to write; it must end with
+            ``catalog.CATALOG_SUFFIX``.
+        algorithm: the checksum algorithm for local tiles.
+        n_workers: the number of worker processes.
+        open_tiles: if True, read every tile's header, even where its extent
+            is known from its name.
+
+    Returns:
+        The list of tile records, in the order of ``tiles``.
+
+    Raises:
+        RuntimeError: if any tile couldn't be described.  The others are
+            kept in the journal, so running again only retries the
+            failures.
+    """
+    journal_path = target_catalog_path + JOURNAL_SUFFIX
+    records = read_journal(journal_path)
+    if records:
+        LOGGER.info(f"Resuming: {len(records)} tiles are already in "
+                    f"{journal_path}")
+    pending = [tile for tile in tiles if tile[0] not in records]
+
+    failures = []
+    start_time = time.time()
+    last_report_time = start_time
+    with open(journal_path, 'a') as journal_file, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(n_workers, 1)) as executor:
+        if journal_file.tell() > 0:
+            # Don't append to a line cut off by an interruption.
+            journal_file.write('\n')
+        futures = {
+            executor.submit(describe_tile, tilename, local_path, url,
+                            algorithm, open_tiles): tilename
+            for tilename, local_path, url in pending}
+        for n_done, future in enumerate(
+                concurrent.futures.as_completed(futures), start=1):
+            tilename = futures[future]
+            try:
+                record = future.result()
+            except Exception:
+                LOGGER.exception(f"Could not describe {tilename}")
+                failures.append(tilename)
+                continue
+            records[tilename] = record
+            journal_file.write(json.dumps(record) + '\n')
+            journal_file.flush()
+            if time.time() - last_report_time > 5.0:
+                elapsed = time.time() - start_time
+                LOGGER.info(f"Described {n_done}/{len(pending)} tiles "
+                            f"({n_done / elapsed:.1f} tiles/s)")
+                last_report_time = time.time()
+
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {len(tiles)} tiles failed: "
+            f"{', '.join(sorted(failures))}")
+
+    ordered_records = [records[tilename] for tilename, _, _ in tiles]
+    digests = {
+        record['name']: record['checksum'] for record in ordered_records
+        if record['checksum']}
+    product_catalog = catalog.build_catalog(
+        [record['name'] for record in ordered_records],
+        [record['bbox'] for record in ordered_records],
+        urls={record['name']: record['url'] for record in ordered_records
+              if record['url']},
+        digests=digests,
+        sizes={record['name']: record['size'] for record in ordered_records},
+        algorithm=algorithm if digests else None,
+        members={record['name']: record.get('member', '')
+                 for record in ordered_records})
+    product_catalog.save(target_catalog_path)
+    os.remove(journal_path)
+    LOGGER.info(f"Wrote {len(product_catalog)} tiles to {target_catalog_path} "
+                f"in {time.time() - start_time:.1f}s")
+    return ordered_records
+
+
+def write_bbox_json(records, target_json_path):
+    # The legacy format: each tile's name mapped to a closed ring of its
+    # bbox's corners, rounded as gdalinfo's wgs84Extent is.
+    with open(target_json_path, 'w') as json_file:
+        json.dump({
+            record['name']: [
+                [minx, maxy], [minx, miny], [maxx, miny], [maxx, maxy],
+                [minx, maxy]]
+            for record in records
+            for minx, miny, maxx, maxy in [
+                [round(coord, 7) for coord in record['bbox']]]}, json_file)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Build a catalog of a product's tiles in parallel.")
+    parser.add_argument('--urls', help=(
+        'A file of tile URLs, one per line.  The tiles are named for the '
+        'last part of their URL.'))
+    parser.add_argument('--tiles-dir', help=(
+        'A directory of downloaded tiles, flat or sharded by the first '
+        f'{tilecache.DEFAULT_SHARD_LENGTH} characters of each tile.  Local '
+        'tiles are checksummed.'))
+    parser.add_argument('--pattern', default='*', help=(
+        'Without --urls, the pattern of the tiles to catalog in '
+        '--tiles-dir.'))
+    parser.add_argument('--algorithm', default='sha256',
+                        choices=checksums.KNOWN_ALGORITHMS)
+    parser.add_argument('--workers', type=int, default=DEFAULT_N_WORKERS)
+    parser.add_argument('--open-tiles', action='store_true', help=(
+        "Read every tile's header, even where its extent is known from its "
+        "name."))
+    parser.add_argument('--write-json', metavar='PATH',
+                        help='Also write the legacy JSON of bbox rings.')
+    parser.add_argument('--write-checksums', metavar='PATH', help=(
+        'Also write a checksum manifest of the local tiles.'))
+    parser.add_argument('catalog', help=(
+        f'The catalog to write, ending with {catalog.CATALOG_SUFFIX}.'))
+    parsed_args = parser.parse_args(args)
+
+    if not catalog.is_catalog_path(parsed_args.catalog):
+        parser.error(f'The catalog must end with {catalog.CATALOG_SUFFIX}')
+    if parsed_args.urls is None and parsed_args.tiles_dir is None:
+        parser.error('At least one of --urls or --tiles-dir is required.')
+
+    if parsed_args.urls is not None:
+        with open(parsed_args.urls) as url_file:
+            urls = [line.strip() for line in url_file if line.strip()]
+        tilenames = [url.rsplit('/', 1)[-1] for url in urls]
+    else:
+        tilenames = sorted(
+            os.path.basename(path) for path in checksums._expand_paths(
+                [parsed_args.tiles_dir], parsed_args.pattern))
+        urls = [None] * len(tilenames)
+
+    tiles = []
+    for tilename, url in zip(tilenames, urls):
+        local_path = None
+        if parsed_args.tiles_dir is not None:
+            local_path = tilecache.find_tile(parsed_args.tiles_dir, tilename)
+        tiles.append((tilename, local_path, url))
+    n_local = sum(local_path is not None for _, local_path, _ in tiles)
+    n_derived = sum(extent_from_name(tilename) is not None
+                    for tilename in tilenames)
+    LOGGER.info(f"Cataloging {len(tiles)} tiles: {n_local} on local disk, "
+                f"{n_derived} with extents known from their names")
+
+    records = build_catalog(
+        tiles, parsed_args.catalog, parsed_args.algorithm,
+        parsed_args.workers, parsed_args.open_tiles)
+    if parsed_args.write_json:
+        write_bbox_json(records, parsed_args.write_json)
+    if parsed_args.write_checksums:
+        checksums.write_manifest(parsed_args.write_checksums, {
+            local_path: record['checksum']
+            for (_, local_path, _), record in zip(tiles, records)
+            if local_path is not None})
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
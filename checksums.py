@@ -0,0 +1,199 @@
+# Parallel checksumming of many files.
+#
+# Files are hashed across a thread pool (hashlib releases the GIL while
+# hashing large buffers) or, optionally, a process pool, and are read through
+# a memory map so that no intermediate copies of the file are made.
+# Manifests are read and written in the format used by sha256sum and md5sum,
+# so that they can also be checked with those tools:
+#
+#     <hexdigest>  <path relative to the manifest's directory>
+#
+# Usage:
+#     python checksums.py --algorithm sha256 --write tiles-checksum-sha256.txt tiles/
+#     python checksums.py --algorithm sha256 --check tiles-checksum-sha256.txt
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import logging
+import mmap
+import os
+import sys
+import time
+
+LOGGER = logging.getLogger(__name__)
+HASH_BUFFER_SIZE = 2**23  # 8 MiB
+KNOWN_ALGORITHMS = ('md5', 'sha256')
+DEFAULT_N_WORKERS = min(os.cpu_count() or 1, 16)
+
+
+def file_digest(filepath, algorithm='sha256', buffer_size=HASH_BUFFER_SIZE):
+    h = hashlib.new(algorithm)
+    with open(filepath, 'rb', buffering=0) as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped, and some filesystems don't
+            # support mmap, so fall back to reading into a reused buffer.
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            while True:
+                n_bytes = f.readinto(buf)
+                if not n_bytes:
+                    break
+                h.update(view[:n_bytes])
+            return h.hexdigest()
+
+        with mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(mapped), buffer_size):
+                    h.update(view[offset:offset + buffer_size])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+
+def hash_files(filepaths, algorithm='sha256', n_workers=DEFAULT_N_WORKERS,
+               use_processes=False):
+    """Hash many files in parallel.
+
+    Args:
+        filepaths: an iterable of paths to hash.
+        algorithm: the hashlib algorithm name.
+        n_workers: the number of threads or processes to use.
+        use_processes: if True, hash in a process pool rather than a thread
+            pool.  Threads are usually enough since hashing releases the GIL.
+
+    Returns:
+        A dict mapping each path to its hex digest.
+    """
+    filepaths = list(filepaths)
+    if use_processes:
+        executor_class = concurrent.futures.ProcessPoolExecutor
+    else:
+        executor_class = concurrent.futures.ThreadPoolExecutor
+
+    digests = {}
+    n_bytes = 0
+    start_time = time.time()
+    last_report_time = start_time
+    with executor_class(max_workers=max(n_workers, 1)) as executor:
+        futures = {
+            executor.submit(file_digest, filepath, algorithm): filepath
+            for filepath in filepaths}
+        for future in concurrent.futures.as_completed(futures):
+            filepath = futures[future]
+            digests[filepath] = future.result()
+            n_bytes += os.path.getsize(filepath)
+            if time.time() - last_report_time > 5.0:
+                LOGGER.info(
+                    f"Hashed {len(digests)}/{len(filepaths)} files "
+                    f"({n_bytes / 2**20 / (time.time() - start_time):.1f} "
+                    "MiB/s)")
+                last_report_time = time.time()
+    return digests
+
+
+def read_manifest(manifest_path):
+    # Parse lines of "<hexdigest>  <path>", where a '*' before the path
+    # indicates binary mode.
+    checksums = {}
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            digest, filepath = line.split(maxsplit=1)
+            checksums[filepath.lstrip('*')] = digest.lower()
+    return checksums
+
+
+def write_manifest(manifest_path, digests):
+    # Paths are written relative to the manifest's directory so that
+    # ``sha256sum -c`` can be run from there.
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    temp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        for filepath, digest in sorted(
+                (os.path.relpath(os.path.abspath(filepath), manifest_dir),
+                 digest) for (filepath, digest) in digests.items()):
+            manifest_file.write(f'{digest}  {filepath}\n')
+    os.replace(temp_path, manifest_path)
+
+
+def verify_manifest(manifest_path, algorithm='sha256',
+                    n_workers=DEFAULT_N_WORKERS, use_processes=False):
+    """Check every file listed in a manifest.
+
+    Returns:
+        A list of the paths (as written in the manifest) that are missing or
+        whose digest does not match.
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    expected = read_manifest(manifest_path)
+    paths = {
+        os.path.join(manifest_dir, filepath): filepath
+        for filepath in expected}
+
+    failures = [
+        filepath for (path, filepath) in paths.items()
+        if not os.path.exists(path)]
+    digests = hash_files(
+        [path for path in paths if os.path.exists(path)], algorithm,
+        n_workers, use_processes)
+    for path, digest in digests.items():
+        if digest != expected[paths[path]]:
+            failures.append(paths[path])
+    return sorted(failures)
+
+
+def _expand_paths(paths, pattern):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in fnmatch.filter(filenames, pattern):
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Write or check a sha256sum-compatible manifest.')
+    parser.add_argument('--algorithm', default='sha256',
+                        choices=KNOWN_ALGORITHMS)
+    parser.add_argument('--workers', type=int, default=DEFAULT_N_WORKERS)
+    parser.add_argument('--processes', action='store_true',
+                        help='Hash in a process pool instead of threads.')
+    parser.add_argument('--pattern', default='*',
+                        help='Filename pattern to match within directories.')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--write', metavar='MANIFEST')
+    mode.add_argument('--check', metavar='MANIFEST')
+    parser.add_argument('paths', nargs='*',
+                        help='Files or directories to hash with --write.')
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.write:
+        digests = hash_files(
+            _expand_paths(parsed_args.paths, parsed_args.pattern),
+            parsed_args.algorithm, parsed_args.workers,
+            parsed_args.processes)
+        write_manifest(parsed_args.write, digests)
+        LOGGER.info(f"Wrote {len(digests)} checksums to {parsed_args.write}")
+        return 0
+
+    failures = verify_manifest(
+        parsed_args.check, parsed_args.algorithm, parsed_args.workers,
+        parsed_args.processes)
+    for filepath in failures:
+        LOGGER.error(f"FAILED: {filepath}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
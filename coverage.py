@@ -0,0 +1,249 @@
+# Where a product has data, at the granularity of tiles and raster blocks.
+#
+# DEM products are only published where there is land, so most global
+# extents are ocean (or otherwise nodata).  A product's coverage is a boolean
+# grid over the globe in lat/lon, marking the cells that are covered by at
+# least one of the product's tiles, derived from the tile bounding boxes in
+# the tile index.  Like the tile index, the grid is saved alongside the
+# product's JSON file and rebuilt when the JSON file changes.
+#
+# ``BlockCoverage`` projects a product's coverage onto the blocks of a raster
+# (e.g. the warped DEM in UTM) so that the stages of the pipeline can skip
+# blocks that can only contain nodata.  Coverage is conservative: a block is
+# only marked empty when no tile comes near it.
+#
+# Usage to prebuild a coverage grid:
+#     python coverage.py srtm-data/srtm_bboxes.json
+import logging
+import math
+import os
+import sys
+
+import numpy
+from osgeo import gdal
+from osgeo import osr
+
+import aoi
+import sidecar
+import tileindex
+
+LOGGER = logging.getLogger(__name__)
+COVERAGE_SUFFIX = '-coverage.npz'
+# The grid always covers the whole globe so that cells are aligned across
+# products.
+GRID_ORIGIN = (-180.0, -90.0)
+# Tile bounding boxes usually extend half a pixel past the tile's nominal
+# extent (e.g. SRTM's 1-degree tiles), so they are shrunk by this fraction of
+# the grid resolution before marking cells.
+EDGE_TOLERANCE = 0.01
+
+
+def coverage_path_for(product_json_path):
+    return os.path.splitext(product_json_path)[0] + COVERAGE_SUFFIX
+
+
+def _cell_ranges(grid_shape, resolution, minx, miny, maxx, maxy):
+    # Vectorized: the (start, stop) columns and rows of the grid cells
+    # touched by each bbox, clipped to the grid.
+    n_rows, n_cols = grid_shape
+    col_start = numpy.clip(numpy.floor(
+        (minx - GRID_ORIGIN[0]) / resolution), 0, n_cols)
+    col_stop = numpy.clip(numpy.floor(
+        (maxx - GRID_ORIGIN[0]) / resolution) + 1, 0, n_cols)
+    row_start = numpy.clip(numpy.floor(
+        (miny - GRID_ORIGIN[1]) / resolution), 0, n_rows)
+    row_stop = numpy.clip(numpy.floor(
+        (maxy - GRID_ORIGIN[1]) / resolution) + 1, 0, n_rows)
+    return (col_start.astype(numpy.int64), col_stop.astype(numpy.int64),
+            row_start.astype(numpy.int64), row_stop.astype(numpy.int64))
+
+
+class Coverage(object):
+    def __init__(self, mask, resolution):
+        # mask[row, col] covers lat/lon cell (col, row) from GRID_ORIGIN, so
+        # row 0 is the southernmost row.
+        self.mask = mask
+        self.resolution = resolution
+        # A summed-area table, so that any rectangle of cells can be counted
+        # in constant time.
+        self._counts = numpy.zeros(
+            (mask.shape[0] + 1, mask.shape[1] + 1), dtype=numpy.int64)
+        self._counts[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    def _cell_ranges(self, minx, miny, maxx, maxy):
+        return _cell_ranges(
+            self.mask.shape, self.resolution, minx, miny, maxx, maxy)
+
+    def _count(self, col_start, col_stop, row_start, row_stop):
+        return (self._counts[row_stop, col_stop] -
+                self._counts[row_start, col_stop] -
+                self._counts[row_stop, col_start] +
+                self._counts[row_start, col_start])
+
+    def fraction(self, bbox):
+        """The fraction of the grid cells touched by a lat/lon bbox that
+        have data.  The bbox may cross the antimeridian."""
+        n_cells = 0
+        n_covered = 0
+        for part in aoi.split_bbox(bbox):
+            col_start, col_stop, row_start, row_stop = self._cell_ranges(
+                *part)
+            part_cells = max((col_stop - col_start) * (row_stop - row_start),
+                             0)
+            if part_cells:
+                n_cells += part_cells
+                n_covered += self._count(
+                    col_start, col_stop, row_start, row_stop)
+        if not n_cells:
+            return 0.0
+        return float(n_covered) / n_cells
+
+    def has_data(self, bbox):
+        return self.fraction(bbox) > 0
+
+    def block_coverage(self, raster_path, block_size=None):
+        """Which blocks of a raster may contain data.
+
+        Args:
+            raster_path: any georeferenced raster.
+            block_size: the (x, y) size of the blocks.  Defaults to the block
+                size of the raster's first band.
+
+        Returns:
+            A ``BlockCoverage`` for the raster.
+        """
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+        if block_size is None:
+            block_size = raster.GetRasterBand(1).GetBlockSize()
+        geotransform = raster.GetGeoTransform()
+        n_cols = raster.RasterXSize
+        n_rows = raster.RasterYSize
+        raster_srs = osr.SpatialReference()
+        raster_srs.ImportFromWkt(raster.GetProjection())
+        raster = None
+
+        block_xsize, block_ysize = block_size
+        col_edges = numpy.append(
+            numpy.arange(0, n_cols, block_xsize), n_cols)
+        row_edges = numpy.append(
+            numpy.arange(0, n_rows, block_ysize), n_rows)
+        # Transform the corners of every block to lat/lon at once.
+        cols, rows = numpy.meshgrid(col_edges, row_edges)
+        x_coords = (geotransform[0] + cols * geotransform[1] +
+                    rows * geotransform[2])
+        y_coords = (geotransform[3] + cols * geotransform[4] +
+                    rows * geotransform[5])
+        wgs84_srs = osr.SpatialReference()
+        wgs84_srs.ImportFromEPSG(4326)
+        for srs in (raster_srs, wgs84_srs):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(raster_srs, wgs84_srs)
+        points = numpy.array(transform.TransformPoints(
+            numpy.column_stack([x_coords.ravel(), y_coords.ravel()])))
+        lons = points[:, 0].reshape(x_coords.shape)
+        lats = points[:, 1].reshape(y_coords.shape)
+
+        def _corner_extremes(coords, reduce):
+            return reduce(reduce(coords[:-1, :-1], coords[1:, :-1]),
+                          reduce(coords[:-1, 1:], coords[1:, 1:]))
+        minx = _corner_extremes(lons, numpy.minimum)
+        maxx = _corner_extremes(lons, numpy.maximum)
+        miny = _corner_extremes(lats, numpy.minimum)
+        maxy = _corner_extremes(lats, numpy.maximum)
+        # Block edges aren't straight lines in lat/lon, so pad each block's
+        # extent a little to stay conservative.  A block that straddles the
+        # antimeridian spans every longitude here, which is conservative too.
+        pad_x = (maxx - minx) * EDGE_TOLERANCE
+        pad_y = (maxy - miny) * EDGE_TOLERANCE
+        mask = self._count(*self._cell_ranges(
+            minx - pad_x, miny - pad_y, maxx + pad_x, maxy + pad_y)) > 0
+        return BlockCoverage(mask, block_size)
+
+    def save(self, target_path):
+        # Renamed into place, like the tile index, so that it is never read
+        # half-written.
+        temp_path = f'{target_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as target_file:
+            numpy.savez_compressed(
+                target_file, mask=self.mask,
+                resolution=numpy.float64(self.resolution))
+        os.replace(temp_path, target_path)
+
+    @classmethod
+    def load(cls, coverage_path):
+        with numpy.load(coverage_path, allow_pickle=False) as coverage_data:
+            return cls(coverage_data['mask'],
+                       float(coverage_data['resolution']))
+
+
+class BlockCoverage(object):
+    def __init__(self, mask, block_size):
+        self.mask = mask  # mask[block_row, block_col]
+        self.block_size = tuple(block_size)
+
+    def has_data(self, xoff, yoff, win_xsize, win_ysize):
+        """Whether any block overlapping a pixel window may contain data."""
+        block_xsize, block_ysize = self.block_size
+        return bool(self.mask[
+            yoff // block_ysize:
+                (yoff + win_ysize + block_ysize - 1) // block_ysize,
+            xoff // block_xsize:
+                (xoff + win_xsize + block_xsize - 1) // block_xsize].any())
+
+    @property
+    def fraction(self):
+        return float(self.mask.mean()) if self.mask.size else 0.0
+
+
+def build_coverage(tile_index, resolution=None):
+    """Build a Coverage grid from a TileIndex.
+
+    If ``resolution`` is not provided, a power of two (in degrees) of no more
+    than a quarter of the smallest tile extent is used, so that e.g. SRTM's
+    1-degree tiles each cover exactly 4x4 cells.
+    """
+    bboxes = tile_index.bboxes
+    if resolution is None:
+        if len(bboxes):
+            smallest_extent = float(numpy.min(numpy.minimum(
+                bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])))
+        else:
+            smallest_extent = 4.0
+        resolution = 2.0 ** math.floor(math.log2(smallest_extent / 4))
+
+    n_cols = int(math.ceil(360 / resolution))
+    n_rows = int(math.ceil(180 / resolution))
+    mask = numpy.zeros((n_rows, n_cols), dtype=bool)
+    tolerance = resolution * EDGE_TOLERANCE
+    col_start, col_stop, row_start, row_stop = _cell_ranges(
+        mask.shape, resolution, bboxes[:, 0] + tolerance, bboxes[:, 1] + tolerance,
+        bboxes[:, 2] - tolerance, bboxes[:, 3] - tolerance)
+    for tile_cells in zip(col_start, col_stop, row_start, row_stop):
+        mask[tile_cells[2]:tile_cells[3], tile_cells[0]:tile_cells[1]] = True
+    return Coverage(mask, resolution)
+
+
+def _build_coverage_from_data(data_path):
+    return build_coverage(tileindex.load_tile_index(data_path))
+
+
+def load_coverage(product_json_path):
+    """Load the coverage grid for a product JSON file, building it if needed.
+
+    The grid is rebuilt when it is missing or older than the JSON file, and
+    loaded grids are kept in memory for the life of the process.
+    """
+    return sidecar.load_or_build(
+        product_json_path, coverage_path_for(product_json_path),
+        Coverage.load, _build_coverage_from_data, 'data coverage')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for data_path in sys.argv[1:]:
+        coverage = _build_coverage_from_data(data_path)
+        coverage.save(coverage_path_for(data_path))
+        LOGGER.info(
+            f"Wrote coverage of {data_path} at {coverage.resolution} degrees "
+            f"({coverage.mask.mean():.1%} of the globe has data) to "
+            f"{coverage_path_for(data_path)}")
@@ -1,22 +1,42 @@
 import argparse
+import concurrent.futures
+import glob
 import json
 import logging
-import math
 import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
 
 import numpy
 import pygeoprocessing
 import pygeoprocessing.routing
 import requests
+import requests.adapters
 import shapely.geometry
+import shapely.ops
 import shapely.prepared
+import shapely.wkb
+import urllib3.exceptions
 from osgeo import gdal
 from osgeo import osr
 from tqdm.auto import tqdm
 
+import aoi
+import catalog
+import coverage
+import profiling
+import stagecache
+import streamwarp
+import tilecache
+import tiledrouting
+import tileindex
+import zippedtiles
+
 logging.basicConfig(level=logging.INFO)
-# TODO: do MD5sum verification of tiles, tracked in JSON
 
 # TODO: Add GMTED2010
 KNOWN_PRODUCTS = {
@@ -26,9 +46,28 @@ KNOWN_PRODUCTS = {
 }
 KNOWN_ROUTING_ALGOS = {'D8', 'MFD'}
 LOGGER = logging.getLogger(__name__)
+# The mirrors that each product's tiles can be downloaded from, in order of
+# preference.  More can be given with --mirror.
 DOWNLOAD_BASE_URLS = {
-    'srtm': 'https://e4ftl01.cr.usgs.gov/MEASURES/SRTMGL1.003/2000.02.11',
+    'srtm': ['https://e4ftl01.cr.usgs.gov/MEASURES/SRTMGL1.003/2000.02.11'],
 }
+DEFAULT_DOWNLOAD_WORKERS = 8
+MIN_DOWNLOAD_CHUNK_SIZE = 2**16  # 64 KiB
+MAX_DOWNLOAD_CHUNK_SIZE = 2**23  # 8 MiB
+# (connect, read) timeouts in seconds.  A transfer that stalls for longer
+# than the read timeout is retried.
+DOWNLOAD_TIMEOUT_S = (10, 60)
+MAX_DOWNLOAD_ATTEMPTS = 5
+RETRY_BACKOFF_S = 1.0
+MAX_RETRY_BACKOFF_S = 60.0
+# Responses that may succeed if the same request is retried later.  Other
+# errors (e.g. a 404) fail over to the next mirror right away.
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# A download that runs for longer than this percentile of the completed
+# downloads' times is hedged with a second attempt, once there are enough
+# completed downloads to tell.
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 5
 PRODUCT_TARGET_RESOLUTION_M = {
     'srtm': (30, -30),
     'hydrosheds': (250, -250),
@@ -42,167 +81,1158 @@ COUNTRY_NAMES = {
     name.upper(): bbox for (name, bbox) in COUNTRY_DATA.values()
 }
 
+DEFAULT_AOI_BUFFER_DEGREES = 0.1
+DEFAULT_WARP_MEMORY_MB = 512
+# The least memory that an AOI in a batch is given.
+MIN_AOI_MEMORY_MB = 1024
+# With SPARSE_OK, blocks that are entirely nodata (e.g. ocean) are never
+# written to disk.
+DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256', 'SPARSE_OK=TRUE'))
+WGS84_SRS = osr.SpatialReference()
+WGS84_SRS.ImportFromEPSG(4326)
+
 gdal.SetCacheMax(1024)  # Megabytes
 
 
-def get_utm_zone_epsg_from_point(lat, lon):
-    # See https://gis.stackexchange.com/a/387774 and https://gis.stackexchange.com/a/375285/3570
-    # and also https://en.wikipedia.org/wiki/Universal_Transverse_Mercator_coordinate_system#/media/File:Modified_UTM_Zones.png
-    # Northern Europe/Arctic has some special cases to handle.
-    if lat >= 72.0 and lat < 84.0:
-        if lon >= 0.0 and lon < 9.0:
-            utm_zone = 31
-        if lon >= 9.0 and lon < 21.0:
-            utm_zone = 33
-        if lon >= 21.0 and lon < 33.0:
-            utm_zone = 35
-        if lon >= 33.0 and lon < 42.0:
-            utm_zone = 37
-    if lat >= 56 and lat < 64.0 and lon >= 3 and lon <= 12:
-        utm_zone = 32
-    utm_zone = math.floor((lon + 180) / 6) + 1
-
-    epsg_code = 32600
-    epsg_code += int(utm_zone)
-    if (lat < 0):  # South
-        epsg_code += 100
-    return epsg_code
+def _extract_streams_d8(flow_accum_path, tfa, target_streams_path):
+    _extract_streams_d8_multi(flow_accum_path, [tfa], [target_streams_path])
 
 
-def _extract_streams_d8(flow_accum_path, tfa, target_streams_path):
+def _extract_streams_d8_multi(flow_accum_path, tfa_list,
+                              target_streams_paths=None,
+                              target_max_tfa_path=None, block_coverage=None):
+    # Extract D8 streams for many thresholds in a single pass over the flow
+    # accumulation raster.  A pixel is a stream at a threshold when its flow
+    # accumulation is greater than the threshold, so the number of
+    # thresholds that a pixel exceeds tells us every stream layer it is in.
+    #
+    # ``target_streams_paths`` are the stream rasters for each threshold in
+    # ``tfa_list``.  If ``target_max_tfa_path`` is provided, write a compact
+    # Int32 raster of the largest threshold in ``tfa_list`` that each pixel
+    # exceeds (or -1 if none), so that the streams for any of these
+    # thresholds are the pixels where that raster is >= the threshold.
+    # Either output may be omitted.
+    #
+    # Blocks outside of ``block_coverage`` (a coverage.BlockCoverage of the
+    # flow accumulation raster), if provided, are not read at all.
     flow_accum_nodata = pygeoprocessing.get_raster_info(
         flow_accum_path)['nodata'][0]
     target_nodata = 255
-    tfa = float(tfa)
+    max_tfa_nodata = numpy.iinfo(numpy.int32).min
+    sort_order = numpy.argsort(tfa_list, kind='stable')
+    thresholds = numpy.asarray(tfa_list, dtype=numpy.float64)[sort_order]
+    if target_streams_paths is None:
+        target_streams_paths = []
+    else:
+        target_streams_paths = [target_streams_paths[i] for i in sort_order]
+
+    targets = []
+    for target_path in target_streams_paths:
+        pygeoprocessing.new_raster_from_base(
+            flow_accum_path, target_path, gdal.GDT_Byte, [target_nodata])
+        targets.append(
+            gdal.OpenEx(target_path, gdal.OF_RASTER | gdal.GA_Update))
+    if target_max_tfa_path:
+        pygeoprocessing.new_raster_from_base(
+            flow_accum_path, target_max_tfa_path, gdal.GDT_Int32,
+            [max_tfa_nodata])
+        targets.append(gdal.OpenEx(
+            target_max_tfa_path, gdal.OF_RASTER | gdal.GA_Update))
+    target_bands = [target.GetRasterBand(1) for target in targets]
+
+    flow_accum_raster = gdal.OpenEx(flow_accum_path, gdal.OF_RASTER)
+    flow_accum_band = flow_accum_raster.GetRasterBand(1)
+    for block_info in pygeoprocessing.iterblocks(
+            (flow_accum_path, 1), offset_only=True):
+        if block_coverage is not None and not block_coverage.has_data(
+                block_info['xoff'], block_info['yoff'],
+                block_info['win_xsize'], block_info['win_ysize']):
+            continue
+        flow_accumulation = flow_accum_band.ReadAsArray(**block_info)
+        if flow_accum_nodata is None:
+            valid_mask = numpy.ones(flow_accumulation.shape, dtype=bool)
+        else:
+            valid_mask = (flow_accumulation != flow_accum_nodata)
+        if not valid_mask.any():
+            # The GTiff driver fills blocks that are never written with
+            # nodata.
+            continue
+
+        # The number of thresholds strictly less than each pixel's flow
+        # accumulation.
+        n_exceeded = numpy.searchsorted(
+            thresholds, flow_accumulation[valid_mask], side='left')
 
-    def _d8_streams(flow_accumulation):
-        valid_mask = (flow_accumulation != flow_accum_nodata)
         result = numpy.full(flow_accumulation.shape, target_nodata,
                             dtype=numpy.uint8)
-        result[valid_mask] = numpy.where(
-            flow_accumulation[valid_mask] <= tfa, 0, 1)
-        return result
+        for threshold_index, band in enumerate(
+                target_bands[:len(target_streams_paths)]):
+            result[valid_mask] = n_exceeded > threshold_index
+            band.WriteArray(
+                result, xoff=block_info['xoff'], yoff=block_info['yoff'])
 
-    pygeoprocessing.raster_calculator(
-        [(flow_accum_path, 1)], _d8_streams, target_streams_path,
-        gdal.GDT_Byte, target_nodata)
+        if target_max_tfa_path:
+            max_tfa = numpy.full(flow_accumulation.shape, max_tfa_nodata,
+                                 dtype=numpy.int32)
+            max_tfa[valid_mask] = numpy.where(
+                n_exceeded > 0, thresholds[numpy.maximum(n_exceeded - 1, 0)],
+                -1)
+            target_bands[-1].WriteArray(
+                max_tfa, xoff=block_info['xoff'], yoff=block_info['yoff'])
 
+    flow_accum_band = None
+    flow_accum_raster = None
+    target_bands = None
+    targets = None
 
-def download(source_url, target_file, session=None):
-    # Adapted from https://stackoverflow.com/a/61575758
-    LOGGER.info(f"Downloading {source_url} --> {target_file}")
+
+def _extract_streams_mfd(flow_accum_path, flow_dir_path, tfa,
+                         target_streams_path):
+    # A module-level wrapper so that MFD extraction can be pickled for a
+    # process pool.
+    LOGGER.info(f"Extracting streams with TFA {tfa}")
+    pygeoprocessing.routing.extract_streams_mfd(
+        flow_accum_raster_path_band=(flow_accum_path, 1),
+        flow_dir_mfd_path_band=(flow_dir_path, 1),
+        flow_threshold=tfa,
+        target_stream_raster_path=target_streams_path)
+
+
+class DownloadError(Exception):
+    """A download failed.
+
+    ``retryable`` is False when retrying the same URL can't help, e.g. after
+    a 404.
+    """
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class DownloadCancelled(Exception):
+    # Raised in a download that lost the race to a hedged attempt.
+    pass
+
+
+class CancelEvent(threading.Event):
+    """An event that stops a download when it is set.
+
+    ``download`` registers its response with the event, so that setting it
+    also aborts a read that is blocked on a stalled server rather than
+    waiting for the read to time out.
+    """
+    def __init__(self):
+        super().__init__()
+        self._response_lock = threading.Lock()
+        self._response = None
+
+    def watch(self, response):
+        with self._response_lock:
+            self._response = response
+            cancelled = self.is_set()
+        if cancelled:
+            _abort_response(response)
+
+    def set(self):
+        with self._response_lock:
+            super().set()
+            response = self._response
+        if response is not None:
+            _abort_response(response)
+
+
+def _abort_response(response):
+    # Shutting the socket down wakes a read blocked in another thread, which
+    # closing it alone doesn't.  urllib3 has had shutdown() since 2.3.
+    shutdown = getattr(response.raw, 'shutdown', None)
+    if shutdown is not None:
+        shutdown()
+    else:
+        response.close()
+
+
+def _open_response(source_url, session=None, headers=None):
     if session:
         # See session example from https://wiki.earthdata.nasa.gov/display/EL/How+To+Access+Data+With+Python
-        authenticated_request = session.request('get', source_url)
-        response = session.get(authenticated_request.url, stream=True)
+        # The first request is redirected to the EarthData login, which
+        # drops the session credentials, so request the login URL again with
+        # the session's auth.  When no login is needed (e.g. on a server
+        # without authentication), the first response is used directly.
+        response = session.request(
+            'get', source_url, headers=headers, stream=True,
+            timeout=DOWNLOAD_TIMEOUT_S)
+        if not response.ok and response.status_code != 416:
+            response.close()
+            response = session.get(response.url, headers=headers, stream=True,
+                                   timeout=DOWNLOAD_TIMEOUT_S)
     else:
-        response = requests.get(source_url, stream=True)
+        response = requests.get(source_url, headers=headers, stream=True,
+                                timeout=DOWNLOAD_TIMEOUT_S)
 
-    if not response.ok:
-        raise AssertionError(
-            f'Response failed with message "{response.text.strip()}" for '
-            f'url {source_url}')
+    # 416 (Range Not Satisfiable) means that a resumed download is already
+    # complete.
+    if not response.ok and response.status_code != 416:
+        status_code = response.status_code
+        message = response.text.strip()
+        response.close()
+        raise DownloadError(
+            f'Response failed with status {status_code} and message '
+            f'"{message}" for url {source_url}',
+            retryable=status_code in RETRYABLE_STATUS_CODES)
+    return response
 
-    with tqdm.wrapattr(open(target_file, "wb"), "write",
-                       miniters=1, desc=source_url.split('/')[-1],
-                       total=int(response.headers.get('content-length', 0))) as fout:
-        for chunk in response.iter_content(chunk_size=4096):
-            fout.write(chunk)
 
+def download(source_url, target_file, session=None, progress=None,
+             resume=False, cancel_event=None):
+    # Adapted from https://stackoverflow.com/a/61575758
+    #
+    # If ``progress`` is a tqdm instance, bytes downloaded are added to it
+    # rather than creating a progress bar for this file alone.
+    #
+    # If ``resume`` is True and ``target_file`` already has data, only the
+    # remaining bytes are requested with an HTTP Range request.  Servers that
+    # ignore the Range header send the whole file, which then replaces the
+    # partial file.
+    #
+    # If ``cancel_event`` (a CancelEvent) is set, the download stops with
+    # DownloadCancelled.
+    headers = {}
+    existing_size = 0
+    if resume and os.path.exists(target_file):
+        existing_size = os.path.getsize(target_file)
+        if existing_size:
+            headers['Range'] = f'bytes={existing_size}-'
 
-# find matching tiles.
-def intersecting_tiles(bbox, product_json_data):
-    bbox_geom = shapely.prepared.prep(shapely.geometry.box(*bbox))
+    LOGGER.info(f"Downloading {source_url} --> {target_file}")
+    with _open_response(source_url, session, headers) as response:
+        if cancel_event is not None:
+            cancel_event.watch(response)
+        if response.status_code == 416:
+            LOGGER.info(f"Download already complete: {target_file}")
+            return
 
-    with open(product_json_data) as data_file:
-        json_boundaries = json.load(data_file)
+        if response.status_code == 206:
+            LOGGER.info(f"Resuming download from byte {existing_size}")
+            file_mode = 'ab'
+        else:
+            existing_size = 0
+            file_mode = 'wb'
 
-    for tile_filename, tile_bbox in json_boundaries.items():
-        tile_geom = shapely.geometry.Polygon(tile_bbox)
-        if not bbox_geom.intersects(tile_geom):
-            continue
+        content_length = int(response.headers.get('content-length', 0))
+        if progress is None:
+            file_progress = tqdm(
+                miniters=1, desc=source_url.split('/')[-1],
+                total=content_length, unit='B', unit_scale=True)
+        else:
+            file_progress = progress
+            with progress.get_lock():
+                progress.total = (progress.total or 0) + content_length
+                progress.refresh()
 
-        # TODO: also yield tile file md5sum?
-        yield tile_filename
+        n_bytes_written = 0
+        try:
+            with open(target_file, file_mode) as fout:
+                for chunk in _iter_adaptive_chunks(response):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise DownloadCancelled(source_url)
+                    fout.write(chunk)
+                    n_bytes_written += len(chunk)
+                    if progress is None:
+                        file_progress.update(len(chunk))
+                    else:
+                        with progress.get_lock():
+                            progress.update(len(chunk))
+        finally:
+            if progress is None:
+                file_progress.close()
 
+    # A dropped connection can end the stream early without an error.  The
+    # length can only be compared when the content wasn't encoded in transit.
+    if (content_length and 'content-encoding' not in response.headers and
+            n_bytes_written != content_length):
+        raise DownloadError(
+            f"Download of {source_url} was truncated: received "
+            f"{n_bytes_written} of {content_length} bytes")
 
-# check tiles against cache and redownload if needed
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--workspace', default=os.getcwd())
-    parser.add_argument('--tile-cache-dir')
 
-    # Auto-detect target projection from closest UTM zone if no projection
-    # provided.
-    parser.add_argument('--target-epsg')
+def _backoff_delay(attempt):
+    # Exponential backoff with "full jitter", so that many workers retrying
+    # at once don't hit a struggling server in lockstep.
+    return random.uniform(
+        0, min(MAX_RETRY_BACKOFF_S, RETRY_BACKOFF_S * 2**attempt))
 
-    parser.add_argument(
-        '--tfa-range', help=(
-            'The min, max and step size of threshold flow accumulation values '
-            'to create in the form MIN:MAX:STEP.  Example: 500::10000::200'))
 
-    parser.add_argument(
-        '--routing-algorithm', choices=KNOWN_ROUTING_ALGOS,
-        help='Routing algorithm to use.')
+def download_with_retries(source_urls, target_file, session=None,
+                          progress=None, resume=True, cancel_event=None):
+    """Download a file from the first of several mirrors that works.
 
-    parser.add_argument(
-        '--username', help=('The username to log in with. Required for SRTM'))
-    parser.add_argument(
-        '--password', help=('The password to log in with.  Required for SRTM'))
+    Attempts rotate through the mirrors.  An attempt that failed in a way
+    that might not happen again (a timeout, a dropped connection, or a
+    5xx or 429 response) is retried after an exponentially growing, randomly
+    jittered delay, resuming the partial file if ``resume`` is True.  A
+    mirror that fails any other way (e.g. a 404) is dropped.
 
-    parser.add_argument(
-        'product', metavar='product', choices=KNOWN_PRODUCTS.keys(),
-        help='The DEM product to use')
+    Args:
+        source_urls: a URL, or a list of the file's URL on each mirror.
+        target_file: the path to write to.
+        session: an optional ``requests.Session``.
+        progress: an optional shared tqdm instance.
+        resume: whether to resume a partial ``target_file``.
+        cancel_event: an optional CancelEvent that stops the download.
 
-    # TODO: add a resolution for the product (e.g. SRTM 1s vs SRTM 3s)
-    # TODO: Add a sub-product, e.g. GMTED minimum vs std deviation
+    Returns:
+        The URL that the file was downloaded from.
 
-    # TODO: support searching by an admin region (countries, states)
-    parser.add_argument(
-        'boundary', help=(
-            'The boundary to use. A path to a vector AOI or a lat/lon '
-            'bounding box in the order "BBOX::minx::miny::maxx::maxy"'))
+    Raises:
+        DownloadError: if every attempt failed.
+        DownloadCancelled: if ``cancel_event`` was set.
+    """
+    if isinstance(source_urls, str):
+        source_urls = [source_urls]
+    mirrors = list(source_urls)
+    last_error = None
+    for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+        if not mirrors:
+            break
+        source_url = mirrors[attempt % len(mirrors)]
+        try:
+            download(source_url, target_file, session=session,
+                     progress=progress, resume=resume,
+                     cancel_event=cancel_event)
+            return source_url
+        except (DownloadError, requests.exceptions.RequestException) as error:
+            if cancel_event is not None and cancel_event.is_set():
+                # The error came from aborting the response.
+                raise DownloadCancelled(source_url) from error
+            last_error = error
+            if not getattr(error, 'retryable', True):
+                LOGGER.warning(f"{error}; not retrying {source_url}")
+                mirrors.remove(source_url)
+                continue
+        if attempt + 1 < MAX_DOWNLOAD_ATTEMPTS:
+            delay = _backoff_delay(attempt)
+            LOGGER.warning(
+                f"Attempt {attempt + 1} of {MAX_DOWNLOAD_ATTEMPTS} at "
+                f"{source_url} failed ({last_error}); retrying in "
+                f"{delay:.1f}s")
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                raise DownloadCancelled(source_url)
+    raise DownloadError(
+        f"Could not download {os.path.basename(target_file)} from "
+        f"{', '.join(source_urls)}: {last_error}", retryable=False)
+
+
+class LatencyTracker(object):
+    # The times of completed downloads, to tell when one has stalled.
+    def __init__(self, percentile=HEDGE_PERCENTILE,
+                 min_samples=HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._durations = []
+        self._lock = threading.Lock()
+
+    def add(self, duration):
+        with self._lock:
+            self._durations.append(duration)
+
+    def hedge_delay(self):
+        # How long a download may run before it is hedged, or None if too
+        # few downloads have completed to tell.
+        with self._lock:
+            if len(self._durations) < self.min_samples:
+                return None
+            return float(numpy.percentile(self._durations, self.percentile))
+
+
+def hedged_download(source_urls, target_file, session=None, progress=None,
+                    latency_tracker=None):
+    """Download a file, starting a second attempt if the first stalls.
+
+    If the download takes longer than ``latency_tracker.hedge_delay()``, a
+    second attempt starts from the next mirror (or the same one, if there's
+    only one).  Whichever attempt finishes first is moved to ``target_file``
+    and the other is cancelled, without waiting for it to stop.  Each
+    attempt retries and fails over as ``download_with_retries`` does.
+
+    Raises:
+        DownloadError: if every attempt failed.
+    """
+    if isinstance(source_urls, str):
+        source_urls = [source_urls]
+    start_time = time.time()
+    hedge_delay = None
+    if latency_tracker is not None:
+        hedge_delay = latency_tracker.hedge_delay()
+    if hedge_delay is None:
+        download_with_retries(source_urls, target_file, session, progress)
+    else:
+        _race_attempts(source_urls, target_file, session, progress,
+                       hedge_delay)
+    if latency_tracker is not None:
+        latency_tracker.add(time.time() - start_time)
+
+
+class _Race(object):
+    # The state shared by the attempts of a hedged download.  Each attempt
+    # writes its own file.  The first to finish moves its file to the target
+    # and cancels the others, and every other attempt deletes its own file
+    # when it stops, so nobody has to wait for the loser.
+    def __init__(self, target_file):
+        self.target_file = target_file
+        self.lock = threading.Lock()
+        self.winner = None
+        self.cancel_events = []
+        self.failed_files = []
 
-    args = parser.parse_args(sys.argv[1:])
 
-    if len(args.boundary) == 2:
+def _remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _run_attempt(race, source_urls, attempt_file, session, progress, resume,
+                 cancel_event):
+    try:
+        source_url = download_with_retries(
+            source_urls, attempt_file, session, progress, resume,
+            cancel_event)
+    except Exception:
+        with race.lock:
+            if race.winner is None:
+                # Kept so that the download can be resumed if every attempt
+                # fails.
+                race.failed_files.append(attempt_file)
+            else:
+                _remove_if_exists(attempt_file)
+        raise
+
+    with race.lock:
+        if race.winner is None:
+            race.winner = attempt_file
+            os.replace(attempt_file, race.target_file)
+            for failed_file in race.failed_files:
+                _remove_if_exists(failed_file)
+            for other_event in race.cancel_events:
+                if other_event is not cancel_event:
+                    other_event.set()
+            return source_url
+    _remove_if_exists(attempt_file)
+    raise DownloadCancelled(source_url)
+
+
+def _race_attempts(source_urls, target_file, session, progress, hedge_delay):
+    target_base, target_ext = os.path.splitext(target_file)
+    primary_file = f'{target_base}.primary{target_ext}'
+    hedge_file = f'{target_base}.hedge{target_ext}'
+    # The primary attempt resumes whatever an earlier download left behind.
+    if os.path.exists(target_file):
+        os.replace(target_file, primary_file)
+    race = _Race(target_file)
+    race.cancel_events = [CancelEvent(), CancelEvent()]
+
+    # The executor isn't shut down with waiting, since the losing attempt
+    # may be blocked on a stalled server.  It cleans up after itself.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        attempts = [executor.submit(
+            _run_attempt, race, source_urls, primary_file, session,
+            progress, True, race.cancel_events[0])]
+        if not concurrent.futures.wait(attempts, timeout=hedge_delay)[0]:
+            LOGGER.info(f"{os.path.basename(target_file)} has taken longer "
+                        f"than {hedge_delay:.1f}s; starting a hedged "
+                        "download")
+            attempts.append(executor.submit(
+                _run_attempt, race, source_urls[1:] + source_urls[:1],
+                hedge_file, session, progress, False, race.cancel_events[1]))
+
+        errors = []
+        pending = set(attempts)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    if len(attempts) > 1 and attempt is attempts[1]:
+                        LOGGER.info(
+                            "The hedged download of "
+                            f"{os.path.basename(target_file)} finished first")
+                    return
+                errors.append(attempt.exception())
+    finally:
+        executor.shutdown(wait=False)
+
+    # Every attempt failed, so none of them is still writing.  Keep the
+    # primary's partial file to resume from next time.
+    if os.path.exists(primary_file):
+        os.replace(primary_file, target_file)
+    _remove_if_exists(hedge_file)
+    raise errors[0]
+
+
+def download_tile(source_urls, tile_cache, tilename, session=None,
+                  progress=None, latency_tracker=None):
+    # Download a tile (from any of its mirrors; see hedged_download) into a
+    # partial file in the cache, resuming any earlier interrupted download,
+    # and move it into place once it is verified.
+    #
+    # Only one job sharing the cache downloads a tile at a time.  The others
+    # wait for the tile's lock and then find it in the cache.  If nobody
+    # held the lock, the tile was missing when the cache was checked, so
+    # the manifest is only read again if the tile has appeared since.
+    with tile_cache.lock(tilename) as waited:
+        if ((waited or os.path.exists(tile_cache.tile_path(tilename))) and
+                tile_cache.is_valid(tilename)):
+            LOGGER.info(f"{tilename} was downloaded by another job")
+            return tile_cache.tile_path(tilename)
+        partial_path = tile_cache.partial_path(tilename)
+        hedged_download(source_urls, partial_path, session=session,
+                        progress=progress, latency_tracker=latency_tracker)
+        try:
+            return tile_cache.commit(tilename, partial_path)
+        except AssertionError:
+            # The partial file may have been corrupt before we resumed it,
+            # so try once more from scratch.
+            LOGGER.warning(
+                f"{tilename} failed verification; downloading again")
+            os.remove(partial_path)
+            hedged_download(source_urls, partial_path, session=session,
+                            progress=progress,
+                            latency_tracker=latency_tracker)
+            return tile_cache.commit(tilename, partial_path)
+
+
+def _iter_adaptive_chunks(response):
+    # Grow the chunk size while chunks arrive quickly and shrink it when they
+    # are slow, so fast connections aren't bound by per-chunk overhead and
+    # slow ones still report progress regularly.
+    chunk_size = MIN_DOWNLOAD_CHUNK_SIZE
+    while True:
+        start_time = time.time()
+        try:
+            chunk = response.raw.read(chunk_size, decode_content=True)
+        except urllib3.exceptions.HTTPError as error:
+            # Reading the raw stream raises urllib3's exceptions rather than
+            # requests', e.g. a ReadTimeoutError when the transfer stalls, so
+            # they are raised as a DownloadError to be retried.
+            raise DownloadError(
+                f"Download of {response.url} failed mid-transfer: "
+                f"{error}") from error
+        if not chunk:
+            break
+        yield chunk
+
+        elapsed = time.time() - start_time
+        if elapsed < 0.1 and len(chunk) == chunk_size:
+            chunk_size = min(chunk_size * 2, MAX_DOWNLOAD_CHUNK_SIZE)
+        elif elapsed > 1.0:
+            chunk_size = max(chunk_size // 2, MIN_DOWNLOAD_CHUNK_SIZE)
+
+
+def new_download_session(auth=None, n_workers=DEFAULT_DOWNLOAD_WORKERS):
+    # requests keeps a connection pool per host; make it large enough for
+    # every worker thread to hold a connection to the same host.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=n_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = auth
+    return session
+
+
+def download_many(url_target_pairs, session=None,
+                  n_workers=DEFAULT_DOWNLOAD_WORKERS, tile_cache=None,
+                  on_download=None):
+    """Download many files concurrently with a bounded thread pool.
+
+    Each download retries, fails over between mirrors and is hedged if it
+    stalls; see ``hedged_download``.
+
+    Args:
+        url_target_pairs: an iterable of ``(source_url, target)``, where
+            ``source_url`` may be a list of the file's URL on each mirror.
+            If ``tile_cache`` is provided, each target is a tile name in the
+            cache, otherwise it is the path to write to.
+        session: an optional ``requests.Session`` shared by all workers.  See
+            ``new_download_session``.
+        n_workers: the maximum number of concurrent downloads.
+        tile_cache: an optional ``tilecache.TileCache``.  If provided, files
+            are downloaded with ``download_tile`` so that they are verified
+            and moved into the cache atomically, and the cache's manifest is
+            saved once, after the last download.
+        on_download: an optional function that is called with each target
+            as soon as it has been downloaded.
+
+    Returns:
+        A list of the files downloaded.
+
+    Raises:
+        RuntimeError: if any download failed.  All other downloads are
+            allowed to finish first.
+    """
+    url_target_pairs = list(url_target_pairs)
+    if not url_target_pairs:
+        return []
+
+    failures = []
+    downloaded_files = []
+    latency_tracker = LatencyTracker()
+    with tqdm(total=0, desc=f'Downloading {len(url_target_pairs)} files',
+              unit='B', unit_scale=True) as progress:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_workers) as executor:
+            futures = {}
+            for (source_urls, target) in url_target_pairs:
+                if isinstance(source_urls, str):
+                    source_urls = [source_urls]
+                if tile_cache is None:
+                    future = executor.submit(
+                        hedged_download, source_urls, target,
+                        session=session, progress=progress,
+                        latency_tracker=latency_tracker)
+                else:
+                    future = executor.submit(
+                        download_tile, source_urls, tile_cache, target,
+                        session=session, progress=progress,
+                        latency_tracker=latency_tracker)
+                futures[future] = (source_urls[0], target)
+
+            for future in concurrent.futures.as_completed(futures):
+                source_url, target = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    LOGGER.exception(f"Download failed: {source_url}")
+                    failures.append(source_url)
+                    continue
+                if tile_cache is None:
+                    downloaded_files.append(target)
+                else:
+                    downloaded_files.append(tile_cache.tile_path(target))
+                if on_download is not None:
+                    on_download(target)
+
+    if tile_cache is not None:
+        tile_cache.save()
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {len(url_target_pairs)} downloads failed: "
+            f"{', '.join(failures)}")
+    return downloaded_files
+
+
+def warp_to_aoi(base_raster_path, target_raster_path, target_pixel_size,
+                target_projection_wkt, aoi_bbox, resample_method='bilinear',
+                n_threads=None, warp_memory_mb=DEFAULT_WARP_MEMORY_MB,
+                overview_level=None, cutline_path=None):
+    """Warp only the part of a raster within a lat/lon bounding box.
+
+    The output bounds are computed from ``aoi_bbox`` in the target
+    projection and snapped to the target pixel size, so GDAL only reads the
+    source pixels needed for that window.
+
+    Args:
+        base_raster_path: the raster (usually a VRT mosaic) to warp, or a
+            list of rasters, e.g. one for each side of an AOI that crosses
+            the antimeridian.
+        target_raster_path: the GeoTIFF to create.
+        target_pixel_size: an (x, y) tuple in target projection units.
+        target_projection_wkt: the WKT of the target projection.
+        aoi_bbox: the [minx, miny, maxx, maxy] lat/lon area to warp.  It
+            may cross the antimeridian (see ``aoi.split_bbox``).
+        resample_method: a GDAL resampling algorithm name.
+        n_threads: the number of warp threads.  Defaults to every CPU.
+        warp_memory_mb: the memory limit for the warp's chunk buffers.
+        overview_level: the index of the source overview to read from, or
+            None to read full-resolution pixels.  See
+            ``select_overview_level``.
+        cutline_path: an optional lat/lon vector of the AOI's geometry.
+            Pixels outside of it are set to nodata.
+
+    Returns:
+        ``None``
+    """
+    if isinstance(base_raster_path, str):
+        base_raster_path = [base_raster_path]
+    base_raster_info = pygeoprocessing.get_raster_info(base_raster_path[0])
+    target_bb = aoi.transform_bbox(aoi_bbox, target_projection_wkt)
+    nodata = base_raster_info['nodata'][0]
+    if n_threads is None:
+        n_threads = 'ALL_CPUS'
+
+    def _warp_progress(pct_complete, message, user_data):
+        if time.time() - _warp_progress.last_progress_report > 5.0:
+            LOGGER.info(f"Warp progress: {round(pct_complete * 100, 2)}%")
+            _warp_progress.last_progress_report = time.time()
+    _warp_progress.last_progress_report = time.time()
+
+    driver, creation_options = DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS
+    gdal.Warp(
+        target_raster_path, base_raster_path,
+        format=driver,
+        creationOptions=list(creation_options),
+        outputBounds=target_bb,
+        xRes=abs(target_pixel_size[0]),
+        yRes=abs(target_pixel_size[1]),
+        targetAlignedPixels=True,
+        dstSRS=target_projection_wkt,
+        resampleAlg=resample_method,
+        srcNodata=nodata,
+        dstNodata=nodata,
+        multithread=True,
+        # Chunks of the output with no source pixels are skipped entirely
+        # and, with SPARSE_OK, never written.
+        warpOptions=[f'NUM_THREADS={n_threads}', 'SKIP_NOSOURCE=YES'],
+        warpMemoryLimit=warp_memory_mb * 2**20,
+        overviewLevel='NONE' if overview_level is None else overview_level,
+        cutlineDSName=cutline_path,
+        callback=_warp_progress)
+
+
+def select_overview_level(raster_path, target_pixel_size,
+                          target_projection_wkt, aoi_bbox):
+    """Find the coarsest overview that still meets a target pixel size.
+
+    Args:
+        raster_path: the source raster.
+        target_pixel_size: an (x, y) tuple in target projection units.
+        target_projection_wkt: the WKT of the target projection.
+        aoi_bbox: the [minx, miny, maxx, maxy] lat/lon area to be warped,
+            used to convert the target pixel size into source units.  It
+            must not cross the antimeridian; use one of its parts instead.
+
+    Returns:
+        The index of the overview to read from, or None if the source's
+        full-resolution pixels are needed.
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    n_overviews = band.GetOverviewCount()
+    if not n_overviews:
+        return None
+
+    source_info = pygeoprocessing.get_raster_info(raster_path)
+    source_bb = pygeoprocessing.transform_bounding_box(
+        aoi_bbox, WGS84_SRS.ExportToWkt(), source_info['projection_wkt'])
+    target_bb = aoi.transform_bbox(aoi_bbox, target_projection_wkt)
+    # The target pixel size in source units, using the finer of the two axes
+    # so that the overview is never coarser than the target in either.
+    target_source_pixel_size = min(
+        abs(target_pixel_size[0]) * (source_bb[2] - source_bb[0]) /
+        (target_bb[2] - target_bb[0]),
+        abs(target_pixel_size[1]) * (source_bb[3] - source_bb[1]) /
+        (target_bb[3] - target_bb[1]))
+
+    # Overviews may be internal or in an external .ovr file (as written by
+    # build_overviews with internal=False); GDAL exposes both the same way.
+    # A VRT of tiles exposes its sources' overviews when they all have them.
+    base_pixel_size_x = abs(source_info['pixel_size'][0])
+    base_pixel_size_y = abs(source_info['pixel_size'][1])
+    selected_level = None
+    for level in range(n_overviews):
+        overview = band.GetOverview(level)
+        overview_pixel_size_x = (
+            base_pixel_size_x * raster.RasterXSize / overview.XSize)
+        overview_pixel_size_y = (
+            base_pixel_size_y * raster.RasterYSize / overview.YSize)
+        if (max(overview_pixel_size_x, overview_pixel_size_y) <=
+                target_source_pixel_size):
+            selected_level = level
+            reduction = ((raster.RasterXSize * raster.RasterYSize) /
+                         (overview.XSize * overview.YSize))
+    overview = None
+    band = None
+    raster = None
+
+    if selected_level is None:
+        LOGGER.info("Reading full-resolution source pixels")
+    else:
+        LOGGER.info(f"Reading source overview level {selected_level}, about "
+                    f"{reduction:.0f}x fewer pixels than full resolution")
+    return selected_level
+
+
+def find_global_raster(cache_dir, product_name):
+    # The global product is a cloud-optimized GeoTIFF with overviews named
+    # <product>-<resolution>-<subproduct>-global.tif (see the README), either
+    # alongside the product's tiles or in its own product directory.
+    for pattern in (
+            os.path.join(cache_dir, product_name.lower(), '*-global.tif'),
+            os.path.join(cache_dir, f'{product_name}-*', '*-global.tif')):
+        candidates = sorted(glob.glob(pattern))
+        if candidates:
+            return candidates[0]
+    return None
+
+
+# find matching tiles.
+def intersecting_tiles(bbox, product_json_data, geometry=None):
+    # The tile index is built once per product JSON and cached on disk (and
+    # a catalog is queried in place), so lookups don't need to parse the
+    # JSON or build a geometry per tile.
+    tile_index = tileindex.load_tile_index(product_json_data)
+    names, bboxes = tile_index.lookup(tile_index.query(bbox))
+
+    if geometry is not None:
+        # Only the tiles in the bbox are tested against the geometry, which
+        # is prepared so that each test is fast even for detailed shapes.
+        prepared_geometry = shapely.prepared.prep(geometry)
+        n_candidates = len(names)
+        names = [
+            name for name, tile_bbox in zip(names, bboxes)
+            if prepared_geometry.intersects(shapely.geometry.box(*tile_bbox))]
+        LOGGER.debug(f"{len(names)} of the {n_candidates} tiles in "
+                     "the bounding box intersect the AOI geometry")
+
+    # TODO: also yield tile file md5sum?
+    for name in names:
+        yield name
+
+
+def source_geometry(geometry, buffer_degrees, simplify_tolerance=0):
+    """Buffer (and optionally simplify) a lat/lon AOI geometry.
+
+    The geometry is buffered by an extra ``simplify_tolerance`` before it is
+    simplified, so the result always contains the AOI buffered by
+    ``buffer_degrees``.
+    """
+    geometry = geometry.buffer(buffer_degrees + simplify_tolerance)
+    if simplify_tolerance:
+        geometry = geometry.simplify(
+            simplify_tolerance, preserve_topology=True)
+    return geometry
+
+
+def write_cutline(geometry, target_path):
+    # GeoJSON is always in lat/lon, which is what the cutline is in.
+    with open(target_path, 'w') as cutline_file:
+        json.dump({
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'properties': {},
+                'geometry': shapely.geometry.mapping(geometry),
+            }],
+        }, cutline_file)
+
+
+# check tiles against cache and redownload if needed
+def resolve_boundary(boundary):
+    """Find the lat/lon bounding box of a boundary.
+
+    Args:
+        boundary: an ISO-3166-1 alpha-2 code, a country name, the path to a
+            spatial file or a bounding box in the form
+            "BBOX::minx::miny::maxx::maxy".
+
+    Returns:
+        The [minx, miny, maxx, maxy] bounding box.  A bounding box that
+        crosses the antimeridian has minx > maxx, e.g.
+        "BBOX::170::-20::-170::-10".
+
+    Raises:
+        ValueError: if the boundary can't be interpreted.
+    """
+    if len(boundary) == 2:
         # It's an ISO-3166-1 code
-        if args.boundary.upper() not in COUNTRY_DATA:
-            parser.error(
-                f'Boundary {args.boundary} is not a known 2-character '
+        if boundary.upper() not in COUNTRY_DATA:
+            raise ValueError(
+                f'Boundary {boundary} is not a known 2-character '
                 'ISO-3166-1 code. See the Alpha-2 code list in '
                 'https://en.wikipedia.org/wiki/ISO_3166-1 for a list of '
                 'valid country codes.')
-        bbox = COUNTRY_DATA[args.boundary.upper()][1]
-    elif args.boundary.upper() in COUNTRY_NAMES:
+        bbox = COUNTRY_DATA[boundary.upper()][1]
+    elif boundary.upper() in COUNTRY_NAMES:
         # It's a country name
-        bbox = COUNTRY_NAMES[args.boundary.upper()]
-    elif os.path.exists(args.boundary):
+        bbox = COUNTRY_NAMES[boundary.upper()]
+    elif os.path.exists(boundary):
         # It's a spatial file
-        gis_type = pygeoprocessing.get_gis_type(args.boundary)
+        gis_type = pygeoprocessing.get_gis_type(boundary)
         if (gis_type & pygeoprocessing.RASTER_TYPE):
-            bbox = pygeoprocessing.get_raster_info(
-                args.boundary)['bounding_box']
+            bbox = pygeoprocessing.get_raster_info(boundary)['bounding_box']
         elif (gis_type & pygeoprocessing.VECTOR_TYPE):
-            bbox = pygeoprocessing.get_vector_info(
-                args.boundary)['bounding_box']
+            bbox = pygeoprocessing.get_vector_info(boundary)['bounding_box']
         else:
             raise ValueError('File exists but is not a GDAL filetype: '
-                             f'{args.bbox}')
+                             f'{boundary}')
         LOGGER.info(f'Bounding box {bbox} read from spatial file '
-                    f'{args.boundary}')
+                    f'{boundary}')
     else:
         # Assume "minx,miny,maxx,maxy"
-        bbox = [float(coord) for coord in
-                args.boundary.replace('BBOX::', '').split('::')]
+        try:
+            bbox = [float(coord) for coord in
+                    boundary.replace('BBOX::', '').split('::')]
+        except ValueError:
+            raise ValueError(f'Could not interpret boundary {boundary}')
+        if len(bbox) != 4:
+            raise ValueError(
+                f'Bounding box {boundary} must have 4 coordinates')
         LOGGER.info(f'User defined bounding box of {bbox}')
+    return aoi.normalize_bbox(bbox)
+
+
+def _aoi_name(boundary):
+    # A name for the AOI's workspace that is safe to use as a directory.
+    if os.path.exists(boundary):
+        boundary = os.path.splitext(os.path.basename(boundary))[0]
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_',
+                  boundary.replace('BBOX::', '')).strip('_')
+
+
+def read_vector_geometries(vector_path):
+    """Yield the (FID, lat/lon shapely geometry) of every feature in a vector.
+
+    Geometries are reprojected to lat/lon if the layer has a projection.
+    """
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    transform = None
+    layer_srs = layer.GetSpatialRef()
+    if layer_srs is not None and not layer_srs.IsSame(WGS84_SRS):
+        layer_srs = layer_srs.Clone()
+        layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84_srs = WGS84_SRS.Clone()
+        wgs84_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(layer_srs, wgs84_srs)
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        yield feature.GetFID(), shapely.wkb.loads(
+            bytes(geometry.ExportToWkb()))
+    layer = None
+    vector = None
+
+
+def _is_vector(boundary):
+    return bool(os.path.exists(boundary) and
+                pygeoprocessing.get_gis_type(boundary) &
+                pygeoprocessing.VECTOR_TYPE)
+
+
+def resolve_aois(boundaries, each_feature=False):
+    """Resolve boundaries to a list of uniquely-named AOIs.
+
+    Vector boundaries keep their geometry (the union of their features), so
+    that tiles and pixels outside of the actual shape can be skipped.  If
+    ``each_feature`` is True, every feature of a vector boundary is its own
+    AOI.
+
+    Returns:
+        A list of (name, bbox, geometry) tuples, where ``geometry`` is a
+        lat/lon shapely geometry or None if only the bbox is known.
+
+    Raises:
+        ValueError: if a boundary can't be interpreted.
+    """
+    aois = []
+    for boundary in boundaries:
+        if _is_vector(boundary):
+            features = list(read_vector_geometries(boundary))
+            if not features:
+                raise ValueError(f'{boundary} has no features')
+            vector_name = _aoi_name(boundary)
+            if each_feature:
+                for fid, geometry in features:
+                    if geometry.is_empty:
+                        raise ValueError(
+                            f'Feature {fid} of {boundary} has an empty '
+                            'geometry')
+                    aois.append((f'{vector_name}-{fid}',
+                                 aoi.geometry_bbox(geometry), geometry))
+            else:
+                geometry = shapely.ops.unary_union(
+                    [geometry for _, geometry in features])
+                if geometry.is_empty:
+                    raise ValueError(
+                        f'Every feature of {boundary} has an empty geometry')
+                bbox = aoi.geometry_bbox(geometry)
+                LOGGER.info(f'Bounding box {bbox} read from vector '
+                            f'{boundary}')
+                aois.append((vector_name, bbox, geometry))
+        else:
+            aois.append(
+                (_aoi_name(boundary), resolve_boundary(boundary), None))
+
+    seen_names = {}
+    unique_aois = []
+    for name, bbox, geometry in aois:
+        if name in seen_names:
+            seen_names[name] += 1
+            name = f'{name}-{seen_names[name]}'
+        else:
+            seen_names[name] = 0
+        unique_aois.append((name, bbox, geometry))
+    return unique_aois
+
+
+def product_data_file(product):
+    # The product's tile catalog, if it has been converted to one.
+    return catalog.preferred_data_path(
+        os.path.join(os.path.dirname(__file__), 'data', f'{product}.json'))
+
+
+def tile_urls(product, tilename, tile_data_file, mirrors=()):
+    """The URLs to download a tile from, in order of preference.
+
+    These are the tile in each of ``mirrors`` (base URLs given by the
+    user), then the tile's URL in the catalog, if there is one, and then the
+    tile in each of the product's ``DOWNLOAD_BASE_URLS``.
+    """
+    urls = [f"{base_url.rstrip('/')}/{tilename}" for base_url in mirrors]
+    if catalog.is_catalog_path(tile_data_file):
+        url = catalog.load_catalog(tile_data_file).url(tilename)
+        if url is not None:
+            urls.append(url)
+    urls += [f'{base_url}/{tilename}'
+             for base_url in DOWNLOAD_BASE_URLS.get(product, [])]
+    return list(dict.fromkeys(urls))
+
 
+def fetch_tiles(product, aoi_sources, tile_cache, auth=None,
+                n_workers=DEFAULT_DOWNLOAD_WORKERS, profiler=None,
+                mirrors=(), on_tile=None):
+    """Make sure every tile needed by any of the AOIs is in the cache.
+
+    Tiles shared by several AOIs are only checked and downloaded once.  The
+    tiles are held in the cache, so that no other job sharing it evicts
+    them, until ``tile_cache.release()`` is called.  Once they are
+    downloaded, the cache is trimmed to its size cap, if it has one.
+
+    Args:
+        product: the product name.
+        aoi_sources: a list of the (bbox, geometry) of the area to read for
+            each AOI, where ``geometry`` may be None.
+        tile_cache: the product's TileCache.
+        auth: the (username, password) to download with, if needed.
+        n_workers: the maximum number of concurrent downloads.
+        profiler: an optional ``profiling.Profiler`` to record the lookup,
+            check and download stages with.
+        mirrors: base URLs to try before the product's own; see
+            ``tile_urls``.
+        on_tile: an optional function that is called with the name of each
+            tile as soon as it is in the cache: first the tiles that already
+            were, and then each tile as its download finishes.
+
+    Returns:
+        A list of the tile names needed for each AOI.
+    """
+    if profiler is None:
+        profiler = profiling.Profiler()
+    tile_data_file = product_data_file(product)
+    with profiler.stage('tile_lookup') as counts:
+        tilenames_per_aoi = [
+            list(intersecting_tiles(source_bbox, tile_data_file, geometry))
+            for source_bbox, geometry in aoi_sources]
+        tilenames = sorted(set().union(*tilenames_per_aoi))
+        counts['tiles'] = len(tilenames)
+    tiles_needed = sum(len(aoi_tiles) for aoi_tiles in tilenames_per_aoi)
+    if len(aoi_sources) > 1:
+        LOGGER.info(f"{len(aoi_sources)} AOIs need {len(tilenames)} unique "
+                    f"tiles ({tiles_needed} without deduplication)")
+
+    with profiler.stage('tile_check') as counts:
+        # The tiles are held before the manifest is read, so a tile that is
+        # found in the cache can't be evicted before we use it.
+        tile_cache.hold(tilenames)
+        valid_tiles = tile_cache.valid_tiles(tilenames)
+        counts['tiles'] = len(tilenames)
+    missing_tiles = [
+        tilename for tilename in tilenames
+        if tilename not in valid_tiles]
+    LOGGER.info(f"{len(missing_tiles)} of {len(tilenames)} tiles need to "
+                "be downloaded")
+    if on_tile is not None:
+        for tilename in tilenames:
+            if tilename in valid_tiles:
+                on_tile(tilename)
+    with profiler.stage('download') as counts:
+        counts['tiles'] = len(missing_tiles)
+        with new_download_session(auth, n_workers) as session:
+            download_many(
+                [(tile_urls(product, tilename, tile_data_file, mirrors),
+                  tilename) for tilename in missing_tiles],
+                session=session, n_workers=n_workers, tile_cache=tile_cache,
+                on_download=on_tile)
+    tile_cache.evict()
+    return tilenames_per_aoi
+
+
+def process_aoi(args, bbox, workspace, global_raster_path=None,
+                memory_budget_mb=None, geometry=None, profiler=None,
+                tile_arrivals=None):
+    """Run the pipeline for a single AOI.
+
+    Every stage is measured, and unless a ``profiler`` is given, the
+    measurements are written to ``profile-report.json`` and ``.csv`` in the
+    workspace (even if a stage fails).  See ``_run_pipeline`` for the other
+    arguments.
+    """
+    owns_profiler = profiler is None
+    if owns_profiler:
+        profiler = profiling.Profiler(workspace, args.profile_stage)
     try:
-        target_projection_epsg = int(args.target_epsg)
-    except TypeError:
-        centroid = shapely.geometry.box(*bbox).centroid
-        target_projection_epsg = get_utm_zone_epsg_from_point(
-            centroid.y, centroid.x)
+        _run_pipeline(args, bbox, workspace, global_raster_path,
+                      memory_budget_mb, geometry, profiler, tile_arrivals)
+    finally:
+        if owns_profiler:
+            profiler.write_report()
+
+
+def _run_pipeline(args, bbox, workspace, global_raster_path=None,
+                  memory_budget_mb=None, geometry=None, profiler=None,
+                  tile_arrivals=None):
+    """Run the pipeline for a single AOI.
+
+    Any tiles that the AOI needs must already be in the tile cache (see
+    ``fetch_tiles``), unless ``tile_arrivals`` is given.
+
+    Args:
+        args: the parsed command-line arguments.
+        bbox: the AOI's [minx, miny, maxx, maxy] lat/lon bounding box.
+        workspace: the directory to write the AOI's outputs to.
+        global_raster_path: the global raster to read from, or None to
+            mosaic tiles from the tile cache.
+        memory_budget_mb: if provided, the GDAL block cache and warp buffers
+            are sized to fit in this many MB.
+        geometry: the AOI's lat/lon shapely geometry, if known.  Only the
+            tiles and pixels within the (buffered) geometry are used.
+        profiler: the ``profiling.Profiler`` that measures each stage.
+        tile_arrivals: a ``queue.Queue`` of the names of tiles as they
+            arrive in the tile cache, followed by None, if the tiles are
+            still being fetched.  The tiles are then warped as they arrive
+            (see ``streamwarp``) rather than mosaicked first.  The AOI must
+            not cross the antimeridian.
+
+    Returns:
+        ``None``
+    """
+    if profiler is None:
+        profiler = profiling.Profiler()
+    product = args.product.lower()
+    use_global_raster = global_raster_path is not None
+    warp_memory_mb = args.warp_memory_mb
+    if memory_budget_mb is not None:
+        # Half for GDAL's block cache (used by every stage), a quarter for
+        # the warp's buffers and the rest for pygeoprocessing's routing.
+        gdal.SetCacheMax(int(memory_budget_mb / 2 * 2**20))
+        warp_memory_mb = max(min(warp_memory_mb, memory_budget_mb // 4), 1)
+
+    if args.target_epsg is not None:
+        projection_name, target_projection_wkt = aoi.projection_from_epsg(
+            args.target_epsg)
+    else:
+        # Usually the AOI's UTM zone, or a polar or equal-area projection for
+        # AOIs that UTM can't represent well.
+        projection_name, target_projection_wkt = aoi.target_projection(bbox)
+    LOGGER.info(f"Processing the AOI in {projection_name}")
 
     try:
         min_tfa, max_tfa, tfa_step = [
@@ -211,77 +1241,206 @@ def main():
         # Effectively skips TFA calculations
         min_tfa, max_tfa, tfa_step = (0, 0, 1)
 
-    cache_dir = args.tile_cache_dir
-    if cache_dir is None:
-        cache_dir = os.path.join(args.workspace, 'tile-cache')
+    # The buffer gives routing room to account for flow from just outside
+    # of the AOI.
+    source_bbox = aoi.buffer_bbox(bbox, args.aoi_buffer)
+    # An AOI that crosses the antimeridian is read from each side separately.
+    source_parts = aoi.split_bbox(source_bbox)
+    aoi_geometry = None
+    if geometry is not None:
+        aoi_geometry = source_geometry(
+            geometry, args.aoi_buffer, args.simplify_tolerance)
+    tile_data_file = product_data_file(product)
+    try:
+        product_coverage = coverage.load_coverage(tile_data_file)
+    except OSError:
+        LOGGER.warning(f"No tile data for {product}; every block of the AOI "
+                       "will be processed")
+        product_coverage = None
+    else:
+        coverage_fraction = product_coverage.fraction(source_bbox)
+        if not coverage_fraction:
+            raise ValueError(f"There is no {product} data within {bbox}")
+        LOGGER.info(f"About {coverage_fraction:.0%} of the AOI has "
+                    f"{product} data")
 
-    product = args.product.lower()
-    if product == 'srtm' and any(
-            [args.username is None, args.password is None]):
-        parser.error(
-            'For SRTM, your NASA EarthData Username and Password are '
-            'required.  Provide them with --username and --password.\n')
+    if use_global_raster:
+        LOGGER.info(f"Reading the AOI from the global raster "
+                    f"{global_raster_path}")
+    else:
+        tile_cache = tilecache.TileCache(
+            os.path.join(args.tile_cache_dir, product),
+            args.checksum_algorithm, args.cache_shard_length)
+        with profiler.stage('tile_lookup') as counts:
+            tile_paths_per_part = [
+                [tile_cache.tile_path(tilename) for tilename in
+                 intersecting_tiles(part, tile_data_file, aoi_geometry)]
+                for part in source_parts]
+            counts['tiles'] = sum(
+                len(tile_paths) for tile_paths in tile_paths_per_part)
+        # Keep every tile of the mosaics open between block reads, if the
+        # open file limit allows.
+        zippedtiles.configure_dataset_pool(counts['tiles'])
 
-    tile_data_file = os.path.join(
-        os.path.dirname(__file__), 'data', f'{product}.json')
-    files_to_download = []
-    tiles_needed = 0
-    tile_cache_dir = os.path.join(cache_dir, product)
-    if not os.path.exists(tile_cache_dir):
-        os.makedirs(tile_cache_dir)
-
-    for tilename in intersecting_tiles(bbox, tile_data_file):
-        tiles_needed += 1
-        cached_tile_file = os.path.join(tile_cache_dir, tilename)
-        files_to_download.append(cached_tile_file)
-
-    with requests.Session() as session:
-        if product == 'srtm':
-            session.auth = (args.username, args.password)
-
-        for filename in tqdm(files_to_download):
-            # TODO: md5sum checking
-            if not os.path.exists(cached_tile_file):
-                LOGGER.info(f"File not found: {cached_tile_file}")
-                download(
-                    f'{DOWNLOAD_BASE_URLS[product]}/{os.path.basename(filename)}',
-                    filename, session=session)
-
-    workspace = args.workspace
     if not os.path.exists(workspace):
         os.makedirs(workspace)
 
-    LOGGER.info(f"Building VRT from {len(files_to_download)} tiles")
-    vrt_path = os.path.join(workspace, f'0_{product}_mosaic.vrt')
-    gdal.BuildVRT(vrt_path, files_to_download)
+    cutline_path = None
+    if aoi_geometry is not None:
+        # Pixels outside of the AOI's geometry are masked out when warping,
+        # so routing only works on the pixels that matter.
+        cutline_path = os.path.join(workspace, 'aoi_cutline.geojson')
+        write_cutline(aoi_geometry, cutline_path)
+
+    # Each stage is skipped if it already ran with the same inputs and
+    # parameters, so re-running with e.g. a new TFA range only re-extracts
+    # the streams.
+    stage_cache = stagecache.StageCache(
+        workspace, enabled=not args.no_stage_cache, profiler=profiler)
+
+    target_pixel_size = PRODUCT_TARGET_RESOLUTION_M[product]
+    warp_source_paths = []
+    source_keys = []
+    if use_global_raster:
+        global_key = stagecache.stage_key('0_global', params={
+            'path': os.path.abspath(global_raster_path),
+            'signature': stagecache.file_signature(global_raster_path),
+        })
+    if tile_arrivals is not None:
+        # The tiles are warped into the target grid as they arrive, so
+        # there's no mosaic to build.
+        tile_paths = {
+            os.path.basename(path): path for path in tile_paths_per_part[0]}
+    else:
+        for part_index, part in enumerate(source_parts):
+            if len(source_parts) == 1:
+                mosaic_name = '0_mosaic'
+                mosaic_path = os.path.join(workspace, f'0_{product}_mosaic.vrt')
+            else:
+                mosaic_name = f'0_mosaic_{part_index}'
+                mosaic_path = os.path.join(
+                    workspace, f'0_{product}_mosaic_{part_index}.vrt')
+
+            if use_global_raster:
+                if len(source_parts) == 1:
+                    # The global raster is read directly, so there's no mosaic
+                    # to build.
+                    warp_source_paths.append(global_raster_path)
+                    source_keys.append(global_key)
+                    continue
+                # Each side of the antimeridian gets its own window of the
+                # global raster, so the warp never reads the whole width of it.
+                source_paths = [global_raster_path]
+                input_keys = [global_key]
+                gdal_source_paths = source_paths
+            else:
+                source_paths = tile_paths_per_part[part_index]
+                input_keys = []
+                # Zipped tiles are read in place rather than extracted.
+                gdal_source_paths = zippedtiles.gdal_paths(
+                    source_paths, tile_data_file)
+                LOGGER.info(f"Building VRT from {len(source_paths)} tiles")
+
+            # Clipping the VRT to the buffered AOI means that only the windows
+            # of the edge tiles that we need are ever read.
+            warp_source_paths.append(mosaic_path)
+            source_keys.append(stage_cache.run(stagecache.Stage(
+                mosaic_name, gdal.BuildVRT,
+                args=(mosaic_path, gdal_source_paths),
+                kwargs={'outputBounds': part}, outputs=[mosaic_path],
+                params={
+                    'tiles': [[os.path.basename(path), os.path.getsize(path)]
+                              for path in source_paths],
+                    'bbox': part,
+                }, inputs=input_keys)))
+            profiler.annotate(mosaic_name, tiles=len(source_paths))
+
+    # --overview-level is parsed by _overview_level, so it is 'auto', None or
+    # an overview index.
+    overview_level = args.overview_level
+    if overview_level == 'auto' and tile_arrivals is not None:
+        # The tiles can't be inspected before they arrive, and single tiles
+        # rarely have overviews.
+        overview_level = None
+    elif overview_level == 'auto':
+        overview_level = select_overview_level(
+            warp_source_paths[0], target_pixel_size, target_projection_wkt,
+            source_parts[0])
 
-    LOGGER.info("Reprojecting VRT to the local projection")
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(target_projection_epsg)
+    LOGGER.info("Reprojecting to the local projection")
     warped_raster = os.path.join(
-        workspace, f'1_{product}_cropped_EPSG{target_projection_epsg}.tif')
-    pygeoprocessing.warp_raster(
-        base_raster_path=vrt_path,
-        target_pixel_size=PRODUCT_TARGET_RESOLUTION_M[product],
-        target_raster_path=warped_raster,
-        resample_method='bilinear',
-        target_projection_wkt=srs.ExportToWkt()
-    )
+        workspace, f'1_{product}_cropped_{projection_name}.tif')
+    warp_kwargs = {
+        'base_raster_path': warp_source_paths,
+        'target_raster_path': warped_raster,
+        'target_pixel_size': target_pixel_size,
+        'target_projection_wkt': target_projection_wkt,
+        'aoi_bbox': source_bbox,
+        'resample_method': 'bilinear',
+        'n_threads': args.n_threads,
+        'warp_memory_mb': warp_memory_mb,
+        'overview_level': overview_level,
+        'cutline_path': cutline_path,
+    }
+    warp_params = {
+        'cutline': None if aoi_geometry is None else aoi_geometry.wkt,
+        **{key: warp_kwargs[key] for key in (
+            'target_pixel_size', 'target_projection_wkt', 'aoi_bbox',
+            'resample_method', 'overview_level')}}
+    if tile_arrivals is None:
+        warp_key = stage_cache.run(stagecache.Stage(
+            '1_warp', warp_to_aoi, kwargs=warp_kwargs,
+            outputs=[warped_raster], params=warp_params, inputs=source_keys))
+    else:
+        # The tiles are identified by name alone, since they may not have
+        # arrived yet.  Every tile is verified before it is used.
+        warp_key = stage_cache.run(stagecache.Stage(
+            '1_warp', streamwarp.warp_as_tiles_arrive,
+            args=(tile_arrivals, tile_paths, warped_raster, target_pixel_size,
+                  target_projection_wkt, source_bbox, tile_data_file,
+                  DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS),
+            kwargs={
+                'resample_method': warp_kwargs['resample_method'],
+                'n_workers': args.n_threads,
+                'warp_memory_mb': warp_memory_mb,
+                'overview_level': overview_level,
+                'cutline_path': cutline_path,
+            },
+            outputs=[warped_raster],
+            params={**warp_params, 'tiles': sorted(tile_paths)}))
+        profiler.annotate('1_warp', tiles=len(tile_paths))
 
     LOGGER.info("Filling sinks")
     filled_sinks_path = os.path.join(
         workspace, f'2_{product}_pitfilled.tif')
-    pygeoprocessing.routing.fill_pits(
-        dem_raster_path_band=(warped_raster, 1),
-        target_filled_dem_raster_path=filled_sinks_path,
-        working_dir=workspace
-    )
+    fill_key = stage_cache.run(stagecache.Stage(
+        '2_fill_pits', pygeoprocessing.routing.fill_pits,
+        kwargs={
+            'dem_raster_path_band': (warped_raster, 1),
+            'target_filled_dem_raster_path': filled_sinks_path,
+            'working_dir': workspace,
+            'raster_driver_creation_tuple':
+                DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
+        },
+        outputs=[filled_sinks_path], inputs=[warp_key]))
+
+    # Every raster from here on shares the warped raster's grid and blocks,
+    # so blocks with no source data can be skipped by the stages that work
+    # block by block.  The pygeoprocessing routing stages can't skip blocks,
+    # but with SPARSE_OK they don't write the empty ones.
+    block_coverage = None
+    if product_coverage is not None:
+        with profiler.stage('block_coverage'):
+            block_coverage = product_coverage.block_coverage(warped_raster)
+        LOGGER.info(f"{block_coverage.fraction:.0%} of the warped raster's "
+                    "blocks may contain data")
 
     routing_method = args.routing_algorithm.lower()
     flow_dir_kwargs = {
         'dem_raster_path_band': (filled_sinks_path, 1),
         'target_flow_dir_path': os.path.join(
-            workspace, f'3_{product}_{routing_method}_flow_dir.tif')
+            workspace, f'3_{product}_{routing_method}_flow_dir.tif'),
+        'raster_driver_creation_tuple': DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
     }
 
     # D8 and MFD flow accumulation functions have slightly different function
@@ -292,15 +1451,39 @@ def main():
         (flow_dir_kwargs['target_flow_dir_path'], 1), flow_accum_path]
 
     if routing_method == 'd8':
-        LOGGER.info("D8 flow direction")
-        pygeoprocessing.routing.flow_dir_d8(**flow_dir_kwargs)
-        LOGGER.info("D8 flow accumulation")
-        pygeoprocessing.routing.flow_accumulation_d8(*flow_accum_args)
+        flow_dir_func = pygeoprocessing.routing.flow_dir_d8
+        flow_accum_func = pygeoprocessing.routing.flow_accumulation_d8
     else:
-        LOGGER.info("MFD flow direction")
-        pygeoprocessing.routing.flow_dir_mfd(**flow_dir_kwargs)
-        LOGGER.info("MFD flow accumulation")
-        pygeoprocessing.routing.flow_accumulation_mfd(*flow_accum_args)
+        flow_dir_func = pygeoprocessing.routing.flow_dir_mfd
+        flow_accum_func = pygeoprocessing.routing.flow_accumulation_mfd
+
+    LOGGER.info(f"{routing_method.upper()} flow direction")
+    flow_dir_key = stage_cache.run(stagecache.Stage(
+        f'3_{routing_method}_flow_dir', flow_dir_func,
+        kwargs=flow_dir_kwargs,
+        outputs=[flow_dir_kwargs['target_flow_dir_path']],
+        inputs=[fill_key]))
+    flow_accum_kwargs = {
+        'raster_driver_creation_tuple': DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
+    }
+    if args.tiled_routing:
+        if routing_method == 'd8':
+            flow_accum_func = tiledrouting.flow_accumulation_d8_tiled
+            flow_accum_kwargs = {
+                'tile_size': args.routing_tile_size,
+                'n_workers': args.n_threads,
+                'working_dir': workspace,
+                'block_coverage': block_coverage,
+            }
+        else:
+            LOGGER.warning("Tiled routing is only available for D8; "
+                           "accumulating MFD flow over the whole raster")
+
+    LOGGER.info(f"{routing_method.upper()} flow accumulation")
+    flow_accum_key = stage_cache.run(stagecache.Stage(
+        f'4_{routing_method}_flow_accumulation', flow_accum_func,
+        args=flow_accum_args, kwargs=flow_accum_kwargs,
+        outputs=[flow_accum_path], inputs=[flow_dir_key]))
 
     if not args.tfa_range:
         LOGGER.info("No TFA range specified; skipping TFA")
@@ -310,24 +1493,385 @@ def main():
         if not os.path.exists(streams_dir):
             os.makedirs(streams_dir)
 
-        for tfa in range(min_tfa, max_tfa+1, tfa_step):
-            LOGGER.info(f"Extracting streams with TFA {tfa}")
-            streams_raster_path = os.path.join(
-                streams_dir, f'tfa{tfa}_{routing_method}_streams.tif')
-            if routing_method == 'd8':
-                _extract_streams_d8(
-                    flow_accum_path=flow_accum_path,
-                    tfa=tfa,
-                    target_streams_path=streams_raster_path)
+        tfa_list = list(range(min_tfa, max_tfa+1, tfa_step))
+        streams_raster_paths = [
+            os.path.join(streams_dir, f'tfa{tfa}_{routing_method}_streams.tif')
+            for tfa in tfa_list]
+        if routing_method == 'd8':
+            # All thresholds are extracted with one read of the flow
+            # accumulation raster.
+            LOGGER.info(f"Extracting streams with {len(tfa_list)} TFAs from "
+                        f"{min_tfa} to {max_tfa}")
+            if args.compact_streams:
+                # Only write the single raster that all of the stream layers
+                # can be derived from.
+                max_tfa_path = os.path.join(
+                    streams_dir, f'max_tfa_{routing_method}_streams.tif')
+                streams_kwargs = {'target_max_tfa_path': max_tfa_path}
+                streams_outputs = [max_tfa_path]
             else:
-                pygeoprocessing.routing.extract_streams_mfd(
-                    flow_accum_raster_path_band=(flow_accum_path, 1),
-                    flow_dir_mfd_path_band=(
-                        flow_dir_kwargs['target_flow_dir_path'], 1),
-                    flow_threshold=tfa,
-                    target_stream_raster_path=streams_raster_path)
+                streams_kwargs = {
+                    'target_streams_paths': streams_raster_paths}
+                streams_outputs = streams_raster_paths
+            streams_kwargs['block_coverage'] = block_coverage
+            stage_cache.run(stagecache.Stage(
+                '5_d8_streams', _extract_streams_d8_multi,
+                args=(flow_accum_path, tfa_list), kwargs=streams_kwargs,
+                outputs=streams_outputs,
+                params={'tfa_list': tfa_list,
+                        'compact': args.compact_streams},
+                inputs=[flow_accum_key]))
+        else:
+            # MFD stream extraction also depends on the flow direction, so
+            # each threshold is extracted by pygeoprocessing separately, with
+            # the thresholds run in parallel.
+            LOGGER.info(f"Extracting streams with {len(tfa_list)} TFAs from "
+                        f"{min_tfa} to {max_tfa}")
+            stage_cache.run_parallel([
+                stagecache.Stage(
+                    f'5_mfd_streams_tfa{tfa}', _extract_streams_mfd,
+                    args=(flow_accum_path,
+                          flow_dir_kwargs['target_flow_dir_path'], tfa,
+                          streams_raster_path),
+                    outputs=[streams_raster_path],
+                    params={'tfa': tfa},
+                    inputs=[flow_accum_key, flow_dir_key])
+                for tfa, streams_raster_path in zip(
+                    tfa_list, streams_raster_paths)],
+                n_workers=args.n_threads)
     LOGGER.info("Complete!")
 
 
+def _overview_level(value):
+    # The argparse type of --overview-level: 'auto', None for 'none', or a
+    # non-negative overview index.  GDAL reads the coarsest overview when the
+    # index is past the last one.
+    value = value.lower()
+    if value in ('auto', 'none'):
+        return None if value == 'none' else value
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+    if level < 0:
+        raise argparse.ArgumentTypeError(
+            f'must be "auto", "none" or a non-negative integer, not '
+            f'"{value}"')
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workspace', default=os.getcwd())
+    parser.add_argument('--tile-cache-dir')
+    parser.add_argument(
+        '--source', choices=['auto', 'tiles', 'global'], default='auto',
+        help=('Where to read the DEM from.  "global" reads the AOI directly '
+              'from the prebuilt global raster (<product>-<resolution>-'
+              '<subproduct>-global.tif in the tile cache, or '
+              '--global-raster), skipping tile downloads entirely. "tiles" '
+              'mosaics individual tiles.  "auto" (the default) uses the '
+              'global raster if one is found.'))
+    parser.add_argument(
+        '--global-raster',
+        help='The path to a global raster of the product to read from.')
+    parser.add_argument(
+        '--checksum-algorithm', default='sha256',
+        choices=['md5', 'sha256'],
+        help=('The algorithm of the tile cache\'s checksum file, '
+              'tiles-checksum-<algorithm>.txt.'))
+    parser.add_argument(
+        '--cache-shard-length', type=int,
+        help=('Shard the tile cache into subdirectories named for this many '
+              'leading characters of each tile, e.g. 4 for SRTM, which '
+              'suits parallel filesystems like Lustre.  0 is a flat '
+              'directory.  Defaults to the existing cache\'s layout, or '
+              'flat for a new cache.  Use tilecache.py to migrate a '
+              'cache.'))
+    parser.add_argument(
+        '--cache-max-size-gb', type=float,
+        help=('After fetching tiles, remove the least recently used tiles '
+              'from the product\'s tile cache until it is at most this '
+              'size.  Tiles in use by any job sharing the cache are never '
+              'removed.'))
+    parser.add_argument(
+        '--mirror', action='append', default=[], help=(
+            'The base URL of a mirror of the product\'s tiles, tried before '
+            'the product\'s own server.  A download that fails or stalls on '
+            'one mirror is retried on the next.  May be given more than '
+            'once.'))
+    parser.add_argument(
+        '--stream-warp', action='store_true', help=(
+            'Warp the tiles into the target grid, chunk by chunk, while the '
+            'remaining tiles are still downloading, rather than after every '
+            'tile has been downloaded.  Only used for a single AOI that '
+            'doesn\'t cross the antimeridian and is read from tiles.  Reads '
+            'full-resolution pixels unless --overview-level is a number.'))
+
+    # Auto-detect target projection from closest UTM zone if no projection
+    # provided.
+    parser.add_argument('--target-epsg')
+
+    parser.add_argument(
+        '--tfa-range', help=(
+            'The min, max and step size of threshold flow accumulation values '
+            'to create in the form MIN:MAX:STEP.  Example: 500::10000::200'))
+
+    parser.add_argument(
+        '--routing-algorithm', choices=KNOWN_ROUTING_ALGOS,
+        help='Routing algorithm to use.')
+
+    parser.add_argument(
+        '--aoi-buffer', type=float, default=DEFAULT_AOI_BUFFER_DEGREES,
+        help=('Degrees to buffer the AOI by before selecting tiles and '
+              'warping, so routing accounts for flow from just outside of '
+              'the AOI.'))
+    parser.add_argument(
+        '--n-threads', type=int,
+        help='The number of threads to warp with.  Defaults to every CPU.')
+    parser.add_argument(
+        '--warp-memory-mb', type=int, default=DEFAULT_WARP_MEMORY_MB,
+        help='The memory limit, in MB, for the warp\'s working buffers.')
+
+    parser.add_argument(
+        '--no-stage-cache', action='store_true',
+        help=('Recompute every stage, even those whose inputs and '
+              'parameters are unchanged since the last run.'))
+    parser.add_argument(
+        '--profile-stage', metavar='PATTERN',
+        help=('Run the stages whose names match this pattern (e.g. 1_warp '
+              'or "5_*") under cProfile, writing profile-<stage>.prof to '
+              'the workspace.'))
+
+    parser.add_argument(
+        '--overview-level', default='auto', type=_overview_level,
+        help=('The source overview level to warp from: "auto" (the '
+              'default) picks the coarsest internal or external (.ovr) '
+              'overview that still meets the target pixel size, "none" '
+              'always reads full-resolution pixels, or an overview index.'))
+
+    parser.add_argument(
+        '--download-workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+        help='The maximum number of tiles to download concurrently.')
+
+    parser.add_argument(
+        '--tiled-routing', action='store_true', help=(
+            'D8 only. Accumulate flow in tiles across a process pool and '
+            'stitch the tiles together.  The result is the same, but very '
+            'large AOIs can use every core with bounded memory per worker.'))
+    parser.add_argument(
+        '--routing-tile-size', type=int,
+        default=tiledrouting.DEFAULT_TILE_SIZE,
+        help='The width and height, in pixels, of tiles for --tiled-routing.')
+
+    parser.add_argument(
+        '--compact-streams', action='store_true', help=(
+            'D8 only. Instead of one streams raster per TFA, write a single '
+            'raster of the largest TFA in the range at which each pixel is '
+            'a stream.  The streams for a TFA in the range are the pixels '
+            'greater than or equal to that TFA.'))
+
+    parser.add_argument(
+        '--each-feature', action='store_true', help=(
+            'Process every feature of a vector boundary as its own AOI.'))
+    parser.add_argument(
+        '--simplify-tolerance', type=float, default=0, help=(
+            'Degrees to simplify vector AOI geometries by before selecting '
+            'tiles and masking.  The simplified geometry is buffered so '
+            'that it still contains the whole AOI.'))
+    parser.add_argument(
+        '--aoi-workers', type=int, default=1,
+        help='The number of AOIs to process at once in batch mode.')
+    parser.add_argument(
+        '--memory-budget-mb', type=float, help=(
+            'The memory, in MB, to divide between the AOIs being processed '
+            'at once.  Limits --aoi-workers if needed.'))
+
+    parser.add_argument(
+        '--username', help=('The username to log in with. Required for SRTM'))
+    parser.add_argument(
+        '--password', help=('The password to log in with.  Required for SRTM'))
+
+    parser.add_argument(
+        'product', metavar='product', choices=KNOWN_PRODUCTS.keys(),
+        help='The DEM product to use')
+
+    # TODO: add a resolution for the product (e.g. SRTM 1s vs SRTM 3s)
+    # TODO: Add a sub-product, e.g. GMTED minimum vs std deviation
+
+    # TODO: support searching by an admin region (countries, states)
+    parser.add_argument(
+        'boundary', nargs='+', help=(
+            'The boundary to use. A path to a vector AOI or a lat/lon '
+            'bounding box in the order "BBOX::minx::miny::maxx::maxy".  '
+            'If several boundaries are given, each is processed in its own '
+            'subdirectory of the workspace.'))
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if (args.compact_streams and
+            str(args.routing_algorithm).upper() != 'D8'):
+        parser.error('--compact-streams is only supported for D8 routing.')
+
+    try:
+        aois = resolve_aois(args.boundary, args.each_feature)
+    except ValueError as error:
+        parser.error(str(error))
+    if not aois:
+        parser.error('No AOIs found in the given boundaries.')
+
+    if args.tile_cache_dir is None:
+        args.tile_cache_dir = os.path.join(args.workspace, 'tile-cache')
+    cache_dir = args.tile_cache_dir
+
+    product = args.product.lower()
+    global_raster_path = args.global_raster
+    if global_raster_path is None and args.source != 'tiles':
+        global_raster_path = find_global_raster(cache_dir, args.product)
+    if args.source == 'global' and global_raster_path is None:
+        parser.error(
+            f'No global {args.product} raster found in {cache_dir}.  Provide '
+            'one with --global-raster or use --source=tiles.')
+    if args.source == 'tiles':
+        global_raster_path = None
+    use_global_raster = global_raster_path is not None
+    max_size_bytes = None
+    if args.cache_max_size_gb is not None:
+        max_size_bytes = int(args.cache_max_size_gb * 2**30)
+    if not use_global_raster:
+        try:
+            tile_cache = tilecache.TileCache(
+                os.path.join(cache_dir, product), args.checksum_algorithm,
+                args.cache_shard_length, max_size_bytes)
+        except ValueError as error:
+            parser.error(str(error))
+
+    if not use_global_raster and product == 'srtm' and any(
+            [args.username is None, args.password is None]):
+        parser.error(
+            'For SRTM, your NASA EarthData Username and Password are '
+            'required.  Provide them with --username and --password.\n')
+
+    stream_warp = False
+    if args.stream_warp:
+        stream_warp = (
+            not use_global_raster and len(aois) == 1 and
+            not aoi.crosses_antimeridian(
+                aoi.buffer_bbox(aois[0][1], args.aoi_buffer)))
+        if not stream_warp:
+            LOGGER.warning("--stream-warp only applies to a single AOI that "
+                           "doesn't cross the antimeridian and is read from "
+                           "tiles; warping after the tiles are fetched")
+
+    # The shared stages (and, for a single AOI, every stage) are reported
+    # in the top-level workspace.  In a batch, each AOI's subdirectory has
+    # its own report.
+    profiler = profiling.Profiler(args.workspace, args.profile_stage)
+    fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    fetched = None
+    tile_arrivals = None
+    try:
+        if not use_global_raster:
+            # Every AOI's tiles are fetched up front so that tiles shared
+            # between AOIs are only downloaded once.
+            auth = None
+            if product == 'srtm':
+                auth = (args.username, args.password)
+            fetch_args = (
+                product, [
+                    (aoi.buffer_bbox(bbox, args.aoi_buffer),
+                     None if geometry is None else source_geometry(
+                         geometry, args.aoi_buffer, args.simplify_tolerance))
+                    for _, bbox, geometry in aois],
+                tile_cache, auth, args.download_workers, profiler,
+                args.mirror)
+            if stream_warp:
+                # The tiles are fetched in the background and warped as
+                # they arrive.
+                tile_arrivals = queue.Queue()
+                fetched = fetch_executor.submit(
+                    _fetch_tiles_into_queue, tile_arrivals, *fetch_args)
+            else:
+                fetch_tiles(*fetch_args)
+
+        if len(aois) == 1:
+            _, bbox, geometry = aois[0]
+            try:
+                process_aoi(args, bbox, args.workspace, global_raster_path,
+                            args.memory_budget_mb, geometry, profiler,
+                            tile_arrivals)
+            finally:
+                if fetched is not None:
+                    # A failed download is reported rather than the warp's
+                    # failure to find the tile.
+                    fetched.result()
+        else:
+            run_batch(args, aois, global_raster_path)
+    finally:
+        fetch_executor.shutdown()
+        if not use_global_raster:
+            # Other jobs may evict the tiles once we're done with them.
+            tile_cache.release()
+        profiler.write_report()
+
+
+def _fetch_tiles_into_queue(tile_arrivals, *fetch_args):
+    # Fetch tiles (see fetch_tiles), putting the name of each tile in the
+    # queue once it's in the cache, and then None once no more will come.
+    try:
+        return fetch_tiles(*fetch_args, on_tile=tile_arrivals.put)
+    finally:
+        tile_arrivals.put(None)
+
+
+def run_batch(args, aois, global_raster_path=None):
+    """Run the pipeline for many AOIs in a process pool.
+
+    Each AOI is processed in its own subdirectory of ``args.workspace``.  The
+    CPUs and ``args.memory_budget_mb`` are divided evenly between the AOIs
+    that run at once.
+
+    Raises:
+        RuntimeError: if any AOI fails.  The other AOIs are still completed.
+    """
+    n_workers = max(min(args.aoi_workers, len(aois)), 1)
+    memory_budget_mb = args.memory_budget_mb
+    if memory_budget_mb is not None:
+        max_workers = max(int(memory_budget_mb // MIN_AOI_MEMORY_MB), 1)
+        if n_workers > max_workers:
+            LOGGER.warning(
+                f"A memory budget of {memory_budget_mb} MB only allows "
+                f"{max_workers} concurrent AOIs")
+            n_workers = max_workers
+        memory_budget_mb /= n_workers
+    if args.n_threads is None:
+        args.n_threads = max((os.cpu_count() or 1) // n_workers, 1)
+    LOGGER.info(f"Processing {len(aois)} AOIs, {n_workers} at a time")
+
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                process_aoi, args, bbox, os.path.join(args.workspace, name),
+                global_raster_path, memory_budget_mb, geometry): name
+            for name, bbox, geometry in aois}
+        for n_done, future in enumerate(
+                concurrent.futures.as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception:
+                LOGGER.exception(f"AOI {name} failed")
+                failures.append(name)
+            else:
+                LOGGER.info(f"({n_done}/{len(aois)}) AOI {name} complete")
+
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {len(aois)} AOIs failed: "
+            f"{', '.join(sorted(failures))}")
+
+
 if __name__ == '__main__':
     main()
@@ -15,9 +15,16 @@
 set -e
 set -x
 
+# The GMTED2010 tiles are on a regular grid, so catalogbuilder.py derives
+# their extents from their names instead of opening each one over /vsicurl/.
+
 CONTAINER=ghcr.io/natcap/devstack
 DIGEST=sha256:54066e72aa135deb8e2f60fda2f42f1856912e36967446659ad754b4b64d7efa
 singularity run \
     --env GDAL_CACHEMAX=1024 \
     docker://$CONTAINER@$DIGEST \
-    python build-product-json.py gmted2010-urls.txt
+    python ../catalogbuilder.py \
+        --urls gmted2010-urls.txt \
+        --workers "${SLURM_CPUS_PER_TASK:-2}" \
+        --write-json gmted2010.json \
+        gmted2010-catalog.npy
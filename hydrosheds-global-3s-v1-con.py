@@ -1,17 +1,17 @@
-import hashlib
 import logging
-import math
 import os
 import sys
 import threading
 import time
 import zipfile
 
-import pygeoprocessing
-import pygeoprocessing.multiprocessing
 import requests
 from osgeo import gdal
 
+import checksums
+import overviews
+import translate
+
 logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger(__name__)
 DOWNLOAD_PREFIX = 'https://data.hydrosheds.org/file/hydrosheds-v1-con'
@@ -24,59 +24,13 @@ FILE_TO_MD5SUM = {
     "sa_con_3s.zip": "9d8624d79fe80f547578be6a9e932b8f",
 }
 DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
-    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'NUM_THREADS=4',
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW',
     'BLOCKXSIZE=256', 'BLOCKYSIZE=256'))
 
 
-def build_overviews(raster_path, internal=False,
-                    resampling_method=gdal.GRA_NearestNeighbour):
-    open_flags = gdal.OF_RASTER
-    if internal:
-        open_flags |= gdal.GA_Update
-        LOGGER.info(f"Building internal overviews on {raster_path}")
-    else:
-        LOGGER.info("Building external overviews.")
-    raster = gdal.OpenEx(raster_path, open_flags)
-    n_pixels_x = raster.RasterXSize
-    n_pixels_y = raster.RasterYSize
-
-    # This loop and limiting factor borrowed from gdaladdo.cpp
-    overview_scales = []
-    factor = 2
-    limiting_factor = 256
-    while (math.ceil(n_pixels_x / factor) > limiting_factor or
-           math.ceil(n_pixels_y / factor) > limiting_factor):
-        overview_scales.append(factor)
-        factor *= 2
-
-    def overviews_progress(*args, **kwargs):
-        pct_complete, name, other = args
-        percent = round(pct_complete * 100, 2)
-        if time.time() - overviews_progress.last_progress_report > 5.0:
-            LOGGER.info(f"Overviews progress: {percent}%")
-            overviews_progress.last_progress_report = time.time()
-    overviews_progress.last_progress_report = time.time()
-
-    LOGGER.debug(f"Using overviews {overview_scales}")
-    result = raster.BuildOverviews('NEAREST', overviewlist=overview_scales,
-                                   callback=overviews_progress)
-    LOGGER.info(f"Overviews completed for {raster_path}")
-    if result:  # Result will be nonzero on error.
-        raise RuntimeError(
-            f"Building overviews failed or was interrupted for {raster_path}")
-
-
 def verify_checksum(filepath, checksum):
     LOGGER.info(f"Checksumming (md5) {filepath}")
-    h = hashlib.md5()
-    with open(filepath, "rb") as f:
-        while True:
-            data = f.read(1024)
-            if not data:
-                break
-            h.update(data)
-
-    digest = h.hexdigest()
+    digest = checksums.file_digest(filepath, 'md5')
     if digest != checksum:
         raise AssertionError(f"Checksum failed for file {filepath}")
     LOGGER.info(f"Checksum (md5) verified on {filepath}")
@@ -133,10 +87,6 @@ def thread_worker(source_url, target_zipfile, target_raster, failed):
         failed.set()
 
 
-def _identity(matrix):
-    return matrix
-
-
 def main(workspace):
     if not os.path.isdir(workspace):
         os.makedirs(workspace)
@@ -171,24 +121,23 @@ def main(workspace):
 
     LOGGER.info("Building a VRT of component rasters for translation")
     gdal.BuildVRT(vrt_path, component_rasters)
-    vrt_raster_info = pygeoprocessing.get_raster_info(vrt_path)
 
     target_gtiff_path = os.path.join(
+        workspace, 'hydrosheds-global-3s-v1-conditioned-base.tif')
+    target_cog_path = os.path.join(
         workspace, 'hydrosheds-global-3s-v1-conditioned.tif')
     LOGGER.info(f"Translating VRT to a single file --> {target_gtiff_path}")
-    raster_calculator_kwargs = {
-        'base_raster_path_band_const_list': [(vrt_path, 1)],
-        'local_op': _identity,
-        'target_raster_path': target_gtiff_path,
-        'datatype_target': vrt_raster_info['datatype'],
-        'nodata_target': vrt_raster_info['nodata'][0],
-        'raster_driver_creation_tuple': DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
-        'largest_block': 2**18,  # 4x the size of default pgp blocksize
-    }
-    pygeoprocessing.raster_calculator(**raster_calculator_kwargs)
-    build_overviews(target_gtiff_path, internal=True)
-
-    LOGGER.info(f"Global HydroSHEDS raster assembled at {target_gtiff_path}")
+    translate.translate_raster(
+        vrt_path, target_gtiff_path, DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS)
+    # The overviews are built externally and then copied along with the
+    # raster into the COG layout, where they come before the full-resolution
+    # pixels.  The base raster and its overviews are then removed.
+    overviews.build_overviews(
+        target_gtiff_path, internal=False, resampling_method='average')
+    overviews.write_cog(target_gtiff_path, target_cog_path,
+                        remove_source=True)
+
+    LOGGER.info(f"Global HydroSHEDS raster assembled at {target_cog_path}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+# Build raster overviews block by block across a process pool.
+#
+# GDAL's BuildOverviews computes every level on a single core.  Here, the
+# overview levels are first allocated empty (``BuildOverviews('NONE')``),
+# then each level is computed from the level before it in chunks: worker
+# processes read and downsample a chunk of the previous level, and the main
+# process (the only writer) writes the result into the overview.  Chunks that
+# are entirely nodata are never written, so sparse rasters stay sparse.
+#
+# Overviews can be internal or in an external ``.ovr`` file.  To publish a
+# cloud-optimized GeoTIFF, ``write_cog`` copies the raster and its existing
+# overviews into the COG layout without recomputing them.
+#
+# Usage:
+#     python overviews.py --resampling average --cog global-cog.tif global.tif
+import argparse
+import concurrent.futures
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy
+from osgeo import gdal
+
+LOGGER = logging.getLogger(__name__)
+RESAMPLING_METHODS = ('nearest', 'average', 'mode')
+DEFAULT_N_WORKERS = os.cpu_count() or 1
+# The size (in pixels of the overview being written) of the chunks computed
+# by each worker.
+DEFAULT_CHUNK_SIZE = 1024
+EXTERNAL_OVERVIEW_CONFIG = {
+    'COMPRESS_OVERVIEW': 'LZW',
+    'PREDICTOR_OVERVIEW': '2',
+    'BIGTIFF_OVERVIEW': 'IF_SAFER',
+}
+
+
+def overview_factors(n_pixels_x, n_pixels_y, limiting_factor=256):
+    # This loop and limiting factor borrowed from gdaladdo.cpp
+    overview_scales = []
+    factor = 2
+    while (math.ceil(n_pixels_x / factor) > limiting_factor or
+           math.ceil(n_pixels_y / factor) > limiting_factor):
+        overview_scales.append(factor)
+        factor *= 2
+    return overview_scales
+
+
+def downsample(array, nodata, resampling_method, ratio=2):
+    """Downsample a 2D array by an integer ratio.
+
+    The array is padded with nodata to a multiple of ``ratio`` so that the
+    last row and column of the output cover the partial blocks at the edge.
+    Nodata pixels are ignored by 'average' and 'mode', and blocks with no
+    valid pixels are nodata in the output.
+    """
+    n_rows = math.ceil(array.shape[0] / ratio)
+    n_cols = math.ceil(array.shape[1] / ratio)
+    if resampling_method == 'nearest':
+        # Like GDAL, use the pixel nearest the center of each block, clamped
+        # to the partial blocks at the edge.
+        rows = numpy.minimum(
+            numpy.arange(n_rows) * ratio + ratio // 2, array.shape[0] - 1)
+        cols = numpy.minimum(
+            numpy.arange(n_cols) * ratio + ratio // 2, array.shape[1] - 1)
+        return array[numpy.ix_(rows, cols)]
+
+    padded = _pad(array, n_rows * ratio, n_cols * ratio, nodata)
+    # Shape (n_rows, n_cols, ratio * ratio): the pixels in each block.
+    blocks = padded.reshape(n_rows, ratio, n_cols, ratio).swapaxes(
+        1, 2).reshape(n_rows, n_cols, ratio * ratio)
+    if nodata is None:
+        valid = numpy.ones(blocks.shape, dtype=bool)
+    else:
+        valid = blocks != nodata
+    if numpy.issubdtype(blocks.dtype, numpy.floating):
+        valid &= ~numpy.isnan(blocks)
+    n_valid = valid.sum(axis=2)
+
+    if resampling_method == 'average':
+        sums = numpy.where(valid, blocks, 0).sum(axis=2, dtype=numpy.float64)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            result = sums / n_valid
+        if numpy.issubdtype(array.dtype, numpy.integer):
+            result = numpy.round(result)
+    elif resampling_method == 'mode':
+        # Count how many valid pixels in the block share each pixel's value
+        # and take the most common, preferring the first on ties.
+        counts = numpy.zeros(blocks.shape, dtype=numpy.int32)
+        for index in range(ratio * ratio):
+            counts += (blocks == blocks[..., index:index + 1]) & (
+                valid[..., index:index + 1])
+        counts[~valid] = -1
+        result = numpy.take_along_axis(
+            blocks, counts.argmax(axis=2)[..., numpy.newaxis], axis=2)[..., 0]
+    else:
+        raise ValueError(f"Unknown resampling method {resampling_method}")
+
+    if nodata is not None:
+        result = numpy.where(n_valid > 0, result, nodata)
+    return result.astype(array.dtype)
+
+
+def _pad(array, n_rows, n_cols, nodata):
+    pad_rows = n_rows - array.shape[0]
+    pad_cols = n_cols - array.shape[1]
+    if not pad_rows and not pad_cols:
+        return array
+    padding = ((0, pad_rows), (0, pad_cols))
+    if nodata is None:
+        return numpy.pad(array, padding, mode='edge')
+    return numpy.pad(array, padding, constant_values=nodata)
+
+
+def _open_level(raster_path, level):
+    # Level -1 is the full-resolution raster.  GDAL finds overviews whether
+    # they are internal or in an external .ovr file.
+    open_options = [] if level < 0 else [f'OVERVIEW_LEVEL={level}']
+    return gdal.OpenEx(raster_path, gdal.OF_RASTER,
+                       open_options=open_options)
+
+
+def _downsample_chunk(raster_path, source_level, window, nodata,
+                      resampling_method):
+    xoff, yoff, win_xsize, win_ysize = window
+    raster = _open_level(raster_path, source_level)
+    band = raster.GetRasterBand(1)
+    # Read the pixels of the previous level covered by this chunk.
+    source_xoff = xoff * 2
+    source_yoff = yoff * 2
+    array = band.ReadAsArray(
+        source_xoff, source_yoff,
+        min(win_xsize * 2, band.XSize - source_xoff),
+        min(win_ysize * 2, band.YSize - source_yoff))
+    band = None
+    raster = None
+
+    if nodata is not None and numpy.all(array == nodata):
+        return window, None
+    result = downsample(array, nodata, resampling_method)
+    return window, result[:win_ysize, :win_xsize]
+
+
+def _plan_chunks(n_cols, n_rows, chunk_size):
+    return [
+        (xoff, yoff, min(chunk_size, n_cols - xoff),
+         min(chunk_size, n_rows - yoff))
+        for yoff in range(0, n_rows, chunk_size)
+        for xoff in range(0, n_cols, chunk_size)]
+
+
+def _overview_band(raster_path, level, internal):
+    # Open a single overview level for writing.  An external .ovr file is a
+    # GeoTIFF whose first image is the first level and whose own overviews
+    # are the remaining levels.
+    if internal:
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        return raster, raster.GetRasterBand(1).GetOverview(level)
+    raster = gdal.OpenEx(
+        f'{raster_path}.ovr', gdal.OF_RASTER | gdal.OF_UPDATE)
+    band = raster.GetRasterBand(1)
+    if level == 0:
+        return raster, band
+    return raster, band.GetOverview(level - 1)
+
+
+def build_overviews(raster_path, internal=False, resampling_method='average',
+                    n_workers=DEFAULT_N_WORKERS,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Build power-of-two overviews for band 1 of a raster.
+
+    Args:
+        raster_path: the raster to build overviews for.
+        internal: whether to write the overviews into the raster itself
+            rather than an external ``.ovr`` file.
+        resampling_method: one of 'nearest', 'average' or 'mode'.
+        n_workers: the number of processes used to compute overview chunks.
+        chunk_size: the width and height of the chunks computed by each
+            worker, in overview pixels.
+    """
+    if resampling_method not in RESAMPLING_METHODS:
+        raise ValueError(
+            f"resampling_method must be one of {RESAMPLING_METHODS}, not "
+            f"{resampling_method}")
+
+    open_flags = gdal.OF_RASTER
+    if internal:
+        open_flags |= gdal.OF_UPDATE
+        LOGGER.info(f"Building internal overviews on {raster_path}")
+    else:
+        LOGGER.info(f"Building external overviews for {raster_path}")
+        for key, value in EXTERNAL_OVERVIEW_CONFIG.items():
+            if gdal.GetConfigOption(key) is None:
+                gdal.SetConfigOption(key, value)
+    raster = gdal.OpenEx(raster_path, open_flags)
+    n_pixels_x = raster.RasterXSize
+    n_pixels_y = raster.RasterYSize
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    pixel_size_bytes = gdal.GetDataTypeSize(band.DataType) // 8
+    band = None
+
+    overview_scales = overview_factors(n_pixels_x, n_pixels_y)
+    LOGGER.debug(f"Using overviews {overview_scales}")
+    # Allocate the overviews without computing them.
+    result = raster.BuildOverviews('NONE', overviewlist=overview_scales)
+    raster = None
+    if result:  # Result will be nonzero on error.
+        raise RuntimeError(
+            f"Allocating overviews failed for {raster_path}")
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(n_workers, 1)) as executor:
+        for level, factor in enumerate(overview_scales):
+            start_time = time.time()
+            level_raster, level_band = _overview_band(
+                raster_path, level, internal)
+            chunks = _plan_chunks(
+                level_band.XSize, level_band.YSize, chunk_size)
+            futures = [
+                executor.submit(
+                    _downsample_chunk, raster_path, level - 1, window,
+                    nodata, resampling_method)
+                for window in chunks]
+            n_written = 0
+            last_report_time = time.time()
+            for n_done, future in enumerate(
+                    concurrent.futures.as_completed(futures), start=1):
+                (xoff, yoff, _, _), array = future.result()
+                if array is not None:
+                    level_band.WriteArray(array, xoff, yoff)
+                    n_written += 1
+                if time.time() - last_report_time > 5.0:
+                    LOGGER.info(f"Overview level {level} (1/{factor}): "
+                                f"{n_done}/{len(chunks)} chunks")
+                    last_report_time = time.time()
+
+            n_pixels = level_band.XSize * level_band.YSize
+            level_band = None
+            # Closing the level flushes it so that the next level can be
+            # read from it.
+            level_raster = None
+            elapsed = max(time.time() - start_time, 1e-9)
+            LOGGER.info(
+                f"Overview level {level} (1/{factor}) done in "
+                f"{elapsed:.1f}s: {n_pixels / elapsed / 1e6:.1f} Mpixels/s, "
+                f"{n_pixels * 4 * pixel_size_bytes / elapsed / 2**20:.1f} "
+                f"MiB/s read; {n_written}/{len(chunks)} chunks had data")
+    LOGGER.info(f"Overviews completed for {raster_path}")
+
+
+def write_cog(raster_path, target_cog_path, n_threads=DEFAULT_N_WORKERS,
+              compress='LZW', remove_source=False):
+    """Copy a raster and its existing overviews into a COG.
+
+    The overviews (internal or external) are reused rather than recomputed,
+    so ``build_overviews`` should be run on ``raster_path`` first.  If
+    ``remove_source`` is True, the raster and its external overviews are
+    deleted once the COG is written, so that a global raster doesn't take up
+    scratch space three times over.
+    """
+    LOGGER.info(f"Writing cloud-optimized GeoTIFF {target_cog_path}")
+    gdal.Translate(
+        target_cog_path, raster_path, format='COG',
+        creationOptions=[
+            f'COMPRESS={compress}', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER',
+            'OVERVIEWS=FORCE_USE_EXISTING', f'NUM_THREADS={n_threads}',
+            'SPARSE_OK=TRUE'])
+    if remove_source:
+        for path in (raster_path, f'{raster_path}.ovr'):
+            if os.path.exists(path):
+                LOGGER.info(f"Removing {path}")
+                os.remove(path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Build overviews for a raster in parallel.')
+    parser.add_argument('--internal', action='store_true',
+                        help='Write overviews into the raster itself.')
+    parser.add_argument('--resampling', default='average',
+                        choices=RESAMPLING_METHODS)
+    parser.add_argument('--workers', type=int, default=DEFAULT_N_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--cog', metavar='TARGET',
+                        help='Also copy the raster and its overviews into a '
+                             'cloud-optimized GeoTIFF at this path.')
+    parser.add_argument('--remove-source', action='store_true',
+                        help='Delete the raster and its external overviews '
+                             'once the COG is written.')
+    parser.add_argument('raster')
+    parsed_args = parser.parse_args(args)
+
+    build_overviews(parsed_args.raster, parsed_args.internal,
+                    parsed_args.resampling, parsed_args.workers,
+                    parsed_args.chunk_size)
+    if parsed_args.cog:
+        write_cog(parsed_args.raster, parsed_args.cog, parsed_args.workers,
+                  remove_source=parsed_args.remove_source)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
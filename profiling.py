@@ -0,0 +1,286 @@
+# Per-stage instrumentation for the pipeline.
+#
+# A Profiler records, for each stage that it measures: wall time, CPU time
+# (including any child processes that finished during the stage, such as a
+# process pool's workers), peak resident memory, bytes read from and written
+# to storage (from /proc/self/io, where available) and, where the caller
+# provides them, the number of tiles and pixels involved.  The records are
+# written to <workspace>/profile-report.json and profile-report.csv so that
+# runs can be compared across releases.
+#
+# Stages whose names match a pattern can also be run under cProfile, writing
+# <workspace>/profile-<stage>.prof, which can be read with ``python -m pstats``
+# or snakeviz.  cProfile only sees Python code; time spent inside GDAL shows
+# up as the builtin call that entered it.
+import contextlib
+import cProfile
+import csv
+import fnmatch
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from osgeo import gdal
+
+LOGGER = logging.getLogger(__name__)
+REPORT_BASENAME = 'profile-report'
+CSV_FIELDS = (
+    'name', 'status', 'start_s', 'wall_time_s', 'cpu_time_s', 'peak_rss_mb',
+    'read_mb', 'write_mb', 'tiles', 'pixels', 'cprofile_path')
+
+
+def source_version():
+    # The git commit of this checkout, if it is one.
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _io_bytes():
+    # Bytes this process (and any children it has waited for) actually read
+    # from and wrote to storage, or None where /proc/self/io isn't available.
+    try:
+        with open('/proc/self/io') as io_file:
+            fields = dict(line.split(':', 1) for line in io_file)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    # Linux resets a process's peak RSS (VmHWM) when 5 is written to
+    # clear_refs, so that each stage's peak can be measured separately.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return _max_rss_bytes(resource.RUSAGE_SELF)
+
+
+def _max_rss_bytes(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def count_pixels(raster_paths):
+    # The total number of pixels in the rasters among ``raster_paths``.
+    n_pixels = 0
+    for path in raster_paths:
+        if os.path.splitext(path)[1].lower() not in ('.tif', '.vrt'):
+            continue
+        raster = gdal.OpenEx(path, gdal.OF_RASTER)
+        if raster is not None:
+            n_pixels += raster.RasterXSize * raster.RasterYSize
+        raster = None
+    return n_pixels
+
+
+class _Measurement(object):
+    def __init__(self, name, cprofile_path=None):
+        self.name = name
+        self.cprofile_path = cprofile_path
+        self.profile = None
+
+    def start(self):
+        _reset_peak_rss()
+        self.children_max_rss = _max_rss_bytes(resource.RUSAGE_CHILDREN)
+        self.io = _io_bytes()
+        self.cpu = (_cpu_seconds(resource.RUSAGE_SELF) +
+                    _cpu_seconds(resource.RUSAGE_CHILDREN))
+        if self.cprofile_path is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.start_time = time.perf_counter()
+
+    def stop(self, status):
+        wall_time = time.perf_counter() - self.start_time
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.cprofile_path)
+            LOGGER.info(f"Wrote cProfile output for {self.name} to "
+                        f"{self.cprofile_path}")
+        cpu = (_cpu_seconds(resource.RUSAGE_SELF) +
+               _cpu_seconds(resource.RUSAGE_CHILDREN))
+        # Without a reset, this is the peak since the process started.
+        peak_rss = _peak_rss_bytes()
+        children_max_rss = _max_rss_bytes(resource.RUSAGE_CHILDREN)
+        if children_max_rss > self.children_max_rss:
+            # A child that finished during the stage set a new peak.
+            peak_rss = max(peak_rss, children_max_rss)
+        io = _io_bytes()
+
+        record = {
+            'name': self.name,
+            'status': status,
+            'wall_time_s': round(wall_time, 3),
+            'cpu_time_s': round(cpu - self.cpu, 3),
+            'peak_rss_mb': round(peak_rss / 2**20, 1),
+            'read_mb': None,
+            'write_mb': None,
+            'cprofile_path': (
+                self.cprofile_path if self.profile is not None else None),
+        }
+        if self.io is not None and io is not None:
+            record['read_mb'] = round((io[0] - self.io[0]) / 2**20, 1)
+            record['write_mb'] = round((io[1] - self.io[1]) / 2**20, 1)
+        return record
+
+
+def _measured_call(name, func, args, kwargs, cprofile_path=None):
+    # Runs in a worker process, so that the stage is measured where it runs.
+    measurement = _Measurement(name, cprofile_path)
+    measurement.start()
+    try:
+        func(*args, **kwargs)
+    except BaseException:
+        measurement.stop('failed')
+        raise
+    return measurement.stop('run')
+
+
+class Profiler(object):
+    def __init__(self, workspace=None, cprofile_pattern=None):
+        """Collect per-stage measurements for a workspace.
+
+        Args:
+            workspace: the directory to write the report (and any cProfile
+                output) to.  If None, measurements are only logged.
+            cprofile_pattern: an optional ``fnmatch`` pattern of the stage
+                names to run under cProfile, e.g. '1_warp' or '5_*'.
+        """
+        self.workspace = workspace
+        self.cprofile_pattern = cprofile_pattern
+        self.records = []
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+
+    def _cprofile_path(self, name):
+        if (self.workspace is None or self.cprofile_pattern is None or
+                not fnmatch.fnmatch(name, self.cprofile_pattern)):
+            return None
+        return os.path.join(self.workspace, f'profile-{name}.prof')
+
+    def _add(self, record, start_time, outputs=()):
+        record['start_s'] = round(start_time - self._start_time, 3)
+        record.setdefault('tiles', None)
+        record['pixels'] = (
+            count_pixels(outputs) if record['status'] == 'run' and outputs
+            else record.get('pixels'))
+        LOGGER.debug(f"Stage {record['name']}: {record}")
+        with self._lock:
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, outputs=()):
+        """Measure the code run within the context.
+
+        Yields a dict to which the caller may add counts, e.g. 'tiles'.  The
+        pixels in ``outputs`` are counted when the stage completes.
+        """
+        start_time = time.perf_counter()
+        counts = {}
+        measurement = _Measurement(name, self._cprofile_path(name))
+        measurement.start()
+        try:
+            yield counts
+        except BaseException:
+            self._add({**counts, **measurement.stop('failed')}, start_time)
+            raise
+        self._add({**counts, **measurement.stop('run')}, start_time,
+                  outputs)
+
+    def skipped(self, name):
+        # A stage whose outputs were already current.
+        self._add({'name': name, 'status': 'skipped'}, time.perf_counter())
+
+    def submit(self, executor, name, func, args=(), kwargs=None, outputs=()):
+        """Submit a call to an executor, measuring it in the worker.
+
+        Returns:
+            The executor's future.  The measurement is recorded when the
+            call completes.
+        """
+        start_time = time.perf_counter()
+        future = executor.submit(
+            _measured_call, name, func, args, kwargs or {},
+            self._cprofile_path(name))
+
+        def _record(done_future):
+            if done_future.exception() is None:
+                self._add(done_future.result(), start_time, outputs)
+            else:
+                self._add({'name': name, 'status': 'failed'}, start_time)
+        future.add_done_callback(_record)
+        return future
+
+    def annotate(self, name, **counts):
+        # Add counts (e.g. tiles=12) to the latest record of a stage.
+        with self._lock:
+            for record in reversed(self.records):
+                if record['name'] == name:
+                    record.update(counts)
+                    return
+
+    def write_report(self):
+        """Write the records to profile-report.json and .csv.
+
+        Returns:
+            The path to the JSON report, or None if there's no workspace.
+        """
+        if self.workspace is None:
+            return None
+        with self._lock:
+            records = list(self.records)
+        os.makedirs(self.workspace, exist_ok=True)
+        json_path = os.path.join(self.workspace, f'{REPORT_BASENAME}.json')
+        with open(json_path, 'w') as report_file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'version': source_version(),
+                'argv': sys.argv,
+                'total_wall_time_s': round(
+                    time.perf_counter() - self._start_time, 3),
+                'stages': records,
+            }, report_file, indent=2)
+        with open(os.path.join(self.workspace, f'{REPORT_BASENAME}.csv'),
+                  'w', newline='') as report_file:
+            writer = csv.DictWriter(
+                report_file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+
+        LOGGER.info(f"Wrote profile report to {json_path}")
+        for record in records:
+            if record['status'] == 'run':
+                LOGGER.info(
+                    f"  {record['name']:<28} {record['wall_time_s']:9.2f}s "
+                    f"wall {record['cpu_time_s']:9.2f}s CPU "
+                    f"{record['peak_rss_mb']:8.1f} MB peak")
+        return json_path
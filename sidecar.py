@@ -0,0 +1,64 @@
+# Files derived from a product's tile data file and saved alongside it.
+#
+# The tile index (tileindex.py) and the coverage grid (coverage.py) are both
+# cheap to load but slow to derive from the product's JSON file, so each is
+# saved next to the JSON file (or catalog) the first time it is built.  A
+# saved sidecar is used until the data file is modified, at which point it is
+# rebuilt, and loaded sidecars are kept in memory for the life of the process.
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+_LOADED_SIDECARS = {}
+
+
+def load_or_build(data_path, sidecar_path, load, build, description):
+    """Load the sidecar of a data file, building it if it is stale.
+
+    Args:
+        data_path: the product JSON file or catalog the sidecar is derived
+            from.  It may be missing if the sidecar was prebuilt.
+        sidecar_path: where the sidecar is saved.
+        load: a function that loads the sidecar from ``sidecar_path``.
+        build: a function that builds the sidecar from ``data_path``.  The
+            object it returns must have a ``save(target_path)`` method.
+        description: what the sidecar is, for log messages.
+
+    Returns:
+        The loaded (or built) sidecar.
+    """
+    data_path = os.path.abspath(data_path)
+    sidecar_path = os.path.abspath(sidecar_path)
+    try:
+        sidecar_mtime = os.path.getmtime(sidecar_path)
+    except OSError:
+        sidecar_mtime = None
+
+    try:
+        data_mtime = os.path.getmtime(data_path)
+    except OSError:
+        if sidecar_mtime is None:
+            raise
+        data_mtime = sidecar_mtime  # Only the prebuilt sidecar is available.
+
+    # The data file's mtime is part of the key so that a sidecar cached
+    # before the data file changed is rebuilt.
+    cache_key = (sidecar_path, sidecar_mtime, data_mtime)
+    if cache_key in _LOADED_SIDECARS:
+        return _LOADED_SIDECARS[cache_key]
+
+    if sidecar_mtime is not None and sidecar_mtime >= data_mtime:
+        sidecar = load(sidecar_path)
+    else:
+        LOGGER.info(f"Building {description} for {data_path}")
+        sidecar = build(data_path)
+        try:
+            sidecar.save(sidecar_path)
+            cache_key = (sidecar_path, os.path.getmtime(sidecar_path),
+                         data_mtime)
+        except OSError:
+            LOGGER.warning(f"Could not write {description} to {sidecar_path}"
+                           "; it will be rebuilt next time.")
+
+    _LOADED_SIDECARS[cache_key] = sidecar
+    return sidecar
@@ -26,7 +26,6 @@ then
     # execute on $SCRATCH if we're on sherlock
     WORKING_DIR="$SCRATCH/$WORKING_DIR"
     module load physics gdal/3.5.2
-    module load system jq
 fi
 
 mkdir $WORKING_DIR || echo "$WORKING_DIR already exists"
@@ -37,38 +36,21 @@ mkdir $WORKING_DIR || echo "$WORKING_DIR already exists"
 # Try this alternate approach and see if it's faster
 wget --no-clobber --no-verbose --user="$NASA_EARTHDATA_USERNAME" --password="$NASA_EARTHDATA_PASSWORD" --directory-prefix=$WORKING_DIR --input-file $SRTM_URLS_FILE
 
-# Runtime: with all of the SRTM files downloaded, this took just under 3 hours to run.
-# It was on SCRATCH, so I'm guessing that the disk I/O is the bottleneck.
+# With all of the SRTM files downloaded, this used to take just under 3 hours
+# with a serial gdalinfo+jq loop.  catalogbuilder.py derives each tile's
+# extent from its name (falling back to reading the header, through /vsizip/
+# for the zips GDAL can't open directly) and checksums the tiles in the same
+# pass, across a process pool.  If it's interrupted, running it again resumes
+# from its journal.
 SRTM_JSON_FILE="srtm_bboxes.json"
-rm $SRTM_JSON_FILE || echo "Can't delete $SRTM_JSON_FILE if it doesn't exist!"
-echo "{" >> $SRTM_JSON_FILE
-
-# This loop has so many iterations that we don't really need everything logged.
-# We're still exiting on the first nonzero exit code.
-set +x
-
-n_total=$(wc -l $SRTM_URLS_FILE | awk '{ print $1 }')
-n_files_so_far=1
-
-# $srtm_file is an absolute path in this case.
-for srtm_file in $(find $WORKING_DIR -name "*.hgt.zip")
-do
-    echo -e "$srtm_file $n_files_so_far \t\t of $n_total"
-
-    # gdalinfo is supposed to be able to extract the SRTM files (and it usually
-    # does).  But there are about 17 tiles that aren't accessible with the standard
-    # gdalinfo, so we need to specifically and correctly name those files.
-    # The /vsigzip/ approach is more reliable, but slower, so we only use that as a fallback when needed.
-    RASTER_METADATA=$(gdalinfo -json $srtm_file || gdalinfo -json /vsizip/$srtm_file/$(unzip -l $srtm_file | head -n4 | tail -n1 | awk '{ print $4 }'))
-    echo "\"$(basename $srtm_file)\": $(echo $RASTER_METADATA | jq -c '.wgs84Extent.coordinates[0]')," >> $SRTM_JSON_FILE
-    n_files_so_far=$(($n_files_so_far+1))
-done
-echo "}" >> $SRTM_JSON_FILE
-
-# Remove the comma from the last object to make the json valid.
-# This complicated sed expression is thanks to https://unix.stackexchange.com/a/485010
-sed -i.bak ':begin;$!N;s/,\n}/\n}/g;tbegin;P;D' $SRTM_JSON_FILE
-
-# Checksum the files while we're at it.
+# checksums.md5 has paths relative to the checksum file, so it can be
+# verified later with `md5sum -c` from $WORKING_DIR.
 CHECKSUM_FILE="$WORKING_DIR/checksums.md5"
-find "$WORKING_DIR" -name "*.hgt.zip" | xargs md5sum > "$CHECKSUM_FILE"
+python3 ../catalogbuilder.py \
+    --urls "$SRTM_URLS_FILE" \
+    --tiles-dir "$WORKING_DIR" \
+    --algorithm md5 \
+    --workers "${SLURM_CPUS_PER_TASK:-4}" \
+    --write-json "$SRTM_JSON_FILE" \
+    --write-checksums "$CHECKSUM_FILE" \
+    srtm_bboxes-catalog.npy
@@ -30,46 +30,32 @@ CONTAINER=ghcr.io/phargogh/natcap-devstack
 DIGEST=sha256:acdae8dc64e1c7f31e6d2a1f92aa16d1f49c50d58adcd841ee2d325a96de89d9
 
 CACHE="$L_SCRATCH"
-#find "$SCRATCH/srtm-global-30m" -name "*.zip" | parallel -j 8 "unzip -d $CACHE {}"
-find "$SCRATCH/srtm-global-30m" -name "*.zip" | parallel -j 8 "cp -v {} $CACHE"
-
+TILES_DIR="$SCRATCH/srtm-global-30m"
+
+# The zipped tiles are read in place on $SCRATCH, rather than copied or
+# extracted to $L_SCRATCH first, which leaves local scratch for the GeoTIFF
+# and its overviews.  srtm-local-1s-v3.py names the raster inside each zip
+# (the few tiles with oddly named rasters included), keeps as many tiles open
+# between block reads as GDAL_MAX_DATASET_POOL_SIZE allows, translates the
+# mosaic with empty ocean blocks skipped, and builds the overviews and COG.
+# The GeoTIFF and its overviews are deleted once the COG is written, so only
+# one copy of the global raster is on local scratch at the end.
+ulimit -n "$(ulimit -Hn)" || echo "Could not raise the open file limit"
 VRT_PATH="$CACHE/cmdline-global.vrt"
-#gdalbuildvrt $VRT_PATH $(find $CACHE -name "*.hgt.zip")
-gdalbuildvrt $VRT_PATH $(find $CACHE -name "*.hgt.zip")
-
-# Typically only takes about 7 minutes to get to this point on Sherlock.
 GTIFF_PATH="$CACHE/srtm-global-1s-v3.tif"
-GDAL_CACHEMAX=2048 gdal_translate \
-    -of "GTiff" \
-    -ot "Int16" \
-    -co "COMPRESS=LZW" \
-    -co "PREDICTOR=2" \
-    -co "TILED=YES" \
-    -co "SPARSE_OK=TRUE" \
-    -co "BIGTIFF=YES" \
-    -co "NUM_THREADS=4" \
-    "$VRT_PATH" \
-    "$GTIFF_PATH"
-
-# Remove the hgt zipfiles so we don't run out of disk space while building
-# overviews.
-df -h "$L_SCRATCH"
-find "$L_SCRATCH" -type f -name "*.hgt.zip" -delete
+# Named <product>-<resolution>-<subproduct>-global.tif, as fetcher.py
+# expects of a product's global raster (see the README).
+COG_PATH="$CACHE/SRTM-1s-v3-global.tif"
+singularity run \
+    --env GDAL_CACHEMAX=2048 \
+    docker://$CONTAINER@$DIGEST \
+    python "srtm-local-1s-v3.py" \
+        --extent="global" \
+        --cache-dir="$TILES_DIR" \
+        --vrt-path="$VRT_PATH" \
+        --gtiff-path="$GTIFF_PATH" \
+        --cog-path="$COG_PATH"
+du -h "$COG_PATH"
 df -h "$L_SCRATCH"
 
-# Generate internal overviews
-du -h "$GTIFF_PATH"
-GDAL_CACHEMAX=2048 gdaladdo $GTIFF_PATH
-du -h "$GTIFF_PATH"
-
-rsync --progress $GTIFF_PATH $WORKING_DIR
-
-#singularity run \
-#    docker://$CONTAINER@$DIGEST \
-#    python "srtm-local-1s-v3.py" \
-#        --extent="global" \
-#        --cache-dir="$CACHE" \
-#        --vrt-path="$WORKING_DIR/global.vrt" \
-#        --gtiff-path="$GTIFF_PATH"
-
-#rsync --progress "$GTIFF_PATH" "$WORKING_DIR/cmdline-srtm-global-1s-v3.tif"
+rsync --progress $COG_PATH $WORKING_DIR
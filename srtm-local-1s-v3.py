@@ -1,20 +1,21 @@
 import argparse
-import json
 import logging
-import math
 import os
-import time
-import zipfile
 
-import pygeoprocessing
-import shapely.geometry
-import shapely.prepared
 from osgeo import gdal
 
+import catalog
+import coverage
+import overviews
+import tilecache
+import tileindex
+import translate
+import zippedtiles
+
 logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger(__name__)
 DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
-    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'NUM_THREADS=4',
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW',
     'SPARSE_OK=TRUE', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'))
 
 # GDAL has an STRM driver!
@@ -42,135 +43,61 @@ DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
 #     create a VRT
 #     do a raster_calculator call if needed
 
-# Thanks to https://www.opentopodata.org/notes/invalid-srtm-zips/ for listing
-# these out.
-PROBLEMATIC_TILES = set([
-    "N37E051",
-    "N37E052",
-    "N38E050",
-    "N38E051",
-    "N38E052",
-    "N39E050",
-    "N39E051",
-    "N40E051",
-    "N41E050",
-    "N41E051",
-    "N42E049",
-    "N42E050",
-    "N43E048",
-    "N43E049",
-    "N44E048",
-    "N44E049",
-])
-
-
-def build_overviews(raster_path, internal=False,
-                    resampling_method=gdal.GRA_NearestNeighbour):
-    open_flags = gdal.OF_RASTER
-    if internal:
-        open_flags |= gdal.GA_Update
-        LOGGER.info(f"Building internal overviews on {raster_path}")
-    else:
-        LOGGER.info("Building external overviews.")
-    raster = gdal.OpenEx(raster_path, open_flags)
-    n_pixels_x = raster.RasterXSize
-    n_pixels_y = raster.RasterYSize
-
-    # This loop and limiting factor borrowed from gdaladdo.cpp
-    overview_scales = []
-    factor = 2
-    limiting_factor = 256
-    while (math.ceil(n_pixels_x / factor) > limiting_factor or
-           math.ceil(n_pixels_y / factor) > limiting_factor):
-        overview_scales.append(factor)
-        factor *= 2
-
-    def overviews_progress(*args, **kwargs):
-        pct_complete, name, other = args
-        percent = round(pct_complete * 100, 2)
-        if time.time() - overviews_progress.last_progress_report > 5.0:
-            LOGGER.info(f"Overviews progress: {percent}%")
-            overviews_progress.last_progress_report = time.time()
-    overviews_progress.last_progress_report = time.time()
-
-    LOGGER.debug(f"Using overviews {overview_scales}")
-    result = raster.BuildOverviews('NEAREST', overviewlist=overview_scales,
-                                   callback=overviews_progress)
-    LOGGER.info(f"Overviews completed for {raster_path}")
-    if result:  # Result will be nonzero on error.
-        raise RuntimeError(
-            f"Building overviews failed or was interrupted for {raster_path}")
-
-
-def _identity(matrix):
-    return matrix
-
-
-def srtm(bbox, cache_dir, target_vrt, target_gtiff):
+
+def srtm(bbox, cache_dir, target_vrt, target_gtiff, target_cog=None):
     LOGGER.info(f"Finding intersecting SRTM tiles for {bbox}")
 
-    srtm_data_file = os.path.join(
-        os.path.dirname(__file__), 'srtm-data', 'srtm_bboxes.json')
-    LOGGER.info("Loading SRTM data")
-    with open(srtm_data_file) as tiles_data:
-        srtm_tiles = json.load(tiles_data)
+    # The tile catalog is used instead of the JSON file when it is current.
+    srtm_data_file = catalog.preferred_data_path(os.path.join(
+        os.path.dirname(__file__), 'srtm-data', 'srtm_bboxes.json'))
+    LOGGER.info("Loading SRTM tile index")
+    srtm_tiles = tileindex.load_tile_index(srtm_data_file)
 
-    LOGGER.info("SRTM data loaded")
+    LOGGER.info("SRTM tile index loaded")
 
     if bbox != 'global':
-        bounding_box = shapely.prepared.prep(shapely.geometry.box(*bbox))
-
-        intersecting_tiles = []
-        for srtm_zipfile, coord_list in srtm_tiles.items():
-            tile = shapely.geometry.Polygon(coord_list)
-            if bounding_box.intersects(tile):
-                intersecting_tiles.append(srtm_zipfile)
+        intersecting_tiles = list(srtm_tiles.intersecting(bbox))
     else:
-        intersecting_tiles = list(srtm_tiles.keys())
+        intersecting_tiles = srtm_tiles.names.tolist()
 
     LOGGER.info(f"{len(intersecting_tiles)} intersecting tiles found")
 
-    valid_intersecting_tiles = []
-    last_time_logged = time.time()
-    for index, tile in enumerate(intersecting_tiles):
-        subdir = tile[:4]  # subdirectory prefix; for lustre performance
-        if time.time() - last_time_logged > 5.0:
-            LOGGER.info(
-                f"({index+1}/{len(intersecting_tiles)}) "
-                f"Determining GDAL-readable filepath for {tile}")
-            last_time_logged = time.time()
-
-        #filepath = os.path.join(cache_dir, subdir, tile)
-        if tile.split('.')[0] in PROBLEMATIC_TILES:
-            filepath = os.path.join(
-                cache_dir, tile.replace('.hgt.zip', '.hgt'))
-        else:
-            filepath = os.path.join(
-                cache_dir, tile.replace('.SRTMGL1.hgt.zip', '.hgt'))
-
-        #if tile.split('.')[0] in PROBLEMATIC_TILES:
-        #    with zipfile.ZipFile(filepath) as srtm_archive:
-        #        sub_filename = srtm_archive.infolist()[0].filename
-        #    filepath = f'/vsizip/{filepath}/{sub_filename}'
-
-        valid_intersecting_tiles.append(filepath)
+    tile_paths = []
+    for tile in intersecting_tiles:
+        # The tiles may be in subdirectories named for their prefix (as
+        # written by srtm-data/srtm-rearrange.py) for lustre performance.
+        filepath = tilecache.find_tile(cache_dir, tile)
+        if filepath is None:
+            LOGGER.warning(f"Tile {tile} is not in {cache_dir}; skipping")
+            continue
+        tile_paths.append(filepath)
+
+    # The zipped tiles are read in place.  The raster inside each zip is
+    # named in the catalog (or read from the zip's directory), which also
+    # takes care of the few tiles whose rasters aren't named like the zip.
+    LOGGER.info(f"Determining GDAL-readable filepaths of {len(tile_paths)} "
+                "tiles")
+    valid_intersecting_tiles = zippedtiles.gdal_paths(
+        tile_paths, srtm_data_file)
+    # Keep as many tiles open between block reads as the open file limit
+    # allows.
+    zippedtiles.configure_dataset_pool(len(valid_intersecting_tiles))
 
     LOGGER.info("Building VRT")
     gdal.BuildVRT(target_vrt, valid_intersecting_tiles)
 
-    LOGGER.info("Getting raster info")
-    vrt_raster_info = pygeoprocessing.get_raster_info(target_vrt)
-
-    pygeoprocessing.geoprocessing.raster_calculator(**{
-        'base_raster_path_band_const_list': [(target_vrt, 1)],
-        'local_op': _identity,
-        'target_raster_path': target_gtiff,
-        'datatype_target': vrt_raster_info['datatype'],
-        'nodata_target': vrt_raster_info['nodata'][0],
-        'raster_driver_creation_tuple': DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
-        'largest_block': 2**19,  # 8x the size of default pgp blocksize
-    })
-    build_overviews(target_gtiff, internal=False)
+    # Most of the globe is ocean, which no SRTM tile covers.
+    translate.translate_raster(
+        target_vrt, target_gtiff, DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
+        block_coverage=coverage.load_coverage(
+            srtm_data_file).block_coverage(target_vrt))
+    # Averaging is the better choice than nearest-neighbor for elevation.
+    overviews.build_overviews(
+        target_gtiff, internal=False, resampling_method='average')
+    if target_cog:
+        # The GeoTIFF and its overviews are only an intermediate step to the
+        # COG, so they are removed to leave scratch space for the COG.
+        overviews.write_cog(target_gtiff, target_cog, remove_source=True)
 
 
 def main(args=None):
@@ -181,6 +108,8 @@ def main(args=None):
     parser.add_argument('--cache-dir')
     parser.add_argument('--vrt-path')
     parser.add_argument('--gtiff-path')
+    # An optional cloud-optimized copy, which replaces the GeoTIFF.
+    parser.add_argument('--cog-path')
 
     parsed_args = parser.parse_args(args)
 
@@ -194,7 +123,8 @@ def main(args=None):
         bbox,
         parsed_args.cache_dir,
         parsed_args.vrt_path,
-        parsed_args.gtiff_path
+        parsed_args.gtiff_path,
+        parsed_args.cog_path
     )
 
 
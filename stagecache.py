@@ -0,0 +1,171 @@
+# Skip pipeline stages whose inputs and parameters haven't changed.
+#
+# Each stage of the pipeline in fetcher.py is identified by a key: a hash of
+# the stage's name, its parameters and the keys of the stages it depends on.
+# Keys are recorded in <workspace>/.stage-cache.json along with the size and
+# modification time of each output file.  When a stage is run again with the
+# same key and its outputs are unchanged on disk, it is skipped.  Because
+# keys are chained through their inputs, changing a parameter of one stage
+# (e.g. the TFA range) re-runs that stage and everything downstream of it,
+# but nothing upstream.
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+STAGE_CACHE_FILENAME = '.stage-cache.json'
+
+
+def stage_key(name, params=None, input_keys=()):
+    # Parameters must be JSON-serializable; anything else (e.g. tuples) is
+    # converted by ``default=str`` so that the key is still deterministic.
+    payload = json.dumps(
+        {'stage': name, 'params': params, 'inputs': list(input_keys)},
+        sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Stage(object):
+    def __init__(self, name, func, args=(), kwargs=None, outputs=(),
+                 params=None, inputs=()):
+        """A unit of work in the pipeline.
+
+        Args:
+            name: a name unique within the workspace, e.g. '2_srtm_pitfilled'.
+            func: the callable to run.  For stages run in parallel, this and
+                its arguments must be picklable.
+            args, kwargs: the arguments to call ``func`` with.
+            outputs: the files that ``func`` writes.
+            params: JSON-serializable parameters that affect the outputs
+                and are not already captured by ``inputs``.
+            inputs: the keys of the stages this stage depends on.
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.outputs = list(outputs)
+        self.key = stage_key(name, params, inputs)
+
+
+class StageCache(object):
+    def __init__(self, workspace, enabled=True, profiler=None):
+        """Track the stages run in a workspace.
+
+        Args:
+            workspace: the directory whose stages are tracked.
+            enabled: if False, every stage is run.
+            profiler: an optional ``profiling.Profiler`` that measures every
+                stage run (or skipped) through this cache.
+        """
+        self.path = os.path.join(workspace, STAGE_CACHE_FILENAME)
+        self.enabled = enabled
+        self.profiler = profiler
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as cache_file:
+                self.records = json.load(cache_file)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def _save(self):
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self.records, cache_file, indent=2)
+        os.replace(temp_path, self.path)
+
+    def is_current(self, stage):
+        if not self.enabled:
+            return False
+        record = self.records.get(stage.name)
+        if record is None or record['key'] != stage.key:
+            return False
+        for output_path in stage.outputs:
+            try:
+                signature = file_signature(output_path)
+            except OSError:
+                return False
+            if record['outputs'].get(output_path) != signature:
+                return False
+        return True
+
+    def _record(self, stage):
+        with self._lock:
+            self.records[stage.name] = {
+                'key': stage.key,
+                'outputs': {
+                    output_path: file_signature(output_path)
+                    for output_path in stage.outputs},
+            }
+            self._save()
+
+    def run(self, stage):
+        """Run ``stage`` unless its outputs are current.
+
+        Returns:
+            The stage's key, for use as an input to downstream stages.
+        """
+        if self.is_current(stage):
+            LOGGER.info(f"Skipping stage {stage.name}; inputs unchanged")
+            if self.profiler is not None:
+                self.profiler.skipped(stage.name)
+            return stage.key
+
+        with self._lock:
+            # Forget the old record first so that an interrupted stage is
+            # never mistaken for a complete one.
+            if self.records.pop(stage.name, None) is not None:
+                self._save()
+        if self.profiler is None:
+            stage.func(*stage.args, **stage.kwargs)
+        else:
+            with self.profiler.stage(stage.name, stage.outputs):
+                stage.func(*stage.args, **stage.kwargs)
+        self._record(stage)
+        return stage.key
+
+    def run_parallel(self, stages, n_workers=None):
+        """Run independent stages concurrently in a process pool.
+
+        Returns:
+            A list of the stages' keys, in the order given.
+        """
+        stages = list(stages)
+        pending = [stage for stage in stages if not self.is_current(stage)]
+        for stage in stages:
+            if stage not in pending:
+                LOGGER.info(f"Skipping stage {stage.name}; inputs unchanged")
+                if self.profiler is not None:
+                    self.profiler.skipped(stage.name)
+
+        if pending:
+            with self._lock:
+                for stage in pending:
+                    self.records.pop(stage.name, None)
+                self._save()
+
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=n_workers) as executor:
+                futures = {}
+                for stage in pending:
+                    if self.profiler is None:
+                        future = executor.submit(
+                            stage.func, *stage.args, **stage.kwargs)
+                    else:
+                        # Measured in the worker, where the stage runs.
+                        future = self.profiler.submit(
+                            executor, stage.name, stage.func, stage.args,
+                            stage.kwargs, stage.outputs)
+                    futures[future] = stage
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    self._record(futures[future])
+        return [stage.key for stage in stages]
@@ -0,0 +1,258 @@
+# Warp tiles into the target grid while they are still being downloaded.
+#
+# Without streaming, fetcher.py downloads every tile, then mosaics them and
+# then warps the mosaic, so the CPUs sit idle during the downloads and the
+# network sits idle during the warp.  Here the target grid is split into
+# square chunks, and a pool of workers warps each chunk as soon as every tile
+# that it reads from has arrived, while the other downloads continue.  Once
+# the last chunk is warped, the chunks are copied into the target raster
+# through a VRT, so the end-to-end time approaches the longer of the
+# downloads and the warp rather than their sum.
+#
+# The chunks are aligned to the target grid and don't overlap, and each
+# chunk is warped from a VRT of every tile within (a little more than) its
+# footprint, so pixels on the edges of tiles and chunks are interpolated just
+# as a warp of the whole mosaic would interpolate them.
+import collections
+import concurrent.futures
+import logging
+import math
+import os
+import shutil
+
+import pygeoprocessing
+from osgeo import gdal
+from osgeo import osr
+
+import aoi
+import tileindex
+import zippedtiles
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_CHUNK_SIZE = 1024
+# How far beyond a chunk's lat/lon footprint to look for tiles, so that the
+# pixels on the chunk's edges have their neighboring source pixels.  This is
+# many source pixels for every supported product.
+SOURCE_BUFFER_DEGREES = 0.01
+# The chunks are only read once, when they are copied into the target, so
+# they are left uncompressed.
+CHUNK_CREATION_OPTIONS = ('TILED=YES', 'SPARSE_OK=TRUE')
+
+
+def aligned_bounds(target_bb, target_pixel_size):
+    # Snap a bounding box outward to whole pixels, as gdal.Warp's
+    # targetAlignedPixels does.
+    x_res, y_res = abs(target_pixel_size[0]), abs(target_pixel_size[1])
+    minx, miny, maxx, maxy = target_bb
+    return [math.floor(minx / x_res) * x_res, math.floor(miny / y_res) * y_res,
+            math.ceil(maxx / x_res) * x_res, math.ceil(maxy / y_res) * y_res]
+
+
+def plan_chunks(target_bounds, target_pixel_size,
+                chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split an aligned grid into chunks of at most ``chunk_size`` pixels.
+
+    Returns:
+        A list of ``(bounds, (n_cols, n_rows))`` for each chunk, top row
+        first, where ``bounds`` is ``[minx, miny, maxx, maxy]``.
+    """
+    x_res, y_res = abs(target_pixel_size[0]), abs(target_pixel_size[1])
+    minx, miny, maxx, maxy = target_bounds
+    n_cols = round((maxx - minx) / x_res)
+    n_rows = round((maxy - miny) / y_res)
+    chunks = []
+    for row_off in range(0, n_rows, chunk_size):
+        row_end = min(row_off + chunk_size, n_rows)
+        for col_off in range(0, n_cols, chunk_size):
+            col_end = min(col_off + chunk_size, n_cols)
+            chunks.append((
+                [minx + col_off * x_res, maxy - row_end * y_res,
+                 minx + col_end * x_res, maxy - row_off * y_res],
+                (col_end - col_off, row_end - row_off)))
+    return chunks
+
+
+def chunk_tiles(chunks, tilenames, tile_data_file, target_projection_wkt):
+    """Find the tiles that each chunk reads from.
+
+    Args:
+        chunks: the chunks from ``plan_chunks``.
+        tilenames: the tiles that the AOI needs.  Chunks only read from
+            these.
+        tile_data_file: the product's tile data file.
+        target_projection_wkt: the WKT of the chunks' projection.
+
+    Returns:
+        A list of the set of tile names for each chunk, which is empty for
+        chunks with no source data.
+    """
+    tile_index = tileindex.load_tile_index(tile_data_file)
+    tilenames = set(tilenames)
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    tiles_per_chunk = []
+    for bounds, _ in chunks:
+        lonlat_bbox = aoi.buffer_bbox(
+            pygeoprocessing.transform_bounding_box(
+                bounds, target_projection_wkt, wgs84_srs.ExportToWkt(),
+                edge_samples=aoi.EDGE_SAMPLES),
+            SOURCE_BUFFER_DEGREES)
+        names, _ = tile_index.lookup(tile_index.query(lonlat_bbox))
+        tiles_per_chunk.append(set(names) & tilenames)
+    return tiles_per_chunk
+
+
+def _warp_chunk(bounds, size, source_paths, vrt_path, chunk_path,
+                target_projection_wkt, resample_method, warp_memory_mb,
+                overview_level, cutline_path):
+    gdal.BuildVRT(vrt_path, source_paths)
+    nodata = pygeoprocessing.get_raster_info(vrt_path)['nodata'][0]
+    # Each chunk is warped on one thread; the chunks are warped in parallel.
+    gdal.Warp(
+        chunk_path, vrt_path,
+        format='GTiff',
+        creationOptions=list(CHUNK_CREATION_OPTIONS),
+        outputBounds=bounds,
+        width=size[0],
+        height=size[1],
+        dstSRS=target_projection_wkt,
+        resampleAlg=resample_method,
+        srcNodata=nodata,
+        dstNodata=nodata,
+        warpOptions=['SKIP_NOSOURCE=YES'],
+        warpMemoryLimit=warp_memory_mb * 2**20,
+        overviewLevel='NONE' if overview_level is None else overview_level,
+        cutlineDSName=cutline_path)
+    return chunk_path
+
+
+def warp_as_tiles_arrive(tile_arrivals, tile_paths, target_raster_path,
+                         target_pixel_size, target_projection_wkt, aoi_bbox,
+                         tile_data_file, raster_driver_creation_tuple,
+                         resample_method='bilinear', n_workers=None,
+                         warp_memory_mb=512, overview_level=None,
+                         cutline_path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Warp tiles into a target raster as they arrive.
+
+    The target raster covers the same pixels as ``fetcher.warp_to_aoi``
+    would write for the same AOI.
+
+    Args:
+        tile_arrivals: a ``queue.Queue`` that yields the name of each tile
+            once it is available locally, and then None once no more tiles
+            will arrive.
+        tile_paths: a dict mapping the name of every tile that the AOI needs
+            to its local path.
+        target_raster_path: the raster to create.
+        target_pixel_size: an (x, y) tuple in target projection units.
+        target_projection_wkt: the WKT of the target projection.
+        aoi_bbox: the [minx, miny, maxx, maxy] lat/lon area to warp.  It must
+            not cross the antimeridian.
+        tile_data_file: the product's tile data file.
+        raster_driver_creation_tuple: the (driver, creation options) of the
+            target raster.
+        resample_method: a GDAL resampling algorithm name.
+        n_workers: the number of chunks to warp at once.  Defaults to every
+            CPU.
+        warp_memory_mb: the memory limit for the warp buffers of all of the
+            workers together.
+        overview_level: the index of the tiles' overview to read from, or
+            None to read full-resolution pixels.
+        cutline_path: an optional lat/lon vector of the AOI's geometry.
+            Pixels outside of it are set to nodata.
+        chunk_size: the width and height of each chunk in pixels.
+
+    Returns:
+        ``None``
+
+    Raises:
+        ValueError: if none of the tiles are within the AOI.
+        RuntimeError: if no more tiles arrive before every chunk could be
+            warped, or if any chunk failed.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    worker_memory_mb = max(warp_memory_mb // n_workers, 1)
+
+    target_bounds = aligned_bounds(
+        aoi.transform_bbox(aoi_bbox, target_projection_wkt), target_pixel_size)
+    chunks = plan_chunks(target_bounds, target_pixel_size, chunk_size)
+    tiles_per_chunk = chunk_tiles(
+        chunks, tile_paths, tile_data_file, target_projection_wkt)
+    # Chunks with no tiles have no source data, and are left as nodata.
+    waiting = {index: set(tilenames)
+               for index, tilenames in enumerate(tiles_per_chunk)
+               if tilenames}
+    if not waiting:
+        raise ValueError(f"No tiles intersect {aoi_bbox}")
+    chunks_per_tile = collections.defaultdict(list)
+    for index, tilenames in waiting.items():
+        for tilename in tilenames:
+            chunks_per_tile[tilename].append(index)
+    LOGGER.info(f"Warping {len(waiting)} chunks of {chunk_size} pixels as "
+                f"their tiles arrive")
+
+    base_path = os.path.splitext(target_raster_path)[0]
+    chunk_dir = f'{base_path}_chunks'
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir)
+
+    n_chunks = len(waiting)
+    futures = {}
+    # GDAL releases the GIL while warping, so threads are enough.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_workers) as executor:
+        while waiting:
+            tilename = tile_arrivals.get()
+            if tilename is None:
+                break
+            for index in chunks_per_tile.pop(tilename, []):
+                waiting[index].discard(tilename)
+                if waiting[index]:
+                    continue
+                del waiting[index]
+                bounds, size = chunks[index]
+                source_paths = zippedtiles.gdal_paths(
+                    [tile_paths[name] for name in sorted(
+                        tiles_per_chunk[index])], tile_data_file)
+                future = executor.submit(
+                    _warp_chunk, bounds, size, source_paths,
+                    os.path.join(chunk_dir, f'chunk_{index}.vrt'),
+                    os.path.join(chunk_dir, f'chunk_{index}.tif'),
+                    target_projection_wkt, resample_method, worker_memory_mb,
+                    overview_level, cutline_path)
+                futures[future] = index
+                LOGGER.debug(f"Chunk {index} is ready to warp "
+                             f"({len(futures)}/{n_chunks})")
+
+        chunk_paths = []
+        failures = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                chunk_paths.append(future.result())
+            except Exception:
+                LOGGER.exception(f"Chunk {futures[future]} failed")
+                failures.append(futures[future])
+
+    if waiting:
+        missing_tiles = sorted(set().union(*waiting.values()))
+        raise RuntimeError(
+            f"{len(waiting)} of {n_chunks} chunks could not be warped "
+            f"because {len(missing_tiles)} tiles never arrived: "
+            f"{', '.join(missing_tiles)}")
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {n_chunks} chunks failed to warp")
+
+    LOGGER.info(f"Copying {n_chunks} chunks into {target_raster_path}")
+    mosaic_path = os.path.join(chunk_dir, 'chunks.vrt')
+    gdal.BuildVRT(
+        mosaic_path, sorted(chunk_paths), outputBounds=target_bounds,
+        resolution='user', xRes=abs(target_pixel_size[0]),
+        yRes=abs(target_pixel_size[1]))
+    driver, creation_options = raster_driver_creation_tuple
+    gdal.Translate(
+        target_raster_path, mosaic_path, format=driver,
+        creationOptions=list(creation_options))
+    shutil.rmtree(chunk_dir)
@@ -0,0 +1,727 @@
+# A local cache of downloaded tiles for a single product.
+#
+# The layout follows the cache structure described in the README:
+#
+#     <cache root>/
+#         tiles/
+#             <shard>/<tile>
+#         tiles-checksum-<algorithm>.txt
+#         tiles-manifest.json
+#
+# Tiles may be kept in one flat directory or sharded into subdirectories
+# named for the first few characters of each tile (e.g. tiles/N45E/ for SRTM),
+# so that no directory holds thousands of entries, which is slow on a
+# metadata-bound parallel filesystem like Lustre.
+#
+# Tiles are downloaded to a ``.part`` file next to their final location and
+# only renamed into place once they have been verified, so a killed job never
+# leaves a truncated tile where a complete one is expected.  The expected
+# checksums come from ``tiles-checksum-<algorithm>.txt`` (the format written
+# by ``sha256sum``/``md5sum``) when it is available.
+#
+# ``tiles-manifest.json`` records the layout and, for every verified tile,
+# its digest, size, modification time and when it was last used.  The
+# manifest is the cache's index: a tile listed in it is a cache hit without
+# touching the tile itself, so checking hundreds of tiles costs one read of
+# the manifest rather than hundreds of ``stat`` calls.  Only tiles missing
+# from the manifest are looked for on disk (and hashed, if found).  Caches
+# that were written with ``tiles-verified.json`` (the manifest's flat
+# predecessor) are read as flat caches.
+#
+# Several jobs may share a cache.  They coordinate with ``flock`` locks, which
+# are released by the kernel if a job dies:
+#
+#   * The manifest is only rewritten under the lock on
+#     ``tiles-manifest.json.lock``, merging in what other jobs have recorded
+#     since it was read.
+#   * A tile is downloaded under an exclusive lock on ``<tile>.lock``, so one
+#     job downloads it while any others wait and then find it in the cache.
+#     The lock file is removed, under the lock, when its tile is evicted.
+#   * A job lists the tiles that it is using in its own lease file under
+#     ``leases/``, which it keeps locked while it runs.  The cache is trimmed
+#     to its size cap by removing the least recently used tiles that aren't
+#     in any live job's lease.  Leases are only written and read under the
+#     manifest lock, and a lease whose lock is free belongs to a job that
+#     died, so it is removed.
+#
+# Usage to shard an existing cache, to rebuild its manifest from the tiles on
+# disk, or to trim it to a size:
+#     python tilecache.py --shard-length 4 tile-cache/srtm
+#     python tilecache.py --rescan tile-cache/srtm
+#     python tilecache.py --max-size-gb 500 tile-cache/srtm
+import argparse
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import checksums
+
+LOGGER = logging.getLogger(__name__)
+PARTIAL_SUFFIX = '.part'
+LOCK_SUFFIX = '.lock'
+LEASE_SUFFIX = '.lease'
+MANIFEST_BASENAME = 'tiles-manifest.json'
+LEGACY_VERIFIED_BASENAME = 'tiles-verified.json'
+# srtm-data/srtm-rearrange.py sharded the global SRTM tiles by their first 4
+# characters, e.g. N45E, which puts at most 10 tiles in a directory.
+DEFAULT_SHARD_LENGTH = 4
+
+
+def read_checksum_file(checksum_path):
+    # The checksum file may list tiles relative to any directory, so the
+    # paths are reduced to their basenames.
+    return {
+        os.path.basename(filepath): digest for (filepath, digest) in
+        checksums.read_manifest(checksum_path).items()}
+
+
+def shard_name(tilename, shard_length):
+    # The subdirectory of a tile, or '' for a flat layout.
+    return tilename[:shard_length] if shard_length else ''
+
+
+def describe_layout(shard_length):
+    if not shard_length:
+        return 'flat'
+    return f'sharded by {shard_length} characters'
+
+
+def find_tile(tiles_dir, tilename, shard_length=DEFAULT_SHARD_LENGTH):
+    """Find a tile in a directory that may or may not be sharded.
+
+    Returns:
+        The tile's path, or None if it isn't in either layout.
+    """
+    for path in (os.path.join(tiles_dir, tilename),
+                 os.path.join(tiles_dir, shard_name(tilename, shard_length),
+                              tilename)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_product_file(filename):
+    # Whether a file directly in a product's cache directory is one of the
+    # product's own files (see the README) rather than a tile.  Caches kept
+    # their tiles there, rather than in tiles/, before tiles/ existed.
+    return (filename.startswith(('tiles-', 'README', 'download-urls', '.'))
+            or '-global.tif' in filename)
+
+
+def _is_same_file(open_file, path):
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    file_stat = os.fstat(open_file.fileno())
+    return (file_stat.st_dev, file_stat.st_ino) == (
+        path_stat.st_dev, path_stat.st_ino)
+
+
+class TileCache(object):
+    def __init__(self, root, algorithm='sha256', shard_length=None,
+                 max_size_bytes=None):
+        """Open (or create) a product's tile cache.
+
+        Args:
+            root: the product's cache directory.
+            algorithm: the checksum algorithm to verify tiles with.
+            shard_length: the number of leading characters of a tile's name
+                to shard tiles by, or 0 for a flat directory.  If None, the
+                cache's existing layout is used, and new caches are flat.
+            max_size_bytes: the size that ``evict`` trims the cache to, or
+                None for no limit.
+
+        Raises:
+            ValueError: if ``shard_length`` doesn't match the layout of an
+                existing cache.  Use ``migrate`` (or this module's command
+                line) to change the layout.
+        """
+        self.root = root
+        self.algorithm = algorithm
+        self.max_size_bytes = max_size_bytes
+        self.tiles_dir = os.path.join(root, 'tiles')
+        self.checksum_path = os.path.join(
+            root, f'tiles-checksum-{algorithm}.txt')
+        self.manifest_path = os.path.join(root, MANIFEST_BASENAME)
+        self.leases_dir = os.path.join(root, 'leases')
+        self._lock = threading.Lock()
+        # Changes not yet merged into the manifest on disk.
+        self._updates = {}
+        self._removals = set()
+        self._accessed = {}
+        # The tiles that this job holds, and its (locked) lease file listing
+        # them.
+        self._held = set()
+        self._lease_file = None
+        self._lease_path = None
+
+        if not os.path.exists(self.tiles_dir):
+            os.makedirs(self.tiles_dir, exist_ok=True)
+
+        if os.path.exists(self.checksum_path):
+            self.expected_checksums = read_checksum_file(self.checksum_path)
+        else:
+            # Nothing is checked without checksums.  fetcher.download only
+            # checks that a download wasn't cut short of its Content-Length.
+            LOGGER.warning(f"No checksum file found at {self.checksum_path}; "
+                           "tiles will not be verified")
+            self.expected_checksums = {}
+
+        manifest = self._read_manifest()
+        self.verified = manifest['tiles']
+        if shard_length is None:
+            self.shard_length = manifest['shard_length']
+        elif manifest['exists'] and shard_length != manifest['shard_length']:
+            raise ValueError(
+                f"The tile cache at {root} is "
+                f"{describe_layout(manifest['shard_length'])}, not "
+                f"{describe_layout(shard_length)}.  Run `python tilecache.py "
+                f"--shard-length {shard_length} {root}` to migrate it.")
+        else:
+            self.shard_length = shard_length
+        if not manifest['exists']:
+            # Record the layout of a new cache before any tile is written.
+            with self._lock:
+                self._save_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            return {'exists': True, 'shard_length': manifest['shard_length'],
+                    'tiles': manifest['tiles']}
+        except (OSError, ValueError, KeyError):
+            pass
+        try:
+            with open(os.path.join(
+                    self.root, LEGACY_VERIFIED_BASENAME)) as index_file:
+                tiles = json.load(index_file)
+            return {'exists': True, 'shard_length': 0, 'tiles': tiles}
+        except (OSError, ValueError):
+            pass
+        # A cache that isn't indexed yet may still have flat tiles in it.
+        return {'exists': bool(os.listdir(self.tiles_dir)),
+                'shard_length': 0, 'tiles': {}}
+
+    def tile_path(self, tilename):
+        return os.path.join(
+            self.tiles_dir, shard_name(tilename, self.shard_length),
+            tilename)
+
+    def partial_path(self, tilename):
+        # The tile's shard directory is created here, since the partial file
+        # is about to be written.
+        partial_path = self.tile_path(tilename) + PARTIAL_SUFFIX
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        return partial_path
+
+    def _stat_key(self, filepath):
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @contextlib.contextmanager
+    def _manifest_lock(self):
+        # Serializes rewriting the manifest across jobs.
+        with open(self.manifest_path + LOCK_SUFFIX, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _merged_tiles(self):
+        # The manifest on disk with this job's changes applied.
+        tiles = self._read_manifest()['tiles']
+        tiles.update(self._updates)
+        for tilename in self._removals:
+            tiles.pop(tilename, None)
+        for tilename, access_time in self._accessed.items():
+            if tilename in tiles:
+                tiles[tilename]['atime'] = max(
+                    tiles[tilename].get('atime', 0), access_time)
+        return tiles
+
+    def _write_manifest(self, tiles):
+        # Write to a temporary file and rename so that the manifest is never
+        # left half-written.  The caller holds both locks.
+        temp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'shard_length': self.shard_length,
+                       'tiles': tiles}, manifest_file)
+        os.replace(temp_path, self.manifest_path)
+        self.verified = tiles
+        self._updates = {}
+        self._removals = set()
+        self._accessed = {}
+
+    def _save_manifest(self):
+        # Merge this job's changes into the manifest.  The caller holds
+        # ``self._lock``.
+        with self._manifest_lock():
+            self._write_manifest(self._merged_tiles())
+
+    def save(self):
+        """Merge this job's pending changes into the manifest on disk.
+
+        Downloads committed with ``commit`` are only recorded in memory until
+        this is called, so that a batch of downloads rewrites the manifest
+        once rather than once per tile.  A tile whose record is lost (e.g. if
+        the job dies first) is found on disk and verified next time.
+        """
+        with self._lock:
+            if self._updates or self._removals or self._accessed:
+                self._save_manifest()
+
+    def reload(self):
+        # Pick up the tiles that other jobs have recorded.
+        with self._lock:
+            self.verified = self._merged_tiles()
+
+    def _record(self, tilename, stat_key, digest, save=True):
+        with self._lock:
+            record = {
+                'size': stat_key[0],
+                'mtime_ns': stat_key[1],
+                'atime': time.time(),
+                self.algorithm: digest,
+            }
+            self.verified[tilename] = record
+            self._updates[tilename] = record
+            self._removals.discard(tilename)
+            if save:
+                self._save_manifest()
+
+    def _forget(self, tilename):
+        # The caller holds ``self._lock``.
+        self.verified.pop(tilename, None)
+        self._updates.pop(tilename, None)
+        self._removals.add(tilename)
+
+    def verify(self, tilename, filepath=None):
+        """Check a file against the expected checksum for ``tilename``.
+
+        Returns:
+            The file's hex digest.
+
+        Raises:
+            AssertionError: if the digest does not match the expected
+                checksum.
+        """
+        if filepath is None:
+            filepath = self.tile_path(tilename)
+        LOGGER.debug(f"Checksumming ({self.algorithm}) {filepath}")
+        digest = checksums.file_digest(filepath, self.algorithm)
+        return self._check_digest(tilename, filepath, digest)
+
+    def _check_digest(self, tilename, filepath, digest):
+        expected = self.expected_checksums.get(tilename)
+        if expected is not None and digest != expected:
+            raise AssertionError(
+                f"Checksum ({self.algorithm}) failed for file {filepath}")
+        return digest
+
+    def _is_recorded(self, tilename, stat_key=None):
+        # Whether the manifest vouches for a tile.  With a ``stat_key``, the
+        # tile must also be unchanged since it was recorded.
+        record = self.verified.get(tilename)
+        if record is None or (
+                stat_key is not None and
+                [record['size'], record['mtime_ns']] != stat_key):
+            return False
+        digest = record.get(self.algorithm)
+        return (digest is not None and
+                self.expected_checksums.get(tilename, digest) == digest)
+
+    def is_valid(self, tilename):
+        """Whether ``tilename`` is present in the cache and verified.
+
+        Tiles recorded in the manifest are trusted as long as their size and
+        modification time are unchanged.  Other tiles are hashed and
+        recorded if they pass; tiles that fail verification are removed.
+        """
+        return tilename in self.valid_tiles(
+            [tilename], n_workers=1, check_files=True)
+
+    def valid_tiles(self, tilenames, n_workers=checksums.DEFAULT_N_WORKERS,
+                    check_files=False):
+        """Return the subset of ``tilenames`` that are cached and verified.
+
+        This is ``is_valid`` for many tiles at once: tiles that need to be
+        hashed are hashed in parallel.  The valid tiles are recorded as used
+        now, for the least recently used eviction.
+
+        Args:
+            tilenames: the tiles to check.
+            n_workers: the number of threads to hash tiles with.
+            check_files: if True, also ``stat`` the tiles in the manifest to
+                make sure that they haven't changed since they were
+                verified.  By default, the manifest is trusted, and only
+                tiles missing from it are looked for on disk.
+        """
+        self.reload()
+        valid = set()
+        stat_keys = {}
+        for tilename in tilenames:
+            if not check_files and self._is_recorded(tilename):
+                valid.add(tilename)
+                continue
+            try:
+                stat_keys[tilename] = self._stat_key(self.tile_path(tilename))
+            except OSError:
+                if not self._adopt_legacy_tile(tilename):
+                    continue
+                stat_keys[tilename] = self._stat_key(self.tile_path(tilename))
+            if self._is_recorded(tilename, stat_keys[tilename]):
+                valid.add(tilename)
+
+        to_hash = {
+            self.tile_path(tilename): tilename for tilename in stat_keys
+            if tilename not in valid}
+        if to_hash:
+            LOGGER.info(f"Checksumming ({self.algorithm}) {len(to_hash)} "
+                        "cached tiles")
+        digests = checksums.hash_files(to_hash, self.algorithm, n_workers)
+        for filepath, digest in digests.items():
+            tilename = to_hash[filepath]
+            try:
+                self._check_digest(tilename, filepath, digest)
+            except AssertionError:
+                LOGGER.warning(f"Removing cached tile {filepath} that "
+                               "failed verification")
+                os.remove(filepath)
+                with self._lock:
+                    self._forget(tilename)
+                continue
+            self._record(tilename, stat_keys[tilename], digest, save=False)
+            valid.add(tilename)
+
+        with self._lock:
+            access_time = time.time()
+            for tilename in valid:
+                self._accessed[tilename] = access_time
+            if valid or self._removals:
+                self._save_manifest()
+        return valid
+
+    @contextlib.contextmanager
+    def lock(self, tilename):
+        """Hold a tile's exclusive lock, e.g. while downloading it.
+
+        Blocks until no other job (or thread) is downloading the tile.
+
+        Yields:
+            Whether we had to wait for the lock, i.e. whether another job
+            may just have downloaded the tile.
+        """
+        lock_path = self.tile_path(tilename) + LOCK_SUFFIX
+        waited = False
+        while True:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    waited = True
+                # ``evict`` removes a lock file while holding it, so a lock
+                # on a file that is no longer at ``lock_path`` excludes
+                # nobody, and is taken again.
+                if _is_same_file(lock_file, lock_path):
+                    yield waited
+                    return
+            waited = True
+
+    def _remove_tile(self, tilename):
+        # Remove a tile and its lock file under the tile's lock.  Returns
+        # False, removing nothing, if a job is holding (or waiting for) the
+        # lock.  The caller holds the manifest lock.
+        lock_path = self.tile_path(tilename) + LOCK_SUFFIX
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                os.remove(self.tile_path(tilename))
+            except FileNotFoundError:
+                pass  # Already gone; only the record is left.
+            os.remove(lock_path)
+        return True
+
+    def hold(self, tilenames):
+        """Hold tiles so that no job evicts them, even before they exist.
+
+        The tiles are listed in this job's lease file until ``release`` is
+        called (or the process exits), which costs one small write however
+        many tiles are held.
+        """
+        with self._lock:
+            new_tiles = set(tilenames) - self._held
+            if not new_tiles:
+                return
+            with self._manifest_lock():
+                self._held.update(new_tiles)
+                self._write_lease()
+
+    def release(self, tilenames=None):
+        # Release some (by default, all) held tiles.
+        with self._lock:
+            if self._lease_file is None:
+                return
+            with self._manifest_lock():
+                if tilenames is None:
+                    self._held.clear()
+                else:
+                    self._held.difference_update(tilenames)
+                self._write_lease()
+
+    def _write_lease(self):
+        # Rewrite this job's lease file with the tiles it holds, or remove
+        # the file if none are held.  The lease is locked for as long as the
+        # file exists.  The caller holds both locks.
+        if not self._held:
+            if self._lease_file is not None:
+                os.remove(self._lease_path)
+                self._lease_file.close()
+                self._lease_file = None
+            return
+        if self._lease_file is None:
+            os.makedirs(self.leases_dir, exist_ok=True)
+            fd, self._lease_path = tempfile.mkstemp(
+                suffix=LEASE_SUFFIX, dir=self.leases_dir,
+                prefix=f'{socket.gethostname()}-{os.getpid()}-')
+            self._lease_file = os.fdopen(fd, 'w')
+            fcntl.flock(self._lease_file, fcntl.LOCK_EX)
+        self._lease_file.seek(0)
+        self._lease_file.truncate()
+        json.dump(sorted(self._held), self._lease_file)
+        self._lease_file.flush()
+
+    def _leased_tiles(self):
+        # The tiles held by every live job, including this one.  Leases that
+        # nobody has locked were left by jobs that died, and are removed.
+        # The caller holds the manifest lock.
+        try:
+            filenames = os.listdir(self.leases_dir)
+        except FileNotFoundError:
+            return set()
+        leased = set()
+        for filename in filenames:
+            if not filename.endswith(LEASE_SUFFIX):
+                continue
+            lease_path = os.path.join(self.leases_dir, filename)
+            with open(lease_path) as lease_file:
+                try:
+                    fcntl.flock(lease_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    leased.update(json.load(lease_file))
+                    continue
+            LOGGER.info(f"Removing {lease_path}, left by a job that died")
+            os.remove(lease_path)
+        return leased
+
+    def commit(self, tilename, partial_path=None):
+        """Verify a completed download and move it into the cache.
+
+        The tile is recorded in the manifest at the next ``save``.
+
+        Returns:
+            The path to the tile in the cache.
+
+        Raises:
+            AssertionError: if the download fails verification.  The partial
+                file is left in place for the caller to remove or retry.
+        """
+        if partial_path is None:
+            partial_path = self.partial_path(tilename)
+        digest = self.verify(tilename, partial_path)
+        target_path = self.tile_path(tilename)
+        os.replace(partial_path, target_path)
+        self._record(tilename, self._stat_key(target_path), digest,
+                     save=False)
+        return target_path
+
+    def size_bytes(self):
+        # The total size of the verified tiles.
+        return sum(record['size'] for record in self.verified.values())
+
+    def evict(self, max_size_bytes=None):
+        """Remove the least recently used tiles until the cache fits a size.
+
+        Tiles held by any job (including this one), or locked while they
+        are downloaded, are never removed.  An evicted tile's lock file is
+        removed with it.
+
+        Args:
+            max_size_bytes: the size to trim the cache to.  Defaults to the
+                cache's ``max_size_bytes``.
+
+        Returns:
+            A list of the tiles removed.
+        """
+        if max_size_bytes is None:
+            max_size_bytes = self.max_size_bytes
+        if max_size_bytes is None:
+            return []
+
+        evicted = []
+        with self._lock, self._manifest_lock():
+            tiles = self._merged_tiles()
+            leased = self._leased_tiles()
+            total_size = sum(record['size'] for record in tiles.values())
+            for tilename, record in sorted(
+                    tiles.items(), key=lambda item: item[1].get('atime', 0)):
+                if total_size <= max_size_bytes:
+                    break
+                if tilename in leased or not self._remove_tile(tilename):
+                    continue  # A job is using this tile.
+                del tiles[tilename]
+                total_size -= record['size']
+                evicted.append(tilename)
+            self._write_manifest(tiles)
+
+        if evicted:
+            LOGGER.info(f"Evicted {len(evicted)} least recently used tiles "
+                        f"from {self.root}; {total_size / 2**30:.2f} GiB "
+                        "remain")
+        if total_size > max_size_bytes:
+            LOGGER.warning(
+                f"{self.root} is still {total_size / 2**30:.2f} GiB, over "
+                f"its cap of {max_size_bytes / 2**30:.2f} GiB, because the "
+                "remaining tiles are in use")
+        return evicted
+
+    def _adopt_legacy_tile(self, tilename):
+        # Move a tile left directly in the cache's root into tiles/.  Its
+        # modification time is kept, so a legacy manifest's record of it
+        # stays valid.  Returns whether the tile is now in place.
+        legacy_path = os.path.join(self.root, tilename)
+        if is_product_file(tilename) or not os.path.isfile(legacy_path):
+            return False
+        target_path = self.tile_path(tilename)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.replace(legacy_path, target_path)
+        except FileNotFoundError:
+            pass  # Another job just moved it.
+        else:
+            LOGGER.info(f"Moved {tilename} from {self.root} into "
+                        f"{self.tiles_dir}")
+        return os.path.exists(target_path)
+
+    def _files_on_disk(self):
+        # A {tilename: path} dict of every tile (and partial download) under
+        # tiles/, in whatever layout, and left directly in the cache's root.
+        # Lock files aren't included.
+        files = {}
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not (
+                    is_product_file(entry.name) or
+                    entry.name.endswith(LOCK_SUFFIX)):
+                files[entry.name] = entry.path
+        for dirpath, _, filenames in os.walk(self.tiles_dir):
+            for filename in filenames:
+                if not filename.endswith(LOCK_SUFFIX):
+                    files[filename] = os.path.join(dirpath, filename)
+        return files
+
+    def migrate(self, shard_length):
+        """Move every tile into the layout sharded by ``shard_length``.
+
+        Tiles left directly in the cache's root, where caches kept them
+        before tiles/ existed, are moved into tiles/ too.  Tiles keep their modification times when moved, so their manifest
+        records stay valid.  Lock files and emptied shard directories are
+        removed, so no other job may be using the cache during a migration.
+
+        Returns:
+            The number of files moved.
+        """
+        n_moved = 0
+        with self._lock, self._manifest_lock():
+            self.shard_length = shard_length
+            for filename, path in sorted(self._files_on_disk().items()):
+                target_path = self.tile_path(filename)
+                if path == target_path:
+                    continue
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.replace(path, target_path)
+                n_moved += 1
+            # Remove lock files, then shard directories that are now empty,
+            # deepest first.
+            for dirpath, _, filenames in sorted(
+                    os.walk(self.tiles_dir), key=lambda entry: -len(entry[0])):
+                for filename in filenames:
+                    if filename.endswith(LOCK_SUFFIX):
+                        os.remove(os.path.join(dirpath, filename))
+                if dirpath != self.tiles_dir and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+            self._write_manifest(self._merged_tiles())
+        LOGGER.info(f"Moved {n_moved} files so that the cache is "
+                    f"{describe_layout(shard_length)}")
+        return n_moved
+
+    def rescan(self, n_workers=checksums.DEFAULT_N_WORKERS):
+        """Rebuild the manifest from the tiles on disk.
+
+        Tiles that have disappeared are dropped from the manifest, and
+        tiles that are new or changed are verified (or removed, if they fail
+        verification).
+
+        Returns:
+            The set of valid tiles.
+        """
+        tilenames = set(
+            filename for filename in self._files_on_disk()
+            if not filename.endswith(PARTIAL_SUFFIX))
+        self.reload()
+        with self._lock:
+            for tilename in list(self.verified):
+                if tilename not in tilenames:
+                    self._forget(tilename)
+            self._save_manifest()
+        return self.valid_tiles(tilenames, n_workers, check_files=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=("Change the layout of a product's tile cache, rebuild "
+                     "its manifest from the tiles on disk, or trim it to a "
+                     "size."))
+    parser.add_argument('--algorithm', default='sha256',
+                        choices=checksums.KNOWN_ALGORITHMS)
+    parser.add_argument('--shard-length', type=int, help=(
+        'Shard tiles by this many leading characters of their names, or 0 '
+        'for a flat directory.'))
+    parser.add_argument('--rescan', action='store_true', help=(
+        'Verify the tiles on disk and rebuild the manifest.'))
+    parser.add_argument('--max-size-gb', type=float, help=(
+        'Remove the least recently used tiles that no job is using until '
+        'the cache is at most this size.'))
+    parser.add_argument('--workers', type=int,
+                        default=checksums.DEFAULT_N_WORKERS)
+    parser.add_argument('cache_root', help="The product's cache directory.")
+    parsed_args = parser.parse_args(args)
+    if (parsed_args.shard_length is None and not parsed_args.rescan and
+            parsed_args.max_size_gb is None):
+        parser.error('Nothing to do: give --shard-length, --rescan and/or '
+                     '--max-size-gb.')
+
+    tile_cache = TileCache(parsed_args.cache_root, parsed_args.algorithm)
+    if parsed_args.shard_length is not None:
+        tile_cache.migrate(parsed_args.shard_length)
+    if parsed_args.rescan:
+        valid = tile_cache.rescan(parsed_args.workers)
+        LOGGER.info(f"{len(valid)} valid tiles are in {tile_cache.root}")
+    if parsed_args.max_size_gb is not None:
+        tile_cache.evict(int(parsed_args.max_size_gb * 2**30))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
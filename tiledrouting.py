@@ -0,0 +1,359 @@
+# Tiled, multi-process D8 flow accumulation.
+#
+# pygeoprocessing's flow accumulation runs in a single process.  For very
+# large (e.g. continental) flow direction rasters, this module splits the
+# raster into square tiles and accumulates each tile in its own process, then
+# stitches the tiles together exactly:
+#
+#   1. Each tile is accumulated on its own, treating flow out of the tile as
+#      leaving the raster.  For every pixel on the edge of the tile we also
+#      trace its D8 path downstream to the pixel where it leaves the tile.
+#   2. Flow that leaves one tile enters a neighboring tile at a single pixel,
+#      and every pixel downstream of that entry point on its path through
+#      the tile receives it.  Since D8 paths don't split, the total flow
+#      leaving each tile's exit pixels can be solved on the (small) graph of
+#      exit pixels in topological order.
+#   3. Each tile is accumulated again with the inflow added to the weight of
+#      its entry pixels, which gives the same result as accumulating the
+#      whole raster at once.
+#
+# Only the flow accumulation is tiled.  Filling pits and resolving flow
+# directions across flat areas both depend on the extent of depressions and
+# plateaus, which can cross any tile boundary, so those steps still run over
+# the whole raster.  Per-worker memory is bounded by the tile size.
+import concurrent.futures
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+import pygeoprocessing
+import pygeoprocessing.routing
+from osgeo import gdal
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_TILE_SIZE = 4096
+# pygeoprocessing's D8 directions: 0 is east, increasing counterclockwise.
+D8_COL_OFFSETS = numpy.array([1, 1, 0, -1, -1, -1, 0, 1], dtype=numpy.int64)
+D8_ROW_OFFSETS = numpy.array([0, -1, -1, -1, 0, 1, 1, 1], dtype=numpy.int64)
+WEIGHT_NODATA = -1.0
+
+
+def plan_tiles(n_cols, n_rows, tile_size=DEFAULT_TILE_SIZE):
+    """Split a raster into (xoff, yoff, win_xsize, win_ysize) windows."""
+    return [
+        (xoff, yoff, min(tile_size, n_cols - xoff),
+         min(tile_size, n_rows - yoff))
+        for yoff in range(0, n_rows, tile_size)
+        for xoff in range(0, n_cols, tile_size)]
+
+
+def _edge_pixels(win_xsize, win_ysize):
+    # Local (row, col) coordinates of every pixel on the edge of a window.
+    edge = numpy.zeros((win_ysize, win_xsize), dtype=bool)
+    edge[0, :] = edge[-1, :] = True
+    edge[:, 0] = edge[:, -1] = True
+    return numpy.nonzero(edge)
+
+
+def _trace_to_exits(flow_dir, valid, rows, cols):
+    # Follow the D8 path from each (row, col) until it leaves the array.
+    # Returns the local (row, col) of the last pixel on each path inside the
+    # array, or -1 where the path ends inside the array (at a pixel whose
+    # downstream neighbor has no valid flow direction).
+    win_ysize, win_xsize = flow_dir.shape
+    exit_rows = numpy.full(rows.shape, -1, dtype=numpy.int64)
+    exit_cols = numpy.full(rows.shape, -1, dtype=numpy.int64)
+    active = numpy.nonzero(valid[rows, cols])[0]
+    rows = rows.astype(numpy.int64)
+    cols = cols.astype(numpy.int64)
+
+    # A D8 path visits each pixel at most once, which bounds the loop.
+    for _ in range(flow_dir.size):
+        if not active.size:
+            break
+        direction = flow_dir[rows[active], cols[active]]
+        next_rows = rows[active] + D8_ROW_OFFSETS[direction]
+        next_cols = cols[active] + D8_COL_OFFSETS[direction]
+        leaves = ((next_rows < 0) | (next_rows >= win_ysize) |
+                  (next_cols < 0) | (next_cols >= win_xsize))
+        exit_rows[active[leaves]] = rows[active[leaves]]
+        exit_cols[active[leaves]] = cols[active[leaves]]
+
+        stays = ~leaves
+        next_rows = next_rows[stays]
+        next_cols = next_cols[stays]
+        continues = valid[next_rows, next_cols]
+        active = active[stays][continues]
+        rows[active] = next_rows[continues]
+        cols[active] = next_cols[continues]
+    return exit_rows, exit_cols
+
+
+def tile_boundary_flow(flow_dir, local_accum, flow_dir_nodata, window,
+                       n_cols, n_rows):
+    """Describe how flow crosses the edges of one tile.
+
+    Args:
+        flow_dir: the tile's D8 flow direction array.
+        local_accum: the tile's flow accumulation, computed on its own.
+        flow_dir_nodata: the flow direction nodata value.
+        window: the tile's (xoff, yoff, win_xsize, win_ysize) in the raster.
+        n_cols, n_rows: the size of the whole raster.
+
+    Returns:
+        A dict of flat (``row * n_cols + col``) raster indices:
+            ``exit_pixels``: edge pixels that drain into another tile.
+            ``exit_targets``: the pixel in another tile each one drains to.
+            ``exit_values``: the local accumulation at each exit pixel.
+            ``edge_pixels``: every edge pixel with a valid flow direction.
+            ``edge_exits``: the exit pixel that each edge pixel drains to
+                through this tile, or -1 if its path ends in the tile.
+    """
+    xoff, yoff, win_xsize, win_ysize = window
+    valid = (flow_dir != flow_dir_nodata) & (flow_dir <= 7)
+    edge_rows, edge_cols = _edge_pixels(win_xsize, win_ysize)
+    keep = valid[edge_rows, edge_cols]
+    edge_rows = edge_rows[keep]
+    edge_cols = edge_cols[keep]
+
+    direction = flow_dir[edge_rows, edge_cols].astype(numpy.int64)
+    target_rows = edge_rows + D8_ROW_OFFSETS[direction]
+    target_cols = edge_cols + D8_COL_OFFSETS[direction]
+    leaves_tile = ((target_rows < 0) | (target_rows >= win_ysize) |
+                   (target_cols < 0) | (target_cols >= win_xsize))
+    global_target_rows = target_rows + yoff
+    global_target_cols = target_cols + xoff
+    in_raster = ((global_target_rows >= 0) & (global_target_rows < n_rows) &
+                 (global_target_cols >= 0) & (global_target_cols < n_cols))
+    is_exit = leaves_tile & in_raster
+
+    exit_rows, exit_cols = _trace_to_exits(
+        flow_dir, valid, edge_rows, edge_cols)
+    ends_in_tile = exit_rows < 0
+    edge_exits = (exit_rows + yoff) * n_cols + (exit_cols + xoff)
+    # Paths that leave the whole raster (rather than this tile) don't feed
+    # another tile either.
+    exit_direction = numpy.where(
+        ends_in_tile, 0,
+        flow_dir[numpy.where(ends_in_tile, 0, exit_rows),
+                 numpy.where(ends_in_tile, 0, exit_cols)]).astype(numpy.int64)
+    exit_target_rows = exit_rows + yoff + D8_ROW_OFFSETS[exit_direction]
+    exit_target_cols = exit_cols + xoff + D8_COL_OFFSETS[exit_direction]
+    leaves_raster = ((exit_target_rows < 0) | (exit_target_rows >= n_rows) |
+                     (exit_target_cols < 0) | (exit_target_cols >= n_cols))
+    edge_exits[ends_in_tile | leaves_raster] = -1
+
+    return {
+        'exit_pixels': ((edge_rows[is_exit] + yoff) * n_cols +
+                        edge_cols[is_exit] + xoff),
+        'exit_targets': (global_target_rows[is_exit] * n_cols +
+                         global_target_cols[is_exit]),
+        'exit_values': local_accum[
+            edge_rows[is_exit], edge_cols[is_exit]].astype(numpy.float64),
+        'edge_pixels': (edge_rows + yoff) * n_cols + edge_cols + xoff,
+        'edge_exits': edge_exits,
+    }
+
+
+def solve_inflows(boundary_flows):
+    """Solve for the flow entering each tile across its edges.
+
+    Args:
+        boundary_flows: an iterable of the dicts returned by
+            ``tile_boundary_flow``, one per tile.
+
+    Returns:
+        A dict mapping the flat raster index of each pixel that receives
+        flow from another tile to the total flow it receives.
+    """
+    local_values = {}
+    exit_targets = {}
+    edge_exits = {}
+    for boundary_flow in boundary_flows:
+        local_values.update(zip(boundary_flow['exit_pixels'].tolist(),
+                                boundary_flow['exit_values'].tolist()))
+        exit_targets.update(zip(boundary_flow['exit_pixels'].tolist(),
+                                boundary_flow['exit_targets'].tolist()))
+        edge_exits.update(zip(boundary_flow['edge_pixels'].tolist(),
+                              boundary_flow['edge_exits'].tolist()))
+
+    # Each exit pixel drains (through the entry pixel in the next tile) to at
+    # most one exit pixel of the next tile.
+    feeds = {}
+    n_upstream = dict.fromkeys(local_values, 0)
+    for exit_pixel, target_pixel in exit_targets.items():
+        downstream_exit = edge_exits.get(target_pixel, -1)
+        if downstream_exit in n_upstream:
+            feeds[exit_pixel] = downstream_exit
+            n_upstream[downstream_exit] += 1
+
+    # Accumulate the exit pixels' totals in topological order.
+    totals = dict(local_values)
+    ready = [pixel for (pixel, count) in n_upstream.items() if count == 0]
+    n_solved = 0
+    while ready:
+        exit_pixel = ready.pop()
+        n_solved += 1
+        downstream_exit = feeds.get(exit_pixel)
+        if downstream_exit is None:
+            continue
+        totals[downstream_exit] += totals[exit_pixel]
+        n_upstream[downstream_exit] -= 1
+        if n_upstream[downstream_exit] == 0:
+            ready.append(downstream_exit)
+    if n_solved != len(totals):
+        raise ValueError(
+            "Flow directions contain a cycle across tile boundaries")
+
+    inflows = {}
+    for exit_pixel, target_pixel in exit_targets.items():
+        inflows[target_pixel] = (
+            inflows.get(target_pixel, 0.0) + totals[exit_pixel])
+    return inflows
+
+
+def _accumulate_tile(flow_dir_path, window, tile_dir, n_cols, n_rows,
+                     inflows=None):
+    # Worker: accumulate one tile of the flow direction raster.
+    #
+    # On the first pass (``inflows`` is None), returns the tile's boundary
+    # flow.  On the second pass, ``inflows`` maps flat raster indices of
+    # this tile's entry pixels to their inflow, and the path to the tile's
+    # final flow accumulation is returned.
+    xoff, yoff, win_xsize, win_ysize = window
+    tile_id = f'{xoff}_{yoff}'
+    tile_flow_dir_path = os.path.join(tile_dir, f'flow_dir_{tile_id}.tif')
+    if not os.path.exists(tile_flow_dir_path):
+        gdal.Translate(
+            tile_flow_dir_path, flow_dir_path,
+            srcWin=[xoff, yoff, win_xsize, win_ysize],
+            creationOptions=['TILED=YES', 'COMPRESS=LZW'])
+
+    if inflows is None:
+        local_accum_path = os.path.join(tile_dir, f'local_accum_{tile_id}.tif')
+        pygeoprocessing.routing.flow_accumulation_d8(
+            (tile_flow_dir_path, 1), local_accum_path)
+        flow_dir = pygeoprocessing.raster_to_numpy_array(tile_flow_dir_path)
+        local_accum = pygeoprocessing.raster_to_numpy_array(local_accum_path)
+        flow_dir_nodata = pygeoprocessing.get_raster_info(
+            tile_flow_dir_path)['nodata'][0]
+        return tile_boundary_flow(
+            flow_dir, local_accum, flow_dir_nodata, window, n_cols, n_rows)
+
+    accum_path = os.path.join(tile_dir, f'accum_{tile_id}.tif')
+    if not inflows:
+        # Nothing flows into this tile, so its local accumulation is final.
+        os.replace(
+            os.path.join(tile_dir, f'local_accum_{tile_id}.tif'), accum_path)
+        return accum_path
+
+    weights = numpy.ones((win_ysize, win_xsize), dtype=numpy.float64)
+    entry_pixels = numpy.fromiter(inflows.keys(), dtype=numpy.int64)
+    entry_rows = entry_pixels // n_cols - yoff
+    entry_cols = entry_pixels % n_cols - xoff
+    weights[entry_rows, entry_cols] += numpy.fromiter(
+        inflows.values(), dtype=numpy.float64)
+    weight_path = os.path.join(tile_dir, f'weights_{tile_id}.tif')
+    pygeoprocessing.numpy_array_to_raster(
+        weights, WEIGHT_NODATA, (1, -1), (0, 0), None, weight_path)
+    pygeoprocessing.routing.flow_accumulation_d8(
+        (tile_flow_dir_path, 1), accum_path,
+        weight_raster_path_band=(weight_path, 1))
+    return accum_path
+
+
+def flow_accumulation_d8_tiled(
+        flow_dir_raster_path_band, target_flow_accum_raster_path,
+        tile_size=DEFAULT_TILE_SIZE, n_workers=None, working_dir=None,
+        block_coverage=None):
+    """Compute D8 flow accumulation tile by tile in a process pool.
+
+    The result matches ``pygeoprocessing.routing.flow_accumulation_d8`` on
+    the whole raster.
+
+    Args:
+        flow_dir_raster_path_band: a (path, band) tuple of a D8 flow
+            direction raster.  Only band 1 is supported.
+        target_flow_accum_raster_path: the flow accumulation raster to
+            create.
+        tile_size: the width and height of each tile in pixels.
+        n_workers: the number of worker processes.  Defaults to every CPU.
+        working_dir: where to write intermediate tiles.  Defaults to a
+            temporary directory next to the target raster.
+        block_coverage: an optional ``coverage.BlockCoverage`` of the flow
+            direction raster.  Tiles with no data are skipped entirely and
+            left as nodata.
+
+    Returns:
+        ``None``
+    """
+    flow_dir_path = flow_dir_raster_path_band[0]
+    flow_dir_info = pygeoprocessing.get_raster_info(flow_dir_path)
+    n_cols, n_rows = flow_dir_info['raster_size']
+    windows = plan_tiles(n_cols, n_rows, tile_size)
+    if block_coverage is None:
+        has_data = [True] * len(windows)
+    else:
+        has_data = [block_coverage.has_data(*window) for window in windows]
+        LOGGER.info(f"Skipping {has_data.count(False)} of {len(windows)} "
+                    "tiles with no data")
+        if not any(has_data):
+            raise ValueError(f"{flow_dir_path} has no data to accumulate")
+    tile_dir = tempfile.mkdtemp(
+        prefix='tiled-routing-',
+        dir=working_dir or os.path.dirname(
+            os.path.abspath(target_flow_accum_raster_path)))
+    LOGGER.info(f"Accumulating flow in {len(windows)} tiles of up to "
+                f"{tile_size}x{tile_size} pixels")
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers) as executor:
+            # Nothing drains into or out of a tile with no data, so skipped
+            # tiles have no boundary flow.
+            boundary_flows = list(executor.map(
+                _accumulate_tile, *zip(*[
+                    (flow_dir_path, window, tile_dir, n_cols, n_rows)
+                    for window, tile_has_data in zip(windows, has_data)
+                    if tile_has_data])))
+            LOGGER.info("Stitching flow across tile boundaries")
+            inflows = solve_inflows(boundary_flows)
+
+            tile_inflows = [{} for _ in windows]
+            tile_index = {
+                (xoff // tile_size, yoff // tile_size): index
+                for index, (xoff, yoff, _, _) in enumerate(windows)}
+            for pixel, inflow in inflows.items():
+                row, col = divmod(pixel, n_cols)
+                tile_inflows[tile_index[
+                    (col // tile_size, row // tile_size)]][pixel] = inflow
+
+            futures = {
+                executor.submit(
+                    _accumulate_tile, flow_dir_path, window, tile_dir,
+                    n_cols, n_rows, inflows=tile_inflows[index]): window
+                for index, window in enumerate(windows) if has_data[index]}
+
+            target_raster = None
+            for future in concurrent.futures.as_completed(futures):
+                xoff, yoff, _, _ = futures[future]
+                tile_accum_path = future.result()
+                if target_raster is None:
+                    pygeoprocessing.new_raster_from_base(
+                        flow_dir_path, target_flow_accum_raster_path,
+                        gdal.GDT_Float64, pygeoprocessing.get_raster_info(
+                            tile_accum_path)['nodata'])
+                    target_raster = gdal.OpenEx(
+                        target_flow_accum_raster_path,
+                        gdal.OF_RASTER | gdal.GA_Update)
+                    target_band = target_raster.GetRasterBand(1)
+                target_band.WriteArray(
+                    pygeoprocessing.raster_to_numpy_array(tile_accum_path),
+                    xoff=xoff, yoff=yoff)
+                os.remove(tile_accum_path)
+            target_band = None
+            target_raster = None
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
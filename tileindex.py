@@ -0,0 +1,215 @@
+# A persistent spatial index over a product's tile bounding boxes.
+#
+# The per-product JSON files (e.g. srtm-data/srtm_bboxes.json) map a tile
+# filename to a closed ring of coordinates.  Parsing that JSON and building a
+# shapely polygon per tile on every lookup is slow, so instead we pack the
+# tile bounding boxes into arrays once and bucket them into a regular grid
+# keyed by integer cell, which suits the regular SRTM and GMTED tilings.  The
+# packed arrays are saved alongside the JSON file and loaded with numpy in a
+# few milliseconds.  A product's tile catalog (see catalog.py) is already
+# compact and memory-mapped, so it is queried in place and needs no index;
+# ``load_tile_index`` returns either, and both have the same lookup methods.
+#
+# Usage to prebuild an index:
+#     python tileindex.py srtm-data/srtm_bboxes.json
+import json
+import logging
+import os
+import sys
+
+import numpy
+
+import catalog
+import sidecar
+
+LOGGER = logging.getLogger(__name__)
+INDEX_SUFFIX = '-index.npz'
+
+
+def index_path_for(product_json_path):
+    return os.path.splitext(product_json_path)[0] + INDEX_SUFFIX
+
+
+class TileIndex(object):
+    def __init__(self, names, bboxes, origin, cell_size, n_cols, n_rows,
+                 cell_offsets, cell_members):
+        self.names = names  # numpy array of tile filenames
+        self.bboxes = bboxes  # float64 array of [minx, miny, maxx, maxy]
+        self.origin = origin  # (x, y) of the lower left of the grid
+        self.cell_size = cell_size
+        self.n_cols = n_cols
+        self.n_rows = n_rows
+        # CSR layout: the tiles touching cell i (row-major) are
+        # cell_members[cell_offsets[i]:cell_offsets[i+1]]
+        self.cell_offsets = cell_offsets
+        self.cell_members = cell_members
+
+    def __len__(self):
+        return len(self.names)
+
+    def _cell_range(self, min_coord, max_coord, origin, n_cells):
+        first = int((min_coord - origin) // self.cell_size)
+        last = int((max_coord - origin) // self.cell_size)
+        return max(first, 0), min(last, n_cells - 1)
+
+    def query(self, bbox):
+        """Return the sorted indices of tiles intersecting ``bbox``.
+
+        Touching edges count as intersecting, matching shapely's
+        ``intersects``.  A bbox with minx > maxx crosses the antimeridian.
+        """
+        minx, miny, maxx, maxy = bbox
+        if minx > maxx:
+            return numpy.union1d(self.query([minx, miny, 180.0, maxy]),
+                                 self.query([-180.0, miny, maxx, maxy]))
+        col_start, col_stop = self._cell_range(
+            minx, maxx, self.origin[0], self.n_cols)
+        row_start, row_stop = self._cell_range(
+            miny, maxy, self.origin[1], self.n_rows)
+        if col_start > col_stop or row_start > row_stop:
+            return numpy.empty(0, dtype=numpy.int64)
+
+        # The cells of a row of the grid are contiguous in the CSR arrays, so
+        # we only need one slice per row of cells.
+        candidates = []
+        for row in range(row_start, row_stop + 1):
+            row_offset = row * self.n_cols
+            start = self.cell_offsets[row_offset + col_start]
+            stop = self.cell_offsets[row_offset + col_stop + 1]
+            candidates.append(self.cell_members[start:stop])
+        candidates = numpy.unique(numpy.concatenate(candidates))
+
+        candidate_bboxes = self.bboxes[candidates]
+        matches = ((candidate_bboxes[:, 0] <= maxx) &
+                   (candidate_bboxes[:, 2] >= minx) &
+                   (candidate_bboxes[:, 1] <= maxy) &
+                   (candidate_bboxes[:, 3] >= miny))
+        return candidates[matches]
+
+    def lookup(self, indices):
+        # The names (as a list) and an (n, 4) array of the bboxes of tiles
+        # by index.
+        return ([str(name) for name in self.names[indices]],
+                self.bboxes[indices])
+
+    def intersecting(self, bbox):
+        for tile_index in self.query(bbox):
+            yield str(self.names[tile_index])
+
+    def save(self, target_path):
+        # Written to a temporary file and renamed, so that processes that
+        # load the index while another builds it never see a partial file.
+        # numpy.savez appends .npz unless it is given an open file.
+        temp_path = f'{target_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as target_file:
+            numpy.savez(
+                target_file,
+                names=self.names,
+                bboxes=self.bboxes,
+                grid=numpy.array(
+                    [self.origin[0], self.origin[1], self.cell_size,
+                     self.n_cols, self.n_rows], dtype=numpy.float64),
+                cell_offsets=self.cell_offsets,
+                cell_members=self.cell_members)
+        os.replace(temp_path, target_path)
+
+    @classmethod
+    def load(cls, index_path):
+        with numpy.load(index_path, allow_pickle=False) as index_data:
+            origin_x, origin_y, cell_size, n_cols, n_rows = (
+                index_data['grid'].tolist())
+            return cls(
+                names=index_data['names'],
+                bboxes=index_data['bboxes'],
+                origin=(origin_x, origin_y),
+                cell_size=cell_size,
+                n_cols=int(n_cols),
+                n_rows=int(n_rows),
+                cell_offsets=index_data['cell_offsets'],
+                cell_members=index_data['cell_members'])
+
+
+def build_tile_index(names, bboxes, cell_size=None):
+    """Build a TileIndex from tile names and an (n, 4) array of bboxes.
+
+    If ``cell_size`` is not provided, the median tile extent is used so that
+    most tiles touch no more than 4 cells of the grid.
+    """
+    names = numpy.asarray(names, dtype=str)
+    bboxes = numpy.asarray(bboxes, dtype=numpy.float64).reshape(-1, 4)
+    if cell_size is None:
+        if len(bboxes):
+            cell_size = float(numpy.median(numpy.maximum(
+                bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])))
+        if not cell_size:
+            cell_size = 1.0
+
+    if len(bboxes):
+        origin = (float(numpy.floor(bboxes[:, 0].min())),
+                  float(numpy.floor(bboxes[:, 1].min())))
+        n_cols = int((bboxes[:, 2].max() - origin[0]) // cell_size) + 1
+        n_rows = int((bboxes[:, 3].max() - origin[1]) // cell_size) + 1
+    else:
+        origin = (0.0, 0.0)
+        n_cols = n_rows = 0
+
+    col_start = ((bboxes[:, 0] - origin[0]) // cell_size).astype(numpy.int64)
+    col_stop = ((bboxes[:, 2] - origin[0]) // cell_size).astype(numpy.int64)
+    row_start = ((bboxes[:, 1] - origin[1]) // cell_size).astype(numpy.int64)
+    row_stop = ((bboxes[:, 3] - origin[1]) // cell_size).astype(numpy.int64)
+
+    cells = [[] for _ in range(n_cols * n_rows)]
+    for tile_index in range(len(bboxes)):
+        for row in range(row_start[tile_index], row_stop[tile_index] + 1):
+            for col in range(col_start[tile_index], col_stop[tile_index] + 1):
+                cells[row * n_cols + col].append(tile_index)
+
+    cell_offsets = numpy.zeros(len(cells) + 1, dtype=numpy.int64)
+    cell_offsets[1:] = numpy.cumsum([len(cell) for cell in cells])
+    cell_members = numpy.fromiter(
+        (tile_index for cell in cells for tile_index in cell),
+        dtype=numpy.int32, count=int(cell_offsets[-1]))
+
+    return TileIndex(names, bboxes, origin, cell_size, n_cols, n_rows,
+                     cell_offsets, cell_members)
+
+
+def build_tile_index_from_json(product_json_path):
+    with open(product_json_path) as data_file:
+        json_boundaries = json.load(data_file)
+
+    names = list(json_boundaries.keys())
+    bboxes = numpy.empty((len(names), 4), dtype=numpy.float64)
+    for tile_index, coords in enumerate(json_boundaries.values()):
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        bboxes[tile_index] = (coords[:, 0].min(), coords[:, 1].min(),
+                              coords[:, 0].max(), coords[:, 1].max())
+    return build_tile_index(names, bboxes)
+
+
+def load_tile_index(product_json_path):
+    """Load the tile index for a product JSON file, building it if needed.
+
+    The index is rebuilt when it is missing or older than the JSON file, and
+    loaded indexes are kept in memory for the life of the process.
+    ``product_json_path`` may also be a tile catalog, which is returned as
+    is, since a ``catalog.Catalog`` is queried in place.
+    """
+    if catalog.is_catalog_path(product_json_path):
+        return catalog.load_catalog(product_json_path)
+    return sidecar.load_or_build(
+        product_json_path, index_path_for(product_json_path), TileIndex.load,
+        build_tile_index_from_json, 'tile index')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for data_path in sys.argv[1:]:
+        if catalog.is_catalog_path(data_path):
+            LOGGER.info(f"{data_path} is a catalog, which is queried in "
+                        "place; skipping")
+            continue
+        tile_index = build_tile_index_from_json(data_path)
+        tile_index.save(index_path_for(data_path))
+        LOGGER.info(f"Indexed {len(tile_index)} tiles from {data_path} into "
+                    f"{index_path_for(data_path)}")
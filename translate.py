@@ -0,0 +1,229 @@
+# Copy a raster (typically a VRT mosaic of tiles) into a tiled GeoTIFF.
+#
+# Pixels are copied in chunks aligned to the target's block size, read as raw
+# bytes by a pool of threads (each with its own handle on the source, since
+# GDAL datasets can't be shared between threads) and written by the calling
+# thread, so no Python callback or extra array copy is needed per block.
+# Chunks that are entirely nodata (e.g. ocean) are never written, so with
+# SPARSE_OK they take no space in the target.  Compression is multithreaded
+# with NUM_THREADS.
+#
+# Usage:
+#     python translate.py mosaic.vrt global.tif
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy
+from osgeo import gdal
+from osgeo import gdal_array
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256'))
+# The fraction of available memory that chunks in flight may use.
+MEMORY_FRACTION = 0.25
+MAX_CHUNK_BLOCKS = 16
+FALLBACK_MEMORY_BYTES = 2**30
+
+
+def available_cpus():
+    # Respects CPU affinity (e.g. a SLURM allocation) where supported.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return FALLBACK_MEMORY_BYTES
+
+
+def plan_chunks(n_cols, n_rows, block_size, pixel_size_bytes, n_threads,
+                memory_budget=None):
+    """Split a raster into chunks aligned to its blocks.
+
+    Each chunk is a square of whole blocks, as large as possible (up to
+    ``MAX_CHUNK_BLOCKS`` blocks on a side) while two chunks per thread fit in
+    ``memory_budget`` bytes.
+
+    Returns:
+        A list of (xoff, yoff, win_xsize, win_ysize) windows.
+    """
+    if memory_budget is None:
+        memory_budget = available_memory() * MEMORY_FRACTION
+    block_xsize, block_ysize = block_size
+    block_bytes = block_xsize * block_ysize * pixel_size_bytes
+    blocks_per_chunk = max(memory_budget / (2 * n_threads * block_bytes), 1)
+    chunk_blocks = int(min(max(blocks_per_chunk ** 0.5, 1), MAX_CHUNK_BLOCKS))
+    chunk_xsize = block_xsize * chunk_blocks
+    chunk_ysize = block_ysize * chunk_blocks
+    return [
+        (xoff, yoff, min(chunk_xsize, n_cols - xoff),
+         min(chunk_ysize, n_rows - yoff))
+        for yoff in range(0, n_rows, chunk_ysize)
+        for xoff in range(0, n_cols, chunk_xsize)]
+
+
+def translate_raster(
+        source_raster_path, target_raster_path,
+        raster_driver_creation_tuple=DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS,
+        n_threads=None, memory_budget=None, block_coverage=None):
+    """Copy band 1 of a raster into a new tiled raster.
+
+    Args:
+        source_raster_path: the raster to copy, e.g. a VRT of tiles.
+        target_raster_path: the raster to create.
+        raster_driver_creation_tuple: a (driver name, creation options)
+            tuple.  SPARSE_OK and NUM_THREADS are always set.
+        n_threads: the number of reader threads and compression threads.
+            Defaults to the number of available CPUs.
+        memory_budget: the number of bytes that chunks in flight may use.
+            Defaults to a fraction of available memory.
+        block_coverage: an optional ``coverage.BlockCoverage`` of the source
+            raster.  Chunks with no data are skipped without being read.
+
+    Returns:
+        A tuple of (number of chunks written, number of chunks skipped).
+    """
+    if n_threads is None:
+        n_threads = available_cpus()
+    driver_name, creation_options = raster_driver_creation_tuple
+    creation_options = [
+        option for option in creation_options
+        if option.partition('=')[0].upper() not in ('NUM_THREADS',
+                                                    'SPARSE_OK')]
+    creation_options += ['SPARSE_OK=TRUE', f'NUM_THREADS={n_threads}']
+
+    source_raster = gdal.OpenEx(source_raster_path, gdal.OF_RASTER)
+    source_band = source_raster.GetRasterBand(1)
+    n_cols = source_raster.RasterXSize
+    n_rows = source_raster.RasterYSize
+    datatype = source_band.DataType
+    nodata = source_band.GetNoDataValue()
+    numpy_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(datatype)
+
+    driver = gdal.GetDriverByName(driver_name)
+    target_raster = driver.Create(
+        target_raster_path, n_cols, n_rows, 1, datatype,
+        options=creation_options)
+    target_raster.SetGeoTransform(source_raster.GetGeoTransform())
+    target_raster.SetProjection(source_raster.GetProjection())
+    target_band = target_raster.GetRasterBand(1)
+    if nodata is not None:
+        target_band.SetNoDataValue(nodata)
+    block_size = target_band.GetBlockSize()
+    source_band = None
+    source_raster = None
+
+    chunks = plan_chunks(
+        n_cols, n_rows, block_size,
+        gdal.GetDataTypeSize(datatype) // 8, n_threads, memory_budget)
+    LOGGER.info(
+        f"Translating {source_raster_path} to {target_raster_path} in "
+        f"{len(chunks)} chunks of up to {chunks[0][2]}x{chunks[0][3]} pixels "
+        f"with {n_threads} threads")
+
+    thread_local = threading.local()
+
+    def _read_chunk(window):
+        if not hasattr(thread_local, 'band'):
+            thread_local.raster = gdal.OpenEx(
+                source_raster_path, gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(1)
+        band = thread_local.band
+        if block_coverage is not None and not block_coverage.has_data(
+                *window):
+            return window, None
+        if nodata is not None:
+            # Formats that know where their data is (e.g. a VRT of tiles)
+            # can report empty windows without reading them.
+            flags, _ = band.GetDataCoverageStatus(*window)
+            if flags == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+                return window, None
+        buffer = band.ReadRaster(*window)
+        if nodata is not None and numpy.all(
+                numpy.frombuffer(buffer, dtype=numpy_dtype) == nodata):
+            return window, None
+        return window, buffer
+
+    n_written = 0
+    n_skipped = 0
+    start_time = time.time()
+    last_report_time = start_time
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_threads) as executor:
+        # Submit a bounded number of chunks at a time so that memory use
+        # stays within the budget however large the raster is.
+        pending = set()
+        for window in chunks:
+            pending.add(executor.submit(_read_chunk, window))
+            if len(pending) < 2 * n_threads:
+                continue
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                written = _write_chunk(target_band, *future.result())
+                n_written += written
+                n_skipped += not written
+            if time.time() - last_report_time > 5.0:
+                LOGGER.info(
+                    f"Translated {n_written + n_skipped}/{len(chunks)} "
+                    f"chunks ({n_skipped} empty)")
+                last_report_time = time.time()
+        for future in concurrent.futures.as_completed(pending):
+            written = _write_chunk(target_band, *future.result())
+            n_written += written
+            n_skipped += not written
+
+    target_band = None
+    target_raster = None
+    LOGGER.info(
+        f"Translated {target_raster_path} in "
+        f"{time.time() - start_time:.1f}s: {n_written} chunks written, "
+        f"{n_skipped} empty chunks skipped")
+    return n_written, n_skipped
+
+
+def _write_chunk(target_band, window, buffer):
+    if buffer is None:
+        return False
+    target_band.WriteRaster(*window, buffer)
+    return True
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Copy a raster into a sparse, tiled, compressed GeoTIFF.')
+    parser.add_argument('--threads', type=int, default=available_cpus())
+    parser.add_argument('--memory-budget-mb', type=float)
+    parser.add_argument('--co', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='A creation option to use instead of the '
+                             'defaults.  May be given more than once.')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parsed_args = parser.parse_args(args)
+
+    creation_tuple = DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS
+    if parsed_args.co:
+        creation_tuple = ('GTIFF', tuple(parsed_args.co))
+    memory_budget = None
+    if parsed_args.memory_budget_mb:
+        memory_budget = parsed_args.memory_budget_mb * 2**20
+    translate_raster(parsed_args.source, parsed_args.target, creation_tuple,
+                     parsed_args.threads, memory_budget)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# Read zipped tiles (e.g. SRTM's .hgt.zip) in place, without extracting them.
+#
+# GDAL's SRTMHGT driver can open most SRTM zips directly, but only when the
+# zip's member is named like the zip (N45E005.SRTMGL1.hgt.zip containing
+# N45E005.hgt).  A handful of tiles (see
+# https://www.opentopodata.org/notes/invalid-srtm-zips/) have differently
+# named members, so every zipped tile is read through /vsizip/ with its
+# actual member name.  The member is taken from the product's catalog where
+# catalogbuilder.py recorded it, and otherwise read from the zip's central
+# directory (which is cheap, and remembered for the life of the process).
+#
+# A VRT mosaic keeps its sources open in a process-wide pool of dataset
+# handles, least recently used first out, so that a block read doesn't have
+# to reopen (and, for a zip, re-read the directory of) every tile it touches.
+# ``configure_dataset_pool`` sizes that pool to the mosaic, within the
+# process's limit on open files.
+import functools
+import logging
+import os
+import resource
+import zipfile
+
+from osgeo import gdal
+
+import catalog
+
+LOGGER = logging.getLogger(__name__)
+ZIP_SUFFIX = '.zip'
+# GDAL's own default.
+DEFAULT_DATASET_POOL_SIZE = 100
+# The share of the open file limit that the pool may use, leaving room for
+# the outputs, the zips' own handles and anything else the process opens.
+OPEN_FILES_FRACTION = 0.5
+
+
+def is_zipped(tile_path):
+    return tile_path.lower().endswith(ZIP_SUFFIX)
+
+
+def choose_member(member_names):
+    # The raster in a tile's zip: an .hgt file if there is one, otherwise
+    # the first file.
+    member_names = sorted(
+        (name for name in member_names if not name.endswith('/')),
+        key=lambda name: (not name.lower().endswith('.hgt'), name))
+    if not member_names:
+        return None
+    return member_names[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _zip_member(zip_path, mtime_ns):
+    with zipfile.ZipFile(zip_path) as tile_archive:
+        return choose_member(tile_archive.namelist())
+
+
+def zip_member(zip_path):
+    """The name of the raster inside a local zip, read from its directory.
+
+    Raises:
+        ValueError: if the zip has no files in it.
+    """
+    member = _zip_member(
+        os.path.abspath(zip_path), os.stat(zip_path).st_mtime_ns)
+    if member is None:
+        raise ValueError(f"{zip_path} has no files in it")
+    return member
+
+
+def gdal_path(tile_path, member=None):
+    """The path for GDAL to read a tile in place.
+
+    Args:
+        tile_path: the tile's local path.
+        member: the name of the raster inside the tile, if the tile is a
+            zip and the name is already known.
+
+    Returns:
+        ``tile_path`` itself, or a /vsizip/ path to the raster in a zip.
+    """
+    if not is_zipped(tile_path):
+        return tile_path
+    if not member:
+        member = zip_member(tile_path)
+    return f'/vsizip/{os.path.abspath(tile_path)}/{member}'
+
+
+def gdal_paths(tile_paths, tile_data_file=None):
+    """The GDAL paths of many tiles, using the catalog's members if any.
+
+    Args:
+        tile_paths: the tiles' local paths, whose basenames are the tile
+            names.
+        tile_data_file: the product's tile data file.  Members are only
+            known when this is a catalog.
+    """
+    members = {}
+    if tile_data_file is not None and catalog.is_catalog_path(
+            tile_data_file):
+        product_catalog = catalog.load_catalog(tile_data_file)
+        members = product_catalog.members(
+            [os.path.basename(path) for path in tile_paths
+             if is_zipped(path)])
+    return [gdal_path(path, members.get(os.path.basename(path)))
+            for path in tile_paths]
+
+
+def configure_dataset_pool(n_datasets):
+    """Let GDAL keep up to ``n_datasets`` tiles open at once.
+
+    This only takes effect if no VRT is open yet, since GDAL sizes its pool
+    when the first one is opened.  The pool is never made smaller than
+    GDAL's default, nor larger than ``OPEN_FILES_FRACTION`` of the open file
+    limit.
+
+    Returns:
+        The pool size that was set.
+    """
+    pool_size = max(n_datasets, DEFAULT_DATASET_POOL_SIZE)
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY:
+        pool_size = min(pool_size, max(
+            int(soft_limit * OPEN_FILES_FRACTION), DEFAULT_DATASET_POOL_SIZE))
+    LOGGER.debug(f"Keeping up to {pool_size} datasets open")
+    gdal.SetConfigOption('GDAL_MAX_DATASET_POOL_SIZE', str(pool_size))
+    return pool_size